@@ -9,34 +9,53 @@ from PIL import Image
 # Paths
 import os
 
+# Normalization
+from stats import NORM_MEAN, NORM_STD
+
+# Test-time augmentation
+from batch_transforms import TestTimeAugment
+
+# Quantized models and ONNX graphs
+from onnx_backend import OnnxModel
+from quantization import is_quantized
+
 # Utils
 from tqdm import tqdm
 
 class HistopathologyImageMaker:
-    def __init__(self, model: torch.nn.Module) -> None:
+    def __init__(self, model: torch.nn.Module, mean: tuple = NORM_MEAN, std: tuple = NORM_STD, tta: int = 1) -> None:
         """
         Constructor for the HistopathologyImageMaker
 
         Args:
-            model (torch.nn.Module): Model that will be used to predict the patches in the reconstruction.
+            model (torch.nn.Module): Model that will be used to predict the patches in the reconstruction (float, int8 quantized or an ONNX graph).
+            mean (tuple, optional): Mean of every channel of the training data (see stats.dataset_stats). Defaults to NORM_MEAN.
+            std (tuple, optional): Standard deviation of every channel of the training data. Defaults to NORM_STD.
+            tta (int, optional): Number of views (flips and rotations) of every patch whose logits are averaged, in a single forward pass. 1 disables it. Defaults to 1.
 
         Raises:
             TypeError: The given model is not a torch.nn.Module
+            TypeError: The given mean or standard deviation is not a tuple
         """  
 
         if not isinstance(model, torch.nn.Module): raise TypeError('"model" must be a torch.nn.Module')
+        if not (isinstance(mean, tuple) and isinstance(std, tuple)): raise TypeError('"mean" and "std" must be tuples')
 
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        # Quantized models (see quantization.quantize_model) and ONNX graphs (see onnx_backend.OnnxModel) only run on the CPU
+        self.device = 'cuda' if torch.cuda.is_available() and not (is_quantized(model) or isinstance(model, OnnxModel)) else 'cpu'
 
         self.model = model.to(self.device)
 
+        # Test-time augmentation (see batch_transforms.TestTimeAugment)
+        self.tta = TestTimeAugment(tta) if tta > 1 else None
+
         self.transforms =  transforms.Compose([
 
             # Convert to tensor
             transforms.ToTensor(),
 
             # Normalize train dataset with its mean and standard deviation
-            transforms.Normalize((0.7595, 0.5646, 0.6882), (0.1496, 0.1970, 0.1428))
+            transforms.Normalize(mean, std)
         ])
 
         return
@@ -220,8 +239,11 @@ class HistopathologyImageMaker:
                 # Add an extra dimension to allow forwarding through the model
                 tensor = tensor[None]
 
-                # Predict label
-                output = self.model(tensor)[:,:1].squeeze(1)
+                # Predict label (averaging the logits of the views of the patch)
+                if self.tta is not None:
+                    output = self.tta.reduce(self.model(self.tta(tensor))[:,:1].squeeze(1))
+                else:
+                    output = self.model(tensor)[:,:1].squeeze(1)
 
                 predicted = 1 if torch.sigmoid(output) > 0.5 else 0
 
@@ -0,0 +1,213 @@
+# PyTorch
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Dataset, IterableDataset, Subset
+
+# Evaluation loop
+from train import evaluate
+
+# Utils
+from utils import build_model, layout_neutral_state_dict
+import numpy as np
+
+# Others
+import os
+import queue
+import sys
+from typing import Callable, Iterator, Tuple
+
+def eval_subset(dataset: Dataset, fraction: float, seed: int = 0) -> Dataset:
+    """
+    Returns a fixed random subset of the test set, the same in every evaluation so accuracies stay comparable
+
+    Args:
+        dataset (Dataset): The test set.
+        fraction (float): Fraction of the images kept, in (0, 1].
+        seed (int, optional): Seed of the subset. Defaults to 0.
+
+    Raises:
+        TypeError: The given fraction is not a float
+        ValueError: The given fraction is not in (0, 1]
+        ValueError: Streamed datasets can not be subsampled
+
+    Returns:
+        Dataset: The subset (the dataset itself if fraction is 1).
+    """
+    if not isinstance(fraction, float): raise TypeError('"fraction" must be a float.')
+    if not 0 < fraction <= 1: raise ValueError('"fraction" must be in (0, 1].')
+
+    if fraction == 1:
+        return dataset
+
+    if isinstance(dataset, IterableDataset): raise ValueError('Streamed datasets can not be subsampled.')
+
+    n_images = max(1, int(len(dataset) * fraction))
+    indices = np.sort(np.random.default_rng(seed).choice(len(dataset), n_images, replace = False))
+
+    return Subset(dataset, indices.tolist())
+
+
+def eval_worker(config: dict, requests: mp.Queue, results: mp.Queue) -> None:
+    """
+    Evaluates the weight snapshots it receives until it receives None (run in a separate process)
+
+    Args:
+        config (dict): Model name, memory format, device, test set, batch size, loader arguments,
+        batch transform and autocast type.
+        requests (mp.Queue): Queue of (epoch, state dict) snapshots.
+        results (mp.Queue): Queue where the (epoch, accuracy) results are put.
+
+    Returns:
+        None
+    """
+    # The progress bar of the training process stays readable
+    sys.stdout = open(os.devnull, 'w')
+
+    device = config['device']
+    model = build_model(config['model_name'], channels_last = config['channels_last']).to(device)
+    testloader = DataLoader(dataset = config['dataset'], batch_size = config['batch_size'], shuffle = False, **config['loader_kwargs'])
+    criterion = torch.nn.BCEWithLogitsLoss()
+
+    while True:
+
+        request = requests.get()
+        if request is None:
+            break
+
+        epoch, state_dict = request
+        model.load_state_dict(state_dict)
+        del state_dict
+
+        acc = evaluate(criterion, device, model, config['model_name'], testloader, batch_transform = config['batch_transform'],
+                       amp_dtype = config['amp_dtype'], log_interval = len(testloader))
+
+        results.put((epoch, acc))
+
+
+class AsyncEvaluator:
+    def __init__(self, model_name: str, device: str, dataset: Dataset, batch_size: int, loader_kwargs: dict = None, batch_transform: Callable = None,
+                 amp_dtype: torch.dtype = None, channels_last: bool = False, max_pending: int = 2) -> None:
+        """
+        Evaluates snapshots of the weights in a separate process, so training goes on while the test set is evaluated.
+        Snapshots are copied to shared CPU memory once and kept until their accuracy arrives, so the best one can be saved.
+
+        Args:
+            model_name (str): The name of the model.
+            device (str): Device the evaluation runs on (CPU or GPU).
+            dataset (Dataset): The test set (see eval_subset).
+            batch_size (int): Batch size.
+            loader_kwargs (dict, optional): Extra arguments of the test DataLoader. Defaults to None.
+            batch_transform (Callable, optional): Transform applied to every test batch on the device. Defaults to None.
+            amp_dtype (torch.dtype, optional): Type used by autocast in the forward pass. None means float32. Defaults to None.
+            channels_last (bool, optional): Whether the model is built in the channels_last memory format. Defaults to False.
+            max_pending (int, optional): Maximum number of snapshots waiting for their accuracy. Submitting
+            more waits for the oldest one, which bounds the memory used by snapshots. Defaults to 2.
+
+        Raises:
+            TypeError: The given model name is not a str
+            TypeError: The given device is not a str
+            ValueError: The given maximum number of pending snapshots is not a positive integer
+        """
+        if not isinstance(model_name, str): raise TypeError('"model_name" must be a str')
+        if not isinstance(device, str): raise TypeError('"device" must be a str (CPU or GPU).')
+        if not (isinstance(max_pending, int) and max_pending > 0): raise ValueError('"max_pending" must be a positive integer.')
+
+        self.max_pending = max_pending
+
+        # Snapshots waiting for their accuracy, and results not yet collected
+        self.snapshots = {}
+        self.ready = []
+
+        config = {'model_name': model_name, 'channels_last': channels_last, 'device': device, 'dataset': dataset, 'batch_size': batch_size,
+                  'loader_kwargs': loader_kwargs or {}, 'batch_transform': batch_transform, 'amp_dtype': amp_dtype}
+
+        context = mp.get_context('spawn')
+        self.requests, self.results = context.Queue(), context.Queue()
+
+        # Not a daemon, so the worker can start its own data loader workers
+        self.process = context.Process(target = eval_worker, args = (config, self.requests, self.results), daemon = False)
+        self.process.start()
+
+    def submit(self, epoch: int, model: torch.nn.Module) -> None:
+        """
+        Sends a snapshot of the current weights to the evaluation worker
+
+        Args:
+            epoch (int): Epoch the model was trained up to.
+            model (torch.nn.Module): The model (compiled, distributed or not).
+
+        Returns:
+            None
+        """
+        while len(self.snapshots) >= self.max_pending:
+            self.ready.append(self.receive(block = True))
+
+        state_dict = { key: value.detach().to('cpu', copy = True) for key, value in layout_neutral_state_dict(model).items() }
+
+        self.snapshots[epoch] = state_dict
+        self.requests.put((epoch, state_dict))
+
+    def receive(self, block: bool) -> Tuple[int, float, dict]:
+        """
+        Gets the next result of the evaluation worker
+
+        Args:
+            block (bool): Whether to wait for it.
+
+        Raises:
+            RuntimeError: The evaluation worker stopped before sending the result
+
+        Returns:
+            tuple: The epoch, the accuracy and the snapshot (None if not blocking and no result is available).
+        """
+        while True:
+            try:
+                epoch, acc = self.results.get(timeout = 1.0) if block else self.results.get_nowait()
+                return epoch, acc, self.snapshots.pop(epoch)
+
+            except queue.Empty:
+                if not block:
+                    return None
+                if not self.process.is_alive():
+                    raise RuntimeError('The evaluation worker stopped unexpectedly.')
+
+    def collect(self, wait: bool = False) -> Iterator[Tuple[int, float, dict]]:
+        """
+        Returns the results that have arrived, in the order they were submitted
+
+        Args:
+            wait (bool, optional): Whether to wait for every pending snapshot. Defaults to False.
+
+        Returns:
+            Iterator: The epoch, the accuracy and the snapshot of every result.
+        """
+        while self.ready:
+            yield self.ready.pop(0)
+
+        while self.snapshots:
+            result = self.receive(block = wait)
+            if result is None:
+                return
+            yield result
+
+    def close(self, timeout: float = 60.0) -> None:
+        """
+        Stops the evaluation worker once it has evaluated every snapshot submitted.
+        A worker still busy after the timeout (e.g. training stopped with an error) is terminated,
+        so the training process never waits for it forever.
+
+        Args:
+            timeout (float, optional): Seconds given to the worker to stop. Defaults to 60.
+
+        Returns:
+            None
+        """
+        self.requests.put(None, timeout = timeout)
+        self.process.join(timeout)
+
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+            # Snapshots never read by the worker must not keep this process from exiting
+            self.requests.cancel_join_thread()
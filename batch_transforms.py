@@ -0,0 +1,321 @@
+# PyTorch
+import torch
+import torch.nn.functional as F
+
+# Others
+import math
+from typing import Dict, Tuple
+
+# Transforms that run on a whole collated batch once it is on the target device,
+# instead of one sample at a time inside the data loader.
+
+class BatchCompose:
+    def __init__(self, transfs: list) -> None:
+        """
+        Composes several batch transforms together.
+
+        Args:
+            transfs (list): List of batch transforms to apply in order.
+
+        Raises:
+            TypeError: The given transforms are not a list
+        """
+        if not isinstance(transfs, list): raise TypeError('"transfs" must be a list.')
+
+        self.transfs = transfs
+
+    def __call__(self, inputs: torch.Tensor) -> torch.Tensor:
+        """
+        Applies every transform to the batch
+
+        Args:
+            inputs (torch.Tensor): Batch of images (N x C x H x W)
+
+        Returns:
+            torch.Tensor: The transformed batch
+        """
+        for transf in self.transfs:
+            inputs = transf(inputs)
+
+        return inputs
+
+
+class BatchAugment:
+    def __init__(self, h_flip: float = 0.25, v_flip: float = 0.05, angles: list = None) -> None:
+        """
+        Random flips and discrete rotations applied to a batch of images.
+        Every image gets its own random draws, with the same probabilities as
+        RandomHorizontalFlip, RandomVerticalFlip and the random angle of BreastCancerDataset.
+
+        Args:
+            h_flip (float, optional): Probability of a horizontal flip. Defaults to 0.25.
+            v_flip (float, optional): Probability of a vertical flip. Defaults to 0.05.
+            angles (list, optional): List of integers which each one indicates an angle to perform a discrete rotation. None means no rotations will be done. Defaults to None.
+
+        Raises:
+            TypeError: The given probabilities are not floats
+            TypeError: The given angles are not a list
+        """
+        if not isinstance(h_flip, float): raise TypeError('"h_flip" must be a float.')
+        if not isinstance(v_flip, float): raise TypeError('"v_flip" must be a float.')
+        if not ( angles is None or isinstance(angles, list) ): raise TypeError('"angles" must be a list of integer or None.')
+
+        self.h_flip = h_flip
+        self.v_flip = v_flip
+        self.angles = angles
+
+        # Sampling grids of every angle, built once per image size, device and dtype
+        self.grids: Dict[Tuple, torch.Tensor] = {}
+
+    def rotation_grids(self, inputs: torch.Tensor) -> torch.Tensor:
+        """
+        Returns the sampling grids of every angle for the given batch
+
+        Args:
+            inputs (torch.Tensor): Batch of images (N x C x H x W)
+
+        Returns:
+            torch.Tensor: The sampling grids (len(angles) x H x W x 2)
+        """
+        key = (inputs.shape[-2], inputs.shape[-1], inputs.device, inputs.dtype)
+
+        if key not in self.grids:
+
+            # Counterclockwise rotation (as TF.rotate), expressed as the map from output to input coordinates
+            radians = torch.tensor([math.radians(agl) for agl in self.angles], dtype = torch.float64)
+            cos, sin, zeros = torch.cos(radians), torch.sin(radians), torch.zeros_like(radians)
+
+            theta = torch.stack([torch.stack([cos, -sin, zeros], dim = 1), torch.stack([sin, cos, zeros], dim = 1)], dim = 1)
+
+            size = (len(self.angles), inputs.shape[1], inputs.shape[-2], inputs.shape[-1])
+            self.grids[key] = F.affine_grid(theta, size, align_corners = False).to(device = inputs.device, dtype = inputs.dtype)
+
+        return self.grids[key]
+
+    def __call__(self, inputs: torch.Tensor) -> torch.Tensor:
+        """
+        Augments the batch
+
+        Args:
+            inputs (torch.Tensor): Batch of images (N x C x H x W)
+
+        Returns:
+            torch.Tensor: The augmented batch
+        """
+        batch_size = inputs.shape[0]
+
+        # Random flips, one draw per image
+        flip = torch.rand(batch_size, device = inputs.device) < self.h_flip
+        inputs = torch.where(flip[:, None, None, None], inputs.flip(-1), inputs)
+
+        flip = torch.rand(batch_size, device = inputs.device) < self.v_flip
+        inputs = torch.where(flip[:, None, None, None], inputs.flip(-2), inputs)
+
+        # Rotate the images (equal probabilities for all angles)
+        if self.angles is not None:
+
+            angle_idx = torch.randint(len(self.angles), (batch_size,), device = inputs.device)
+
+            # Nearest neighbour and zero fill, as TF.rotate does for tensors
+            inputs = F.grid_sample(inputs, self.rotation_grids(inputs)[angle_idx], mode = 'nearest', padding_mode = 'zeros', align_corners = False)
+
+        return inputs
+
+
+class BatchNormalize:
+    def __init__(self, mean: tuple, std: tuple, dtype: torch.dtype = torch.float32) -> None:
+        """
+        Converts a batch of uint8 images to float and normalizes it with the mean and
+        standard deviation of the dataset, as ToTensor and Normalize do for a single image.
+        Scaling and normalization are fused into a single multiply-add.
+
+        Args:
+            mean (tuple): Mean of every channel (images in [0, 1]).
+            std (tuple): Standard deviation of every channel (images in [0, 1]).
+            dtype (torch.dtype, optional): Type of the normalized batch. Defaults to torch.float32.
+
+        Raises:
+            TypeError: The given mean is not a tuple
+            TypeError: The given standard deviation is not a tuple
+        """
+        if not isinstance(mean, tuple): raise TypeError('"mean" must be a tuple.')
+        if not isinstance(std, tuple): raise TypeError('"std" must be a tuple.')
+
+        self.mean = mean
+        self.std = std
+        self.dtype = dtype
+
+        # Scale and bias of every channel, built once per device
+        self.params: Dict[torch.device, Tuple[torch.Tensor, torch.Tensor]] = {}
+
+    def __call__(self, inputs: torch.Tensor) -> torch.Tensor:
+        """
+        Normalizes the batch
+
+        Args:
+            inputs (torch.Tensor): Batch of uint8 images (N x C x H x W)
+
+        Returns:
+            torch.Tensor: The normalized batch
+        """
+        if inputs.device not in self.params:
+
+            # (x / 255 - mean) / std == x * scale + bias
+            std = torch.tensor(self.std, dtype = torch.float64)
+            mean = torch.tensor(self.mean, dtype = torch.float64)
+
+            scale = (1 / (255 * std)).to(device = inputs.device, dtype = self.dtype)
+            bias = (-mean / std).to(device = inputs.device, dtype = self.dtype)
+
+            self.params[inputs.device] = (scale[None, :, None, None], bias[None, :, None, None])
+
+        scale, bias = self.params[inputs.device]
+
+        return torch.addcmul(bias, inputs.to(self.dtype), scale)
+
+
+class BatchResize:
+    def __init__(self, size: tuple) -> None:
+        """
+        Resizes a batch of images with bilinear interpolation, as transforms.Resize does for a single image.
+        Used to upsample the 50 x 50 patches to the input size of the ViT on the device, so the
+        loader only moves 50 x 50 images.
+
+        Args:
+            size (tuple): Output size (height, width).
+
+        Raises:
+            TypeError: The given size is not a tuple
+        """
+        if not isinstance(size, tuple): raise TypeError('"size" must be a tuple.')
+
+        self.size = size
+
+    def __call__(self, inputs: torch.Tensor) -> torch.Tensor:
+        """
+        Resizes the batch
+
+        Args:
+            inputs (torch.Tensor): Batch of images (N x C x H x W)
+
+        Returns:
+            torch.Tensor: The resized batch
+        """
+        if tuple(inputs.shape[-2:]) == self.size:
+            return inputs
+
+        return F.interpolate(inputs, size = self.size, mode = 'bilinear', align_corners = False)
+
+
+class BatchChannelsLast:
+    def __call__(self, inputs: torch.Tensor) -> torch.Tensor:
+        """
+        Returns the batch in the channels_last (NHWC) memory format. Nothing is copied if it already is.
+
+        Args:
+            inputs (torch.Tensor): Batch of images (N x C x H x W)
+
+        Returns:
+            torch.Tensor: The same batch in the channels_last memory format
+        """
+        return inputs.contiguous(memory_format = torch.channels_last)
+
+
+class TestTimeAugment:
+    def __init__(self, views: int, angles: list = None) -> None:
+        """
+        Test-time augmentation over the orientations seen in training. A batch of B images is expanded
+        into its K views (a K*B batch, so the model runs a single forward pass) and the logits of the
+        views of every image are averaged. Views are taken in order from: the image itself, its
+        horizontal and vertical flips, then its rotations by increasing magnitude (15, -15, 30, ...).
+
+        Args:
+            views (int): Number of views K of every image (1 is the image alone).
+            angles (list, optional): Discrete rotation set of the training augmentation. None means list(range(-90,91,15)). Defaults to None.
+
+        Raises:
+            TypeError: The given angles are not a list
+            ValueError: The given number of views is not between 1 and the number of orientations
+        """
+        angles = list(range(-90, 91, 15)) if angles is None else angles
+        if not isinstance(angles, list): raise TypeError('"angles" must be a list of integer or None.')
+
+        # (angle, horizontal flip, vertical flip) of every view, the image itself first
+        orientations = [(0, False, False), (0, True, False), (0, False, True)]
+        orientations += [ (agl, False, False) for agl in sorted(set(angles) - {0}, key = lambda agl: (abs(agl), -agl)) ]
+
+        if not (isinstance(views, int) and 1 <= views <= len(orientations)): raise ValueError('"views" must be an integer between 1 and %d.' % len(orientations))
+
+        self.views = views
+        self.orientations = orientations[:views]
+
+        # Sampling grids of every view, built once per image size, device and dtype
+        self.grids: Dict[Tuple, torch.Tensor] = {}
+
+    def view_grids(self, inputs: torch.Tensor) -> torch.Tensor:
+        """
+        Returns the sampling grids of every view for the given batch
+
+        Args:
+            inputs (torch.Tensor): Batch of images (N x C x H x W)
+
+        Returns:
+            torch.Tensor: The sampling grids (K x H x W x 2)
+        """
+        key = (inputs.shape[-2], inputs.shape[-1], inputs.device, inputs.dtype)
+
+        if key not in self.grids:
+
+            # Flip, then counterclockwise rotation (as the training augmentation), from output to input coordinates
+            theta = []
+            for agl, h_flip, v_flip in self.orientations:
+                cos, sin = math.cos(math.radians(agl)), math.sin(math.radians(agl))
+                x_sign, y_sign = -1 if h_flip else 1, -1 if v_flip else 1
+                theta.append([[x_sign * cos, -x_sign * sin, 0], [y_sign * sin, y_sign * cos, 0]])
+
+            theta = torch.tensor(theta, dtype = torch.float64)
+
+            size = (self.views, 1, inputs.shape[-2], inputs.shape[-1])
+            self.grids[key] = F.affine_grid(theta, size, align_corners = False).to(device = inputs.device, dtype = inputs.dtype)
+
+        return self.grids[key]
+
+    def __call__(self, inputs: torch.Tensor) -> torch.Tensor:
+        """
+        Expands the batch into its views
+
+        Args:
+            inputs (torch.Tensor): Batch of images (B x C x H x W)
+
+        Returns:
+            torch.Tensor: The views (K*B x C x H x W), the B images of the first view first
+        """
+        if self.views == 1:
+            return inputs
+
+        batch_size, channels, height, width = inputs.shape
+        channels_last = inputs.is_contiguous(memory_format = torch.channels_last) and not inputs.is_contiguous()
+
+        # The images of the batch are stacked as channels, so a single grid per view samples all of them
+        stacked = inputs.reshape(1, batch_size * channels, height, width).expand(self.views, -1, -1, -1)
+
+        # Nearest neighbour and zero fill, as the training rotations
+        views = F.grid_sample(stacked, self.view_grids(inputs), mode = 'nearest', padding_mode = 'zeros', align_corners = False)
+        views = views.reshape(self.views * batch_size, channels, height, width)
+
+        return views.contiguous(memory_format = torch.channels_last) if channels_last else views
+
+    def reduce(self, outputs: torch.Tensor) -> torch.Tensor:
+        """
+        Averages the logits of the views of every image
+
+        Args:
+            outputs (torch.Tensor): Logits of the views (K*B x ...)
+
+        Returns:
+            torch.Tensor: Logits of the images (B x ...)
+        """
+        if self.views == 1:
+            return outputs
+
+        return outputs.float().reshape(self.views, -1, *outputs.shape[1:]).mean(0)
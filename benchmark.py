@@ -0,0 +1,349 @@
+# Performance measurements of the training and inference paths on synthetic data
+
+# PyTorch
+import torch
+from torch.optim.lr_scheduler import ExponentialLR
+from torch.utils.data import DataLoader, TensorDataset
+
+# Training and testing loops
+from train import train
+
+# Activation checkpointing
+from checkpointing import enable_activation_checkpointing
+
+# Test-time augmentation
+from batch_transforms import TestTimeAugment
+
+# Utils
+from utils import build_model, build_optimizer
+
+# Others
+import argparse as arg
+import copy
+import multiprocessing as mp
+import resource
+import time
+from typing import Tuple
+
+parser = arg.ArgumentParser(description= 'Measure the performance of the training and inference paths on synthetic data.')
+subparsers = parser.add_subparsers(dest = 'command')
+
+# Steps per second with per-step and deferred metric reads
+sync_parser = subparsers.add_parser('sync', help= 'Steps per second of train() reading the metrics every step vs every N steps')
+sync_parser.add_argument('-n', '--nets', dest = 'nets', default = 'lenet5,alexnet', type=str, help= 'Comma separated models')
+sync_parser.add_argument('-b', '--batch_size', dest = 'batch_size', default = 64, type=int, help= 'Batch size')
+sync_parser.add_argument('-s', '--steps', dest = 'steps', default = 200, type=int, help= 'Number of steps measured')
+sync_parser.add_argument('-l', '--log_interval', dest = 'log_interval', default = 50, type=int, help= 'Deferred log interval')
+
+# Peak memory and step time with and without activation checkpointing
+ckpt_parser = subparsers.add_parser('checkpoint', help= 'Peak memory and step time with and without activation checkpointing')
+ckpt_parser.add_argument('-n', '--nets', dest = 'nets', default = 'vit_l_16,convnext_large,densenet161,efficientnetb7', type=str, help= 'Comma separated models')
+ckpt_parser.add_argument('-b', '--batch_size', dest = 'batch_size', default = 8, type=int, help= 'Batch size')
+ckpt_parser.add_argument('-s', '--steps', dest = 'steps', default = 5, type=int, help= 'Number of steps measured')
+ckpt_parser.add_argument('-sg', '--segments', dest = 'segments', default = '0,2,4', type=str, help= 'Comma separated number of segments (0 disables checkpointing)')
+
+# Step time with the NCHW and channels_last memory formats
+layout_parser = subparsers.add_parser('layout', help= 'Step time of every model with NCHW and channels_last weights and batches')
+layout_parser.add_argument('-n', '--nets', dest = 'nets', default = 'resnet50,densenet121,efficientnetb0,convnext_tiny', type=str, help= 'Comma separated models')
+layout_parser.add_argument('-b', '--batch_size', dest = 'batch_size', default = 32, type=int, help= 'Batch size')
+layout_parser.add_argument('-s', '--steps', dest = 'steps', default = 20, type=int, help= 'Number of steps measured')
+
+# Latency and peak memory of test-time augmentation for every number of views
+tta_parser = subparsers.add_parser('tta', help= 'Batch latency, images per second and peak memory of prediction with K test-time augmentation views')
+tta_parser.add_argument('-n', '--nets', dest = 'nets', default = 'efficientnetb0,resnet50', type=str, help= 'Comma separated models')
+tta_parser.add_argument('-b', '--batch_size', dest = 'batch_size', default = 64, type=int, help= 'Batch size (images before the expansion into views)')
+tta_parser.add_argument('-s', '--steps', dest = 'steps', default = 20, type=int, help= 'Number of steps measured')
+tta_parser.add_argument('-k', '--views', dest = 'views', default = '1,3,5,9,15', type=str, help= 'Comma separated number of views')
+
+# Device setup
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+def input_size(model_name: str) -> int:
+    """
+    Returns the input size of a model
+    Args:
+        model_name: Name of the model
+    """
+    return 224 if model_name.startswith('vit') else 50
+
+def synthetic_loader(model_name: str, batch_size: int, steps: int) -> DataLoader:
+    """
+    Builds a data loader of random images already in memory, so only the model is measured
+    Args:
+        model_name: Name of the model
+        batch_size: Batch size
+        steps: Number of batches
+    """
+    size = input_size(model_name)
+    images = torch.randn(batch_size * steps, 3, size, size)
+    labels = torch.randint(2, (batch_size * steps,))
+
+    return DataLoader(TensorDataset(images, labels), batch_size = batch_size, shuffle = False)
+
+def bench_sync(args):
+    """
+    Measures the steps per second of train() reading the metrics every step vs every N steps
+    Args:
+        args: Arguments passed from the argument parser
+    """
+    criterion = torch.nn.BCEWithLogitsLoss()
+    results = []
+
+    for model_name in args.nets.split(','):
+
+        model = build_model(model_name).to(device)
+        optimizer = build_optimizer(model, 'adam')
+        scheduler = ExponentialLR(optimizer, gamma = 0.95)
+        trainloader = synthetic_loader(model_name, args.batch_size, args.steps)
+
+        # Warm up
+        train(criterion, device, 0, model, model_name, optimizer, scheduler, synthetic_loader(model_name, args.batch_size, 10))
+
+        for log_interval in (1, args.log_interval):
+
+            begin = time.perf_counter()
+            train(criterion, device, 0, model, model_name, optimizer, scheduler, trainloader, log_interval = log_interval)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+
+            results.append((model_name, log_interval, args.steps / (time.perf_counter() - begin)))
+
+    print('%-12s %-12s %s' % ('Model', 'Log interval', 'Steps/s'))
+    for model_name, log_interval, rate in results:
+        print('%-12s %-12d %.1f' % (model_name, log_interval, rate))
+
+def peak_memory() -> float:
+    """
+    Returns the peak memory used so far by this process in MiB (device memory on GPU, resident memory on CPU)
+    """
+    if device == 'cuda':
+        return torch.cuda.max_memory_allocated() / 1024**2
+
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def batchnorm_stats_match(model_name: str, segments: int, batch_size: int) -> bool:
+    """
+    Checks that a training step updates the BatchNorm running statistics of a checkpointed model
+    as it updates those of the same model without checkpointing (once, not again in the recomputation)
+    Args:
+        model_name: Name of the model
+        segments: Number of segments
+        batch_size: Batch size
+    """
+    model = build_model(model_name).to(device).train()
+    checkpointed = enable_activation_checkpointing(copy.deepcopy(model), model_name, segments)
+
+    size = input_size(model_name)
+    inputs = torch.randn(batch_size, 3, size, size, device = device)
+
+    # Same random draws (dropout, stochastic depth) in both models
+    for net in (model, checkpointed):
+        torch.manual_seed(0)
+        net(inputs)[:,:1].sum().backward()
+
+    expected = dict(model.named_buffers())
+
+    return all(torch.allclose(buffer.float(), expected[name].float()) for name, buffer in checkpointed.named_buffers())
+
+def measure_checkpointing(config: tuple) -> tuple:
+    """
+    Measures the step time and the peak memory of training steps (run in a fresh process,
+    so peak memory of other configurations does not leak into it), and checks the BatchNorm statistics
+    Args:
+        config: Name of the model, number of segments (0 disables checkpointing), batch size and number of steps
+    """
+    model_name, segments, batch_size, steps = config
+
+    # Checked first, so its memory is not counted by the measurement below
+    stats_match = batchnorm_stats_match(model_name, segments, batch_size) if segments > 0 else None
+
+    model = build_model(model_name)
+    if segments > 0:
+        model = enable_activation_checkpointing(model, model_name, segments)
+    model = model.to(device).train()
+
+    optimizer = build_optimizer(model, 'adam')
+    criterion = torch.nn.BCEWithLogitsLoss()
+
+    size = input_size(model_name)
+    inputs = torch.randn(batch_size, 3, size, size, device = device)
+    labels = torch.randint(2, (batch_size,), device = device).float()
+
+    def step():
+        optimizer.zero_grad()
+        loss = criterion(model(inputs)[:,:1].squeeze(1), labels)
+        loss.backward()
+        optimizer.step()
+
+    # Warm up (also allocates the optimizer state)
+    step()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    begin = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+    return (time.perf_counter() - begin) / steps, peak_memory(), stats_match
+
+def bench_checkpoint(args):
+    """
+    Measures peak memory and step time with and without activation checkpointing
+    Args:
+        args: Arguments passed from the argument parser
+    """
+    results = []
+
+    for model_name in args.nets.split(','):
+        for segments in [ int(segments) for segments in args.segments.split(',') ]:
+
+            with mp.get_context('spawn').Pool(1) as pool:
+                step_time, peak, stats_match = pool.apply(measure_checkpointing, ((model_name, segments, args.batch_size, args.steps),))
+
+            results.append((model_name, segments, step_time, peak, stats_match))
+
+    print('%-16s %-9s %-13s %-18s %s' % ('Model', 'Segments', 'Step time (s)', 'Peak memory (MiB)', 'Same BN statistics'))
+    for model_name, segments, step_time, peak, stats_match in results:
+        print('%-16s %-9s %-13.3f %-18.0f %s' % (model_name, segments if segments > 0 else 'off', step_time, peak, '-' if stats_match is None else stats_match))
+
+def measure_layout(model_name: str, channels_last: bool, batch_size: int, steps: int) -> Tuple[float, float]:
+    """
+    Measures the time of a training step and of an inference step in a memory format
+    Args:
+        model_name: Name of the model
+        channels_last: Whether the weights and the batch are channels_last
+        batch_size: Batch size
+        steps: Number of steps
+    """
+    model = build_model(model_name, channels_last = channels_last).to(device)
+    optimizer = build_optimizer(model, 'adam')
+    criterion = torch.nn.BCEWithLogitsLoss()
+
+    size = input_size(model_name)
+    inputs = torch.randn(batch_size, 3, size, size, device = device)
+    labels = torch.randint(2, (batch_size,), device = device).float()
+
+    if channels_last:
+        inputs = inputs.contiguous(memory_format = torch.channels_last)
+
+    def train_step():
+        optimizer.zero_grad()
+        loss = criterion(model(inputs)[:,:1].squeeze(1), labels)
+        loss.backward()
+        optimizer.step()
+
+    def test_step():
+        with torch.no_grad():
+            model(inputs)
+
+    times = []
+    for step, mode in ((train_step, True), (test_step, False)):
+
+        model.train(mode)
+
+        # Warm up
+        step()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+        begin = time.perf_counter()
+        for _ in range(steps):
+            step()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+        times.append((time.perf_counter() - begin) / steps)
+
+    return times[0], times[1]
+
+def bench_layout(args):
+    """
+    Measures the step time of every model with NCHW and channels_last weights and batches
+    Args:
+        args: Arguments passed from the argument parser
+    """
+    results = []
+
+    for model_name in args.nets.split(','):
+        for channels_last in (False, True):
+            results.append((model_name, channels_last) + measure_layout(model_name, channels_last, args.batch_size, args.steps))
+
+    print('%-16s %-14s %-14s %s' % ('Model', 'Layout', 'Train step (s)', 'Test step (s)'))
+    for model_name, channels_last, train_time, test_time in results:
+        print('%-16s %-14s %-14.4f %.4f' % (model_name, 'channels_last' if channels_last else 'NCHW', train_time, test_time))
+
+def measure_tta(config: tuple) -> tuple:
+    """
+    Measures the latency of a prediction step with test-time augmentation and the peak memory
+    (run in a fresh process, so peak memory of other configurations does not leak into it)
+    Args:
+        config: Name of the model, number of views, batch size and number of steps
+    """
+    model_name, views, batch_size, steps = config
+
+    model = build_model(model_name).to(device).eval()
+    tta = TestTimeAugment(views)
+
+    size = input_size(model_name)
+    inputs = torch.randn(batch_size, 3, size, size, device = device)
+
+    def step():
+        with torch.no_grad():
+            torch.sigmoid(tta.reduce(model(tta(inputs))[:,:1].squeeze(1)))
+
+    # Warm up
+    step()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    begin = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+    return (time.perf_counter() - begin) / steps, peak_memory()
+
+def bench_tta(args):
+    """
+    Measures the batch latency, images per second and peak memory of prediction for every number of test-time augmentation views
+    Args:
+        args: Arguments passed from the argument parser
+    """
+    results = []
+
+    for model_name in args.nets.split(','):
+        for views in [ int(views) for views in args.views.split(',') ]:
+
+            with mp.get_context('spawn').Pool(1) as pool:
+                step_time, peak = pool.apply(measure_tta, ((model_name, views, args.batch_size, args.steps),))
+
+            results.append((model_name, views, step_time, peak))
+
+    print('%-16s %-6s %-18s %-10s %s' % ('Model', 'Views', 'Batch latency (ms)', 'Images/s', 'Peak memory (MiB)'))
+    for model_name, views, step_time, peak in results:
+        print('%-16s %-6d %-18.2f %-10.1f %.0f' % (model_name, views, 1000 * step_time, args.batch_size / step_time, peak))
+
+def main():
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    if args.command == 'sync':
+        bench_sync(args)
+    elif args.command == 'checkpoint':
+        bench_checkpoint(args)
+    elif args.command == 'layout':
+        bench_layout(args)
+    elif args.command == 'tta':
+        bench_tta(args)
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+# PyTorch
+import torch
+
+# Utils
+import numpy as np
+
+# Others
+import io
+import os
+import queue
+import random
+import re
+import threading
+from typing import Any, Optional
+
+def to_cpu(obj: Any) -> Any:
+    """
+    Copies every tensor of a (nested) state to the CPU, so the copy no longer changes while training goes on
+
+    Args:
+        obj (Any): Tensor, or dict, list or tuple of them (e.g. a state dict).
+
+    Returns:
+        Any: The copy.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy = True)
+    if isinstance(obj, dict):
+        return { key: to_cpu(value) for key, value in obj.items() }
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+
+    return obj
+
+def capture_rng_state() -> dict:
+    """
+    Returns the state of every random number generator used by training (Python, NumPy, PyTorch CPU and GPU)
+
+    Returns:
+        dict: The states.
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+
+    return {
+        'python': random.getstate(),
+        'numpy': (name, keys.tolist(), pos, has_gauss, cached_gaussian),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []
+    }
+
+def restore_rng_state(state: dict) -> None:
+    """
+    Restores the random number generators from capture_rng_state()
+
+    Args:
+        state (dict): The states.
+
+    Returns:
+        None
+    """
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+
+    random.setstate(state['python'])
+    np.random.set_state((name, np.array(keys, dtype = np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+
+    if torch.cuda.is_available() and state['cuda']:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def sampler_state(loader: torch.utils.data.DataLoader) -> dict:
+    """
+    Returns the epoch and seed of the sampler of a loader (or of its dataset, for streamed shards)
+
+    Args:
+        loader (torch.utils.data.DataLoader): The training loader.
+
+    Returns:
+        dict: The state (empty for samplers without one, driven by the PyTorch generator).
+    """
+    source = loader.sampler if hasattr(loader.sampler, 'set_epoch') else loader.dataset
+
+    return { key: getattr(source, key) for key in ('epoch', 'seed') if hasattr(source, key) }
+
+def restore_sampler_state(loader: torch.utils.data.DataLoader, state: dict) -> None:
+    """
+    Restores the sampler of a loader from sampler_state()
+
+    Args:
+        loader (torch.utils.data.DataLoader): The training loader.
+        state (dict): The state.
+
+    Returns:
+        None
+    """
+    source = loader.sampler if hasattr(loader.sampler, 'set_epoch') else loader.dataset
+
+    for key, value in state.items():
+        setattr(source, key, value)
+
+def atomic_save(data: bytes, path: str) -> None:
+    """
+    Writes a file atomically: the data goes to a temporary file of the same directory, which then replaces
+    the destination. A crash leaves either the previous file or the new one, never a truncated one.
+
+    Args:
+        data (bytes): Content of the file.
+        path (str): Destination.
+
+    Returns:
+        None
+    """
+    tmp = path + '.tmp'
+
+    with open(tmp, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(tmp, path)
+
+
+class CheckpointWriter:
+    def __init__(self, directory: str = './pretrained', name: str = 'output', keep_last: int = 3, resume: bool = False) -> None:
+        """
+        Writes checkpoints in a background thread, so training does not wait for the disk.
+        The best checkpoint is "<directory>/<name>.pth" (with the usual 'model', 'accuracy' and 'epoch' keys)
+        and the last keep_last checkpoints are "<directory>/<name>_epoch<N>.pth". Every write is atomic.
+        Only the epoch checkpoints of this run are deleted when they get old (see clear for the ones of previous runs).
+
+        Args:
+            directory (str, optional): Directory of the checkpoints. Defaults to './pretrained'.
+            name (str, optional): Name of the checkpoints. Defaults to 'output'.
+            keep_last (int, optional): Number of last checkpoints kept, older ones are deleted. Defaults to 3.
+            resume (bool, optional): Whether this run continues the one of the epoch checkpoints on disk, which then count as its own. Defaults to False.
+
+        Raises:
+            TypeError: The given directory is not a str
+            TypeError: The given name is not a str
+            ValueError: The given number of checkpoints kept is not a positive integer
+        """
+        if not isinstance(directory, str): raise TypeError('"directory" must be a str.')
+        if not isinstance(name, str): raise TypeError('"name" must be a str.')
+        if not (isinstance(keep_last, int) and keep_last > 0): raise ValueError('"keep_last" must be a positive integer.')
+
+        self.directory = directory
+        self.name = name
+        self.keep_last = keep_last
+
+        os.makedirs(directory, exist_ok = True)
+
+        # Epochs of the checkpoints of this run, the only ones deleted when they get old
+        self.written = self.last_epochs() if resume else []
+
+        # Error of the writer thread, raised in the training thread
+        self.error = None
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def best_path(self) -> str:
+        """
+        Returns the path of the best checkpoint
+
+        Returns:
+            str: The path.
+        """
+        return os.path.join(self.directory, self.name + '.pth')
+
+    def last_path(self, epoch: int) -> str:
+        """
+        Returns the path of the checkpoint of an epoch
+
+        Args:
+            epoch (int): The epoch.
+
+        Returns:
+            str: The path.
+        """
+        return os.path.join(self.directory, '%s_epoch%d.pth' % (self.name, epoch))
+
+    def last_epochs(self) -> list:
+        """
+        Returns the epochs of the last checkpoints on disk
+
+        Returns:
+            list: The epochs, in increasing order.
+        """
+        pattern = re.compile(re.escape(self.name) + r'_epoch(\d+)\.pth$')
+        matches = [ pattern.match(file) for file in os.listdir(self.directory) ]
+
+        return sorted(int(match.group(1)) for match in matches if match is not None)
+
+    def latest(self) -> Optional[str]:
+        """
+        Returns the path of the most recent checkpoint to resume from
+
+        Returns:
+            str: The path (None if there is none).
+        """
+        epochs = self.last_epochs()
+
+        return self.last_path(epochs[-1]) if epochs else None
+
+    def clear(self) -> None:
+        """
+        Deletes the epoch checkpoints of a previous run with the same name, so a later
+        resume can not pick one of them up
+
+        Returns:
+            None
+        """
+        for epoch in self.last_epochs():
+            if epoch not in self.written:
+                os.remove(self.last_path(epoch))
+
+    def save(self, state: dict, best: bool = False, last: bool = True) -> None:
+        """
+        Queues a checkpoint. The state is copied to the CPU before returning, the rest happens in the background.
+
+        Args:
+            state (dict): The checkpoint, with at least the 'epoch' key.
+            best (bool, optional): Whether it is saved as the best checkpoint. Defaults to False.
+            last (bool, optional): Whether it is saved as the checkpoint of its epoch. Defaults to True.
+
+        Raises:
+            RuntimeError: A previous write failed
+
+        Returns:
+            None
+        """
+        self.check()
+        self.queue.put((to_cpu(state), best, last))
+
+    def run(self) -> None:
+        """
+        Writes the queued checkpoints (writer thread)
+
+        Returns:
+            None
+        """
+        while True:
+            item = self.queue.get()
+
+            try:
+                if item is None:
+                    return
+
+                state, best, last = item
+
+                # Serialized once, even if written twice
+                buffer = io.BytesIO()
+                torch.save(state, buffer)
+                data = buffer.getvalue()
+
+                if best:
+                    atomic_save(data, self.best_path())
+
+                if last:
+                    atomic_save(data, self.last_path(state['epoch']))
+
+                    if state['epoch'] not in self.written:
+                        self.written.append(state['epoch'])
+
+                    # Only checkpoints of this run are deleted
+                    for epoch in self.written[:-self.keep_last]:
+                        if os.path.isfile(self.last_path(epoch)):
+                            os.remove(self.last_path(epoch))
+
+                    self.written = self.written[-self.keep_last:]
+
+            except Exception as error:
+                self.error = error
+
+            finally:
+                self.queue.task_done()
+
+    def check(self) -> None:
+        """
+        Raises the error of a failed write, if any
+
+        Raises:
+            RuntimeError: A previous write failed
+
+        Returns:
+            None
+        """
+        if self.error is not None:
+            raise RuntimeError('Checkpoint write failed') from self.error
+
+    def flush(self) -> None:
+        """
+        Waits until every queued checkpoint is on disk
+
+        Raises:
+            RuntimeError: A write failed
+
+        Returns:
+            None
+        """
+        self.queue.join()
+        self.check()
+
+    def close(self) -> None:
+        """
+        Writes the queued checkpoints and stops the writer thread
+
+        Raises:
+            RuntimeError: A write failed
+
+        Returns:
+            None
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
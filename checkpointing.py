@@ -0,0 +1,140 @@
+# PyTorch
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+# Others
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from typing import Tuple
+
+@contextmanager
+def frozen_batchnorm_stats(modules: list):
+    """
+    Restores the running statistics of the BatchNorm layers of some modules on exit, so recomputing
+    their forward pass in the backward pass does not update the statistics a second time
+
+    Args:
+        modules (list): The modules.
+    """
+    layers = [ layer for module in modules for layer in module.modules() if isinstance(layer, nn.modules.batchnorm._BatchNorm) ]
+    saved = [ [ (buffer, buffer.clone()) for buffer in layer.buffers(recurse = False) ] for layer in layers ]
+
+    # Also restored when the recomputation is stopped early (non-reentrant checkpoint raises once it has what it needs)
+    try:
+        yield
+
+    finally:
+        with torch.no_grad():
+            for buffers in saved:
+                for buffer, value in buffers:
+                    buffer.copy_(value)
+
+class CheckpointedSequential(nn.Sequential):
+    def __init__(self, module: nn.Sequential, segments: int) -> None:
+        """
+        Sequential module whose activations are recomputed in the backward pass instead of kept.
+        Only the inputs of every segment are stored while training. It keeps the children
+        (and their names) of the wrapped module, so state dicts are the same with or without it.
+        BatchNorm layers see every training batch twice, but their running statistics are
+        restored after the recomputation, so they are updated once per batch as without checkpointing.
+
+        Args:
+            module (nn.Sequential): The module to checkpoint.
+            segments (int): Number of segments the children are split in.
+
+        Raises:
+            TypeError: The given module is not a nn.Sequential
+            ValueError: The given number of segments is not a positive integer
+        """
+        if not isinstance(module, nn.Sequential): raise TypeError('"module" must be a nn.Sequential')
+        if not (isinstance(segments, int) and segments > 0): raise ValueError('"segments" must be a positive integer')
+
+        super(CheckpointedSequential, self).__init__(OrderedDict(module.named_children()))
+
+        self.segments = min(segments, len(self))
+
+    def run_segment(self, start: int, end: int, x: torch.Tensor) -> torch.Tensor:
+        """
+        Runs the children of a segment
+
+        Args:
+            start (int): Index of the first child.
+            end (int): Index after the last child.
+            x (torch.Tensor): Input of the segment.
+
+        Returns:
+            torch.Tensor: Output of the segment.
+        """
+        for module in list(self)[start:end]:
+            x = module(x)
+
+        return x
+
+    def segment_contexts(self, start: int, end: int) -> Tuple:
+        """
+        Returns the contexts of the forward pass and of the recomputation of a segment
+
+        Args:
+            start (int): Index of the first child.
+            end (int): Index after the last child.
+
+        Returns:
+            tuple: Nothing special for the forward pass, the BatchNorm statistics restored after the recomputation.
+        """
+        return nullcontext(), frozen_batchnorm_stats(list(self)[start:end])
+
+    def forward(self, x):
+
+        # Nothing to save for backward when evaluating
+        if not (self.training and torch.is_grad_enabled()):
+            return super(CheckpointedSequential, self).forward(x)
+
+        # Every segment but the last one is checkpointed (as checkpoint_sequential does)
+        size = len(self) // self.segments
+        for start in range(0, size * (self.segments - 1), size):
+            x = checkpoint(partial(self.run_segment, start, start + size), x, use_reentrant = False,
+                           context_fn = partial(self.segment_contexts, start, start + size))
+
+        return self.run_segment(size * (self.segments - 1), len(self), x)
+
+
+def enable_activation_checkpointing(model: nn.Module, model_name: str, segments: int) -> nn.Module:
+    """
+    Wraps the encoder blocks (ViT) or the feature stages (ConvNeXt, DenseNet, EfficientNet, ResNet, VGG)
+    of a model built by utils.build_model with activation checkpointing.
+
+    Args:
+        model (nn.Module): The model.
+        model_name (str): The name of the model.
+        segments (int): Number of segments of every checkpointed module.
+
+    Raises:
+        TypeError: The given model is not a nn.Module
+        TypeError: The given model name is not a str
+        ValueError: Activation checkpointing is not available for the given model.
+
+    Returns:
+        nn.Module: The same model, with its blocks checkpointed.
+    """
+    if not isinstance(model, nn.Module): raise TypeError('"model" must be a nn.Module')
+    if not isinstance(model_name, str): raise TypeError('"model_name" must be a str')
+
+    # Encoder blocks
+    if model_name.startswith('vit'):
+        model.encoder.layers = CheckpointedSequential(model.encoder.layers, segments)
+
+    # Feature stages
+    elif model_name.startswith(('convnext', 'densenet', 'efficientnet', 'vgg')):
+        model.features = CheckpointedSequential(model.features, segments)
+
+    # Residual stages, every stage is split in segments
+    elif model_name.startswith('resnet'):
+        for layer in ('layer1', 'layer2', 'layer3', 'layer4'):
+            setattr(model, layer, CheckpointedSequential(getattr(model, layer), segments))
+
+    else:
+        raise ValueError('Activation checkpointing is not available for "%s"' % model_name)
+
+    return model
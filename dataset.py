@@ -2,24 +2,188 @@
 from PIL import Image 
 
 # Path to images
-import glob
+import io
+import json
+import os
+import tarfile
+import re
 from os import path
 
 # For data augmentation
-from random import choice
+from random import choice, Random
 from torchvision import transforms
 import torchvision.transforms.functional as TF
 
 # To create the class
-from torch.utils.data.dataset import Dataset
+from torch.utils.data import DataLoader, default_collate, get_worker_info
+from torch.utils.data.dataset import Dataset, IterableDataset
+import torch.distributed as dist
+
+# Default normalization
+from stats import NORM_MEAN, NORM_STD
+
+# Cache files are replaced atomically
+from checkpoint import atomic_save
 
 # Utilities
-from typing import Tuple
+import hashlib
+import numpy as np
+import torch
+from tqdm import tqdm
+from typing import Iterator, Tuple
 from torch import Tensor
 
+# Patch file names look like "[<patient>_][idx5_]x<X>_y<Y>_class<L>.png"
+PATCH_NAME = re.compile(r'(?:(\d+)_)?(?:idx5_)?x(\d+)_y(\d+)_class([01])\.png$')
+
+# Directory where cached data (transformed test sets, manifests...) is stored
+CACHE_DIR = './cache/'
+
+# Index of a directory of tar shards
+SHARD_INDEX = 'shards.json'
+
+# Files that make up a packed patch store
+PACKED_FILES = ('images.npy', 'labels.npy', 'patients.npy', 'coords.npy', 'names.npy')
+
+def parse_patch_name(name: str) -> Tuple[int, int, int, int]:
+    """
+    Extracts the patient id, position and label embedded in a patch file name.
+
+    Args:
+        name (str): File name (or path) of the patch.
+
+    Raises:
+        TypeError: The given name is not a str
+        ValueError: The given name does not follow the patch naming scheme
+
+    Returns:
+        int: The patient id (-1 if it is not part of the name).
+        int: The x coordinate of the patch.
+        int: The y coordinate of the patch.
+        int: The label of the patch.
+    """
+    if not isinstance(name, str): raise TypeError('"name" must be a str.')
+
+    match = PATCH_NAME.search(path.basename(name))
+    if match is None: raise ValueError('"%s" is not a valid patch name.' % name)
+
+    patient, x, y, label = match.groups()
+
+    return (int(patient) if patient is not None else -1), int(x), int(y), int(label)
+
+
+def to_uint8_tensor(img) -> Tensor:
+    """
+    Converts an image to a uint8 tensor without scaling it.
+
+    Args:
+        img (PIL.Image or np.ndarray): The image (H x W x C)
+
+    Returns:
+        Tensor: The image as a uint8 tensor (C x H x W). It is a view of the pixels, collation makes it contiguous.
+    """
+    pixels = img if isinstance(img, np.ndarray) else np.array(img.convert('RGB'))
+
+    return torch.from_numpy(pixels).permute(2, 0, 1)
+
+
+def channels_last_collate(batch: list) -> Tuple[Tensor, Tensor]:
+    """
+    Collates images into a batch in the channels_last (NHWC) memory format, with a single copy.
+
+    Args:
+        batch (list): List of (image, label) samples, images are C x H x W tensors.
+
+    Returns:
+        Tensor: The images (N x C x H x W, channels_last strides).
+        Tensor: The labels.
+    """
+    images = torch.stack([ tensor.permute(1, 2, 0) for tensor, _ in batch ]).permute(0, 3, 1, 2)
+
+    return images, default_collate([ label for _, label in batch ])
+
+
+# One record per image of a manifest, the file names are kept in a separate byte buffer
+MANIFEST_DTYPE = np.dtype([('offset', np.int64), ('length', np.int32), ('label', np.uint8), ('patient', np.int32), ('x', np.int32), ('y', np.int32)])
+
+def build_manifest(data_dir: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Lists the patches of a directory as a compact manifest.
+
+    Args:
+        data_dir (str): Path to the images
+
+    Raises:
+        TypeError: The given path is not a string
+        OSError: Path to images not found
+
+    Returns:
+        np.ndarray: One MANIFEST_DTYPE record per image, sorted by file name.
+        np.ndarray: The uint8 buffer with every file name, indexed by the "offset" and "length" of the records.
+    """
+    if not isinstance(data_dir, str): raise TypeError('"data_dir" must be a str.')
+    if not path.isdir(data_dir): raise OSError ('Directory not found')
+
+    with os.scandir(data_dir) as entries:
+        names = sorted(entry.name for entry in entries if entry.is_file() and not entry.name.startswith('.') and PATCH_NAME.search(entry.name))
+
+    manifest = np.empty(len(names), dtype = MANIFEST_DTYPE)
+    encoded = [name.encode() for name in names]
+
+    lengths = np.array([len(name) for name in encoded], dtype = np.int32)
+    manifest['length'] = lengths
+    manifest['offset'] = np.cumsum(lengths) - lengths
+
+    for idx, name in enumerate(names):
+        manifest['patient'][idx], manifest['x'][idx], manifest['y'][idx], manifest['label'][idx] = parse_patch_name(name)
+
+    return manifest, np.frombuffer(b''.join(encoded), dtype = np.uint8)
+
+
+def load_manifest(data_dir: str, cache_dir: str = CACHE_DIR) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Loads the manifest of a directory, building it only if the directory changed since it was cached.
+
+    Args:
+        data_dir (str): Path to the images
+        cache_dir (str, optional): Directory where manifests are cached. Defaults to CACHE_DIR.
+
+    Raises:
+        TypeError: The given path is not a string
+        OSError: Path to images not found
+
+    Returns:
+        np.ndarray: One MANIFEST_DTYPE record per image, sorted by file name.
+        np.ndarray: The uint8 buffer with every file name.
+    """
+    if not isinstance(data_dir, str): raise TypeError('"data_dir" must be a str.')
+    if not path.isdir(data_dir): raise OSError ('Directory not found')
+
+    # Adding, removing or renaming files changes the modification time of the directory
+    mtime = os.stat(data_dir).st_mtime_ns
+
+    # Stored outside the data directory, as writing in it would change its modification time
+    file = path.join(cache_dir, 'manifest_' + hashlib.sha1(path.abspath(data_dir).encode()).hexdigest()[:16] + '.npz')
+
+    if path.isfile(file):
+        with np.load(file) as cached:
+            if int(cached['mtime']) == mtime:
+                return cached['manifest'], cached['names']
+
+    manifest, names = build_manifest(data_dir)
+
+    # Written atomically, so a crash or a concurrent reader never sees a truncated manifest
+    buffer = io.BytesIO()
+    np.savez(buffer, manifest = manifest, names = names, mtime = np.int64(mtime))
+    os.makedirs(cache_dir, exist_ok = True)
+    atomic_save(buffer.getvalue(), file)
+
+    return manifest, names
+
+
 class BreastCancerDataset(Dataset):
-    def __init__(self, data_dir: str, transfs: transforms.transforms.Compose = transforms.Compose([ transforms.ToTensor(), transforms.Normalize((0.7595, 0.5646, 0.6882), (0.1497, 0.1970, 0.1428)) ]), 
-                angles: list = None):
+    def __init__(self, data_dir: str, transfs: transforms.transforms.Compose = transforms.Compose([ transforms.ToTensor(), transforms.Normalize(NORM_MEAN, NORM_STD) ]), 
+                angles: list = None, uint8: bool = False):
         """
         Dataset for breast histopathology images where the label is embedded in the file.
 
@@ -27,12 +191,14 @@ class BreastCancerDataset(Dataset):
             data_dir (str): Path to the images
             transfs (transforms.transforms.Compose, optional): Transform to apply to the images for data augmentation. Defaults to transforms.ToTensor().
             angles (list, optional): List of integers which each one indicates an angle to perform a discrete rotation. None means no rotations will be done. Defaults to None.
+            uint8 (bool, optional): Whether to return the raw uint8 image (C x H x W) instead of applying the transforms. Conversion to float and normalization are then done on the whole batch (see batch_transforms.BatchNormalize). Defaults to False.
 
         Raises:
             OSError: Path to images not found
             TypeError: The given path is not a string
             TypeError: The given transforms are not torchvision.transforms.transforms.Compose.
             TypeError: The given angles are not a list
+            TypeError: The given uint8 flag is not a bool
         """        
         if not path.isdir(data_dir):
             raise OSError ('Directory not found')
@@ -40,12 +206,21 @@ class BreastCancerDataset(Dataset):
         if not isinstance(data_dir, str): raise TypeError('"data_dir" must be a str.')
         if not isinstance(transfs, transforms.transforms.Compose): raise TypeError('"transfs" must be a torchvision.transforms.transforms.Compose.')
         if not ( angles is None or isinstance(angles, list) ): raise TypeError('"angles" must be a list of integer or None.')
+        if not isinstance(uint8, bool): raise TypeError('"uint8" must be a bool.')
 
-        # Image list
-        self.image_list = glob.glob(data_dir + '*')
+        self.data_dir = data_dir
+
+        # Image manifest: numpy arrays instead of a list of str, so forked loader workers
+        # do not copy it when touching the reference counts of its items
+        self.manifest, self.names = load_manifest(data_dir)
+
+        # Label, patient and coordinates of every image
+        self.labels = self.manifest['label']
+        self.patients = self.manifest['patient']
+        self.coords = np.stack([self.manifest['x'], self.manifest['y']], axis = 1)
 
         # Number of images
-        self.data_len = len(self.image_list)
+        self.data_len = len(self.manifest)
             
         # Function to transform images
         self.transfs = transfs
@@ -53,6 +228,9 @@ class BreastCancerDataset(Dataset):
         # List containing a discrete rotation set
         self.angles = angles
 
+        # Whether raw uint8 images are returned
+        self.uint8 = uint8
+
 
     def __getitem__(self,index: int) -> Tuple[Tensor, int]:
         """
@@ -65,14 +243,11 @@ class BreastCancerDataset(Dataset):
             Tensor: The image as a Tensor
             int: The label of the image
         """        
-        # Get image name from list
-        img_path = self.image_list[index]
-
         # Open image with PIL
-        img = Image.open(img_path)
+        img = Image.open(self.image_path(index))
 
-        # Apply transforms 
-        tensor = self.transfs(img)
+        # Apply transforms (raw images are normalized later, on the whole batch)
+        tensor = to_uint8_tensor(img) if self.uint8 else self.transfs(img)
 
         # Rotate the image.
         if self.angles is not None:
@@ -83,10 +258,21 @@ class BreastCancerDataset(Dataset):
             # Rotate
             tensor = TF.rotate(tensor,agl)
 
-        # Get image label from the file name
-        label = int(img_path [-5])
+        return (tensor, int(self.labels[index]))
 
-        return (tensor, label)
+    def image_path(self, index: int) -> str:
+        """
+        Returns the path of an image given a index
+
+        Args:
+            index (int): The index of the image
+
+        Returns:
+            str: The path of the image
+        """
+        offset, length = self.manifest['offset'][index], self.manifest['length'][index]
+
+        return path.join(self.data_dir, self.names[offset:offset + length].tobytes().decode())
 
     def __len__(self) -> int:
         """
@@ -95,4 +281,644 @@ class BreastCancerDataset(Dataset):
         Returns:
             int: The length of the dataset
         """        
-        return self.data_len    
\ No newline at end of file
+        return self.data_len    
+
+def pack_dataset(data_dir: str, dst: str) -> int:
+    """
+    Packs every patch of a directory into a memory-mappable store.
+
+    The store is a directory with one contiguous uint8 array of shape (N, 50, 50, 3)
+    plus the label, patient id, (x, y) coordinates and file name of every patch.
+
+    Args:
+        data_dir (str): Path to the images
+        dst (str): Path to the destination directory
+
+    Raises:
+        TypeError: The given path is not a string
+        TypeError: The given destination is not a string
+        OSError: Path to images not found
+
+    Returns:
+        int: The number of packed images.
+    """
+    if not isinstance(data_dir, str): raise TypeError('"data_dir" must be a str.')
+    if not isinstance(dst, str): raise TypeError('"dst" must be a str.')
+    if not path.isdir(data_dir): raise OSError ('Directory not found')
+
+    # Same order as BreastCancerDataset, so an index means the same image in both
+    manifest, names = load_manifest(data_dir)
+    image_list = [ names[offset:offset + length].tobytes().decode() for offset, length in zip(manifest['offset'], manifest['length']) ]
+    n_images = len(image_list)
+
+    os.makedirs(dst, exist_ok = True)
+
+    # Written straight to disk, the images never have to fit in memory
+    images = np.lib.format.open_memmap(path.join(dst, 'images.npy'), mode = 'w+', dtype = np.uint8, shape = (n_images, 50, 50, 3))
+
+    for idx, name in enumerate(tqdm(image_list, desc = 'Packing images...')):
+
+        with Image.open(path.join(data_dir, name)) as img:
+            images[idx] = np.asarray(img.convert('RGB'))
+
+    images.flush()
+    del images
+
+    np.save(path.join(dst, 'labels.npy'), manifest['label'])
+    np.save(path.join(dst, 'patients.npy'), manifest['patient'])
+    np.save(path.join(dst, 'coords.npy'), np.stack([manifest['x'], manifest['y']], axis = 1))
+    np.save(path.join(dst, 'names.npy'), np.array(image_list, dtype = np.bytes_))
+
+    return n_images
+
+
+def is_packed(data_dir: str) -> bool:
+    """
+    Checks whether a directory holds a packed patch store.
+
+    Args:
+        data_dir (str): Path to check
+
+    Returns:
+        bool: True if every file of a packed store is present.
+    """
+    return all(path.isfile(path.join(data_dir, file)) for file in PACKED_FILES)
+
+
+class PackedBreastCancerDataset(Dataset):
+    def __init__(self, data_dir: str, transfs: transforms.transforms.Compose = transforms.Compose([ transforms.ToTensor(), transforms.Normalize(NORM_MEAN, NORM_STD) ]),
+                angles: list = None, uint8: bool = False):
+        """
+        Dataset for breast histopathology images stored with pack_dataset.
+        Images are read through a memory map, so no file is opened or decoded per sample.
+
+        Args:
+            data_dir (str): Path to the packed store
+            transfs (transforms.transforms.Compose, optional): Transform to apply to the images for data augmentation. Defaults to transforms.ToTensor().
+            angles (list, optional): List of integers which each one indicates an angle to perform a discrete rotation. None means no rotations will be done. Defaults to None.
+            uint8 (bool, optional): Whether to return the raw uint8 image (C x H x W) instead of applying the transforms. Conversion to float and normalization are then done on the whole batch (see batch_transforms.BatchNormalize). Defaults to False.
+
+        Raises:
+            OSError: Packed store not found
+            TypeError: The given path is not a string
+            TypeError: The given transforms are not torchvision.transforms.transforms.Compose.
+            TypeError: The given angles are not a list
+            TypeError: The given uint8 flag is not a bool
+        """
+        if not isinstance(data_dir, str): raise TypeError('"data_dir" must be a str.')
+        if not is_packed(data_dir): raise OSError ('Packed store not found')
+        if not isinstance(transfs, transforms.transforms.Compose): raise TypeError('"transfs" must be a torchvision.transforms.transforms.Compose.')
+        if not ( angles is None or isinstance(angles, list) ): raise TypeError('"angles" must be a list of integer or None.')
+        if not isinstance(uint8, bool): raise TypeError('"uint8" must be a bool.')
+
+        self.data_dir = data_dir
+
+        # Metadata is small, so it is kept in memory
+        self.labels = np.load(path.join(data_dir, 'labels.npy'))
+        self.patients = np.load(path.join(data_dir, 'patients.npy'))
+        self.coords = np.load(path.join(data_dir, 'coords.npy'))
+        self.names = np.load(path.join(data_dir, 'names.npy'))
+
+        # The image memory map is opened lazily, so each loader worker maps the file itself
+        # instead of receiving a pickled copy of the pixels
+        self.images = None
+
+        # Number of images
+        self.data_len = len(self.labels)
+
+        # Function to transform images
+        self.transfs = transfs
+
+        # List containing a discrete rotation set
+        self.angles = angles
+
+        # Whether raw uint8 images are returned
+        self.uint8 = uint8
+
+    def __getstate__(self) -> dict:
+        """
+        Drops the memory map when the dataset is sent to a loader worker.
+
+        Returns:
+            dict: The state of the dataset.
+        """
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+    def __getitem__(self, index: int) -> Tuple[Tensor, int]:
+        """
+        Returns an image given a index
+
+        Args:
+            index (int): The index of the image
+
+        Returns:
+            Tensor: The image as a Tensor
+            int: The label of the image
+        """
+        if self.images is None:
+            # Copy-on-write mapping: the returned views are writable (as torch expects)
+            # without ever touching the file
+            self.images = np.load(path.join(self.data_dir, 'images.npy'), mmap_mode = 'c')
+
+        # HWC uint8 view into the page cache, ToTensor accepts it as it does a PIL image
+        tensor = to_uint8_tensor(self.images[index]) if self.uint8 else self.transfs(self.images[index])
+
+        # Rotate the image.
+        if self.angles is not None:
+
+            # Get a random angle (equal probabilities for all)
+            agl = choice(self.angles)
+
+            # Rotate
+            tensor = TF.rotate(tensor,agl)
+
+        return (tensor, int(self.labels[index]))
+
+    def image_path(self, index: int) -> str:
+        """
+        Returns the path an image had before it was packed, relative to the packed store
+
+        Args:
+            index (int): The index of the image
+
+        Returns:
+            str: The path of the image
+        """
+        return path.join(self.data_dir, self.names[index].decode())
+
+    def __len__(self) -> int:
+        """
+        Returns the number of images in the dataset
+
+        Returns:
+            int: The length of the dataset
+        """
+        return self.data_len
+
+
+def data_digest(dataset: Dataset) -> str:
+    """
+    Returns a digest of the images a dataset reads, which changes when images are added, removed or replaced
+
+    Args:
+        dataset (Dataset): The dataset.
+
+    Returns:
+        str: Digest of the manifest (directory of images), of the names and the time the images were
+        written (packed store), or of the number of files and their latest modification time (otherwise).
+    """
+    if isinstance(dataset, BreastCancerDataset):
+        data = dataset.manifest.tobytes() + dataset.names.tobytes()
+
+    elif isinstance(dataset, PackedBreastCancerDataset):
+        data = dataset.names.tobytes() + str(os.stat(path.join(dataset.data_dir, 'images.npy')).st_mtime_ns).encode()
+
+    else:
+        data_dir = getattr(dataset, 'data_dir', '')
+        files = [ entry.stat().st_mtime_ns for entry in os.scandir(data_dir) if entry.is_file() ] if path.isdir(data_dir) else []
+        data = ('%d|%d' % (len(files), max(files, default = 0))).encode()
+
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+class CachedDataset(Dataset):
+    def __init__(self, dataset: Dataset, max_memory: int = 2 * 1024**3, cache_dir: str = CACHE_DIR, num_workers: int = 0):
+        """
+        Keeps the transformed images of a deterministic dataset (e.g. the test set), so they are
+        only decoded and transformed once. Images are kept in RAM when they fit in "max_memory",
+        otherwise they are written to an on-disk shard that is reused by later runs.
+        The cache key is made from the dataset path, a digest of its images (see data_digest) and its
+        transform, so the 224 x 224 ViT test set and the 50 x 50 CNN test set are cached separately,
+        and a directory whose images changed is cached again.
+
+        Args:
+            dataset (Dataset): Dataset to cache. It must not apply random transforms.
+            max_memory (int, optional): Maximum number of bytes to keep in RAM. Defaults to 2 GiB.
+            cache_dir (str, optional): Directory of the on-disk shards. Defaults to CACHE_DIR.
+            num_workers (int, optional): Number of loader workers used to build the cache. Defaults to 0.
+
+        Raises:
+            TypeError: The given dataset is not a Dataset
+            TypeError: The given memory limit is not an integer
+            TypeError: The given cache directory is not a string
+            TypeError: The given number of workers is not an integer
+            ValueError: The given dataset is streamed (tar shards), so its images can not be indexed
+            ValueError: The given dataset does random rotations
+        """
+        if not isinstance(dataset, Dataset): raise TypeError('"dataset" must be a torch.utils.data.Dataset.')
+        if not isinstance(max_memory, int): raise TypeError('"max_memory" must be an integer.')
+        if not isinstance(cache_dir, str): raise TypeError('"cache_dir" must be a str.')
+        if not isinstance(num_workers, int): raise TypeError('"num_workers" must be an integer.')
+        if isinstance(dataset, IterableDataset): raise ValueError('Streamed tar shards can not be cached (--cache_test), use a directory of images or a packed store.')
+        if getattr(dataset, 'angles', None) is not None: raise ValueError('"dataset" must be deterministic (no rotations).')
+
+        self.dataset = dataset
+        self.data_len = len(dataset)
+
+        # Shape and type of a transformed image
+        sample, _ = dataset[0]
+        self.shape, self.dtype = tuple(sample.shape), sample.dtype
+
+        # Key of the cache
+        key = '%s|%d|%s|%r|%s' % (path.abspath(getattr(dataset, 'data_dir', '')), self.data_len, data_digest(dataset), getattr(dataset, 'transfs', None), getattr(dataset, 'uint8', False))
+        self.key = hashlib.sha1(key.encode()).hexdigest()[:16]
+
+        self.images_path = path.join(cache_dir, 'images_' + self.key + '.npy')
+        self.labels_path = path.join(cache_dir, 'labels_' + self.key + '.npy')
+
+        self.images, self.labels = None, None
+
+        if sample.element_size() * sample.numel() * self.data_len <= max_memory:
+            self.build(None, num_workers)
+
+        else:
+            # The labels are written last, so their presence means the shard is complete
+            if not path.isfile(self.labels_path):
+                os.makedirs(cache_dir, exist_ok = True)
+                self.build(self.images_path, num_workers)
+
+            self.labels = torch.from_numpy(np.load(self.labels_path))
+
+    def build(self, file: str, num_workers: int) -> None:
+        """
+        Transforms every image of the dataset and stores it
+
+        Args:
+            file (str): Path of the on-disk shard, None to keep the images in RAM.
+            num_workers (int): Number of loader workers.
+
+        Returns:
+            None
+        """
+        if file is None:
+            images = torch.empty((self.data_len,) + self.shape, dtype = self.dtype)
+        else:
+            images = np.lib.format.open_memmap(file, mode = 'w+', dtype = torch.empty((), dtype = self.dtype).numpy().dtype, shape = (self.data_len,) + self.shape)
+
+        labels = torch.empty(self.data_len, dtype = torch.int64)
+
+        loader = DataLoader(self.dataset, batch_size = 256, shuffle = False, num_workers = num_workers)
+
+        start = 0
+        for inputs, targets in tqdm(loader, desc = 'Caching dataset...'):
+
+            end = start + inputs.shape[0]
+
+            images[start:end] = inputs if file is None else inputs.numpy()
+            labels[start:end] = targets
+
+            start = end
+
+        if file is None:
+            self.images, self.labels = images, labels
+
+        else:
+            images.flush()
+            del images
+            buffer = io.BytesIO()
+            np.save(buffer, labels.numpy())
+            atomic_save(buffer.getvalue(), self.labels_path)
+
+    def __getstate__(self) -> dict:
+        """
+        Drops the memory map of the on-disk shard when the dataset is sent to a loader worker.
+
+        Returns:
+            dict: The state of the dataset.
+        """
+        state = self.__dict__.copy()
+        if not isinstance(self.images, Tensor):
+            state['images'] = None
+        return state
+
+    def __getitem__(self, index: int) -> Tuple[Tensor, int]:
+        """
+        Returns an image given a index
+
+        Args:
+            index (int): The index of the image
+
+        Returns:
+            Tensor: The transformed image
+            int: The label of the image
+        """
+        if self.images is None:
+            self.images = np.load(self.images_path, mmap_mode = 'c')
+
+        if isinstance(self.images, Tensor):
+            return (self.images[index], int(self.labels[index]))
+
+        return (torch.from_numpy(self.images[index]), int(self.labels[index]))
+
+    def __len__(self) -> int:
+        """
+        Returns the number of images in the dataset
+
+        Returns:
+            int: The length of the dataset
+        """
+        return self.data_len
+
+
+def write_shards(data_dir: str, dst: str, shard_size: int = 10000, seed: int = 0) -> int:
+    """
+    Converts a directory of patches into tar shards that can be read sequentially.
+    Images are written in a random order, so every shard mixes classes and patients.
+
+    Args:
+        data_dir (str): Path to the images
+        dst (str): Path to the destination directory
+        shard_size (int, optional): Number of images per shard. Defaults to 10000.
+        seed (int, optional): Seed of the order of the images. Defaults to 0.
+
+    Raises:
+        TypeError: The given path is not a string
+        TypeError: The given destination is not a string
+        TypeError: The given shard size is not an integer
+        OSError: Path to images not found
+
+    Returns:
+        int: The number of shards written.
+    """
+    if not isinstance(data_dir, str): raise TypeError('"data_dir" must be a str.')
+    if not isinstance(dst, str): raise TypeError('"dst" must be a str.')
+    if not isinstance(shard_size, int): raise TypeError('"shard_size" must be an integer.')
+    if not path.isdir(data_dir): raise OSError ('Directory not found')
+
+    manifest, names = load_manifest(data_dir)
+    image_list = [ names[offset:offset + length].tobytes().decode() for offset, length in zip(manifest['offset'], manifest['length']) ]
+    Random(seed).shuffle(image_list)
+
+    os.makedirs(dst, exist_ok = True)
+
+    shards = []
+    for start in tqdm(range(0, len(image_list), shard_size), desc = 'Writing shards...'):
+
+        shard_name = 'shard-%06d.tar' % len(shards)
+
+        # Uncompressed tar: PNG files are already compressed
+        with tarfile.open(path.join(dst, shard_name), 'w') as shard:
+            for name in image_list[start:start + shard_size]:
+                shard.add(path.join(data_dir, name), arcname = name)
+
+        shards.append({'name': shard_name, 'count': len(image_list[start:start + shard_size])})
+
+    with open(path.join(dst, SHARD_INDEX), 'w') as file:
+        json.dump({'shards': shards}, file, indent = 4)
+
+    return len(shards)
+
+
+def is_sharded(data_dir: str) -> bool:
+    """
+    Checks whether a directory holds tar shards written by write_shards.
+
+    Args:
+        data_dir (str): Path to check
+
+    Returns:
+        bool: True if the shard index is present.
+    """
+    return path.isfile(path.join(data_dir, SHARD_INDEX))
+
+
+class ShardedBreastCancerDataset(IterableDataset):
+    def __init__(self, data_dir: str, transfs: transforms.transforms.Compose = transforms.Compose([ transforms.ToTensor(), transforms.Normalize(NORM_MEAN, NORM_STD) ]),
+                angles: list = None, uint8: bool = False, buffer_size: int = 4096, shuffle: bool = True, seed: int = 0,
+                split_ranks: bool = True, batch_size: int = 1):
+        """
+        Streaming dataset for breast histopathology images stored as tar shards (see write_shards).
+        Shards are read sequentially, which suits network-backed disks where random small reads are slow.
+        Images are split across distributed ranks (the same number for every rank) and loader workers,
+        and shuffled with a bounded in-memory buffer of encoded images.
+
+        Args:
+            data_dir (str): Path to the shards
+            transfs (transforms.transforms.Compose, optional): Transform to apply to the images for data augmentation. Defaults to transforms.ToTensor().
+            angles (list, optional): List of integers which each one indicates an angle to perform a discrete rotation. None means no rotations will be done. Defaults to None.
+            uint8 (bool, optional): Whether to return the raw uint8 image (C x H x W) instead of applying the transforms. Conversion to float and normalization are then done on the whole batch (see batch_transforms.BatchNormalize). Defaults to False.
+            buffer_size (int, optional): Number of images kept in the shuffle buffer. Defaults to 4096.
+            shuffle (bool, optional): Whether to shuffle the shards and the images. Defaults to True.
+            seed (int, optional): Seed of the shuffling, combined with the epoch. Defaults to 0.
+            split_ranks (bool, optional): Whether every distributed rank only reads its share of the images. Defaults to True.
+            batch_size (int, optional): Batch size of the loader, so the images of a rank are split between loader workers in whole batches. Defaults to 1.
+
+        Raises:
+            OSError: Shard index not found
+            TypeError: The given path is not a string
+            TypeError: The given transforms are not torchvision.transforms.transforms.Compose.
+            TypeError: The given angles are not a list
+            TypeError: The given uint8 flag is not a bool
+            TypeError: The given buffer size is not an integer
+            ValueError: The given batch size is not a positive integer
+        """
+        if not isinstance(data_dir, str): raise TypeError('"data_dir" must be a str.')
+        if not is_sharded(data_dir): raise OSError ('Shard index not found')
+        if not isinstance(transfs, transforms.transforms.Compose): raise TypeError('"transfs" must be a torchvision.transforms.transforms.Compose.')
+        if not ( angles is None or isinstance(angles, list) ): raise TypeError('"angles" must be a list of integer or None.')
+        if not isinstance(uint8, bool): raise TypeError('"uint8" must be a bool.')
+        if not isinstance(buffer_size, int): raise TypeError('"buffer_size" must be an integer.')
+        if not (isinstance(batch_size, int) and batch_size > 0): raise ValueError('"batch_size" must be a positive integer.')
+
+        self.data_dir = data_dir
+
+        with open(path.join(data_dir, SHARD_INDEX)) as file:
+            self.shards = json.load(file)['shards']
+
+        # Number of images
+        self.data_len = sum(shard['count'] for shard in self.shards)
+
+        # Function to transform images
+        self.transfs = transfs
+
+        # List containing a discrete rotation set
+        self.angles = angles
+
+        # Whether raw uint8 images are returned
+        self.uint8 = uint8
+
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.split_ranks = split_ranks
+        self.batch_size = batch_size
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Sets the epoch, so every epoch gets a different order.
+        Loader workers copy the dataset when an iteration starts, so they must not be persistent.
+
+        Args:
+            epoch (int): Current epoch number.
+
+        Returns:
+            None
+        """
+        self.epoch = epoch
+
+    def rank_and_world(self) -> Tuple[int, int]:
+        """
+        Returns the distributed rank of this process and the number of processes
+
+        Returns:
+            int: The rank.
+            int: The world size.
+        """
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+
+        return 0, 1
+
+    def assigned_parts(self, shards: list, rank: int, world_size: int, worker_id: int, num_workers: int) -> list:
+        """
+        Returns the images read by a rank and a loader worker, as ranges of images of the shards.
+        The shards are laid end to end and every rank reads a contiguous range of exactly
+        data_len // world_size images (the last data_len % world_size images of the epoch are dropped,
+        a different set every epoch), so every rank runs the same number of steps. The range of a rank
+        is split between its workers in whole batches, so only the last worker yields a partial batch.
+
+        Args:
+            shards (list): Shards, in the order of the epoch
+            rank (int): Rank of this process
+            world_size (int): Number of processes
+            worker_id (int): Index of the loader worker
+            num_workers (int): Number of loader workers
+
+        Returns:
+            list: (shard, first image, end image) of every shard read, indices relative to the shard
+        """
+        n_images = len(self)
+        n_batches = -(-n_images // self.batch_size)
+
+        # Range of the rank, then whole batches of it for the worker
+        begin = rank * n_images if self.split_ranks else 0
+        end = begin + min(n_images, (worker_id + 1) * n_batches // num_workers * self.batch_size)
+        begin += worker_id * n_batches // num_workers * self.batch_size
+
+        parts, offset = [], 0
+        for shard in shards:
+
+            first, last = max(begin, offset), min(end, offset + shard['count'])
+            if first < last:
+                parts.append((shard, first - offset, last - offset))
+
+            offset += shard['count']
+
+        return parts
+
+    def records(self, parts: list) -> Iterator[Tuple[bytes, int]]:
+        """
+        Reads the encoded images of the given ranges of shards sequentially
+
+        Args:
+            parts (list): (shard, first image, end image) of every shard to read
+
+        Returns:
+            Iterator: The PNG bytes of the images and their labels
+        """
+        for shard, first, last in parts:
+
+            # Stream mode: the shard is read front to back, without seeking
+            with tarfile.open(path.join(self.data_dir, shard['name']), 'r|') as tar:
+
+                idx = 0
+                for member in tar:
+
+                    if not member.isfile():
+                        continue
+
+                    if idx >= last:
+                        break
+
+                    if idx >= first:
+                        yield (tar.extractfile(member).read(), parse_patch_name(member.name)[3])
+
+                    idx += 1
+
+    def decode(self, record: Tuple[bytes, int]) -> Tuple[Tensor, int]:
+        """
+        Decodes and transforms an image read from a shard
+
+        Args:
+            record (tuple): The PNG bytes of the image and its label
+
+        Returns:
+            Tensor: The image as a Tensor
+            int: The label of the image
+        """
+        data, label = record
+        img = Image.open(io.BytesIO(data))
+
+        # Apply transforms (raw images are normalized later, on the whole batch)
+        tensor = to_uint8_tensor(img) if self.uint8 else self.transfs(img)
+
+        # Rotate the image.
+        if self.angles is not None:
+
+            # Get a random angle (equal probabilities for all)
+            agl = choice(self.angles)
+
+            # Rotate
+            tensor = TF.rotate(tensor,agl)
+
+        return (tensor, label)
+
+    def __iter__(self) -> Iterator[Tuple[Tensor, int]]:
+        """
+        Iterates over the images assigned to this rank and worker
+
+        Returns:
+            Iterator: The transformed images and their labels
+        """
+        rng = Random(self.seed + self.epoch)
+
+        shards = list(self.shards)
+        if self.shuffle:
+            rng.shuffle(shards)
+
+        # Split the images between ranks and then between the loader workers of every rank
+        rank, world_size = self.rank_and_world()
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+
+        records = self.records(self.assigned_parts(shards, rank, world_size, worker_id, num_workers))
+
+        if not self.shuffle:
+            yield from map(self.decode, records)
+            return
+
+        # Every worker gets its own stream of random numbers
+        rng = Random(self.seed + self.epoch + 1000003 * (rank * num_workers + worker_id + 1))
+
+        # Bounded shuffle buffer of encoded images (decoded once yielded): a random image
+        # of the buffer is replaced by the next one read
+        buffer = []
+        for record in records:
+
+            if len(buffer) < self.buffer_size:
+                buffer.append(record)
+                continue
+
+            idx = rng.randrange(self.buffer_size)
+            yield self.decode(buffer[idx])
+            buffer[idx] = record
+
+        rng.shuffle(buffer)
+        yield from map(self.decode, buffer)
+
+    def __len__(self) -> int:
+        """
+        Returns the number of images read by this rank
+
+        Returns:
+            int: The length of the dataset
+        """
+        if not self.split_ranks:
+            return self.data_len
+
+        _, world_size = self.rank_and_world()
+
+        return self.data_len // world_size
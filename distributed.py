@@ -0,0 +1,168 @@
+# PyTorch
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+# Others
+import os
+import sys
+from contextlib import contextmanager
+from typing import Any, Iterator, Tuple
+
+def init_distributed(backend: str = 'gloo') -> Tuple[int, int]:
+    """
+    Joins the process group described by the environment (RANK, WORLD_SIZE, LOCAL_RANK,
+    MASTER_ADDR and MASTER_PORT), as set by launch.py or torchrun. Only the first process
+    keeps printing to the standard output.
+
+    Args:
+        backend (str, optional): Backend of the process group. Defaults to 'gloo'.
+
+    Raises:
+        TypeError: The given backend is not a str
+
+    Returns:
+        int: The rank of this process (0 if not distributed).
+        int: The number of processes (1 if not distributed).
+    """
+    if not isinstance(backend, str): raise TypeError('"backend" must be a str')
+
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        return 0, 1
+
+    rank = int(os.environ['RANK'])
+
+    # One GPU per process of the host
+    if torch.cuda.is_available():
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)) % torch.cuda.device_count())
+
+    dist.init_process_group(backend, rank = rank, world_size = world_size)
+
+    if rank != 0:
+        sys.stdout = open(os.devnull, 'w')
+
+    return rank, world_size
+
+def cleanup_distributed() -> None:
+    """
+    Leaves the process group, if any
+
+    Returns:
+        None
+    """
+    if is_distributed():
+        dist.destroy_process_group()
+
+def is_distributed() -> bool:
+    """
+    Returns whether this process belongs to a process group
+
+    Returns:
+        bool: True if distributed.
+    """
+    return dist.is_available() and dist.is_initialized()
+
+def is_main_process() -> bool:
+    """
+    Returns whether this process is the first one (or the only one), the one that writes checkpoints
+
+    Returns:
+        bool: True for rank 0.
+    """
+    return not is_distributed() or dist.get_rank() == 0
+
+def barrier() -> None:
+    """
+    Waits until every process gets here, if distributed
+
+    Returns:
+        None
+    """
+    if is_distributed():
+        dist.barrier()
+
+@contextmanager
+def main_process_first():
+    """
+    Context run by the first process before the others, so files cached by its body (manifests,
+    statistics, cached test sets) are built once and then read by the other processes instead
+    of being written by all of them at the same time
+    """
+    if not is_main_process():
+        barrier()
+
+    yield
+
+    if is_main_process():
+        barrier()
+
+def broadcast_object(obj: Any) -> Any:
+    """
+    Sends an object of the first process to every process
+
+    Args:
+        obj (Any): The object (picklable), only used on the first process.
+
+    Returns:
+        Any: The object of the first process.
+    """
+    if not is_distributed():
+        return obj
+
+    objects = [obj]
+    dist.broadcast_object_list(objects, src = 0)
+
+    return objects[0]
+
+def all_reduce_sum(*values: float) -> list:
+    """
+    Sums numbers across every process, in a single all-reduce
+
+    Args:
+        values (float): Numbers (or 0-d tensors) of this process.
+
+    Returns:
+        list: The sums, in the same order.
+    """
+    if not is_distributed():
+        return [ float(value) for value in values ]
+
+    sums = torch.tensor([ float(value) for value in values ], dtype = torch.float64)
+    dist.all_reduce(sums, op = dist.ReduceOp.SUM)
+
+    return sums.tolist()
+
+
+class ShardedEvalSampler(Sampler):
+    def __init__(self, dataset, rank: int = None, world_size: int = None) -> None:
+        """
+        Splits a dataset between processes for evaluation. Unlike DistributedSampler, no index
+        is repeated to even out the shards, so every image is counted exactly once in the metrics.
+
+        Args:
+            dataset: The dataset.
+            rank (int, optional): Rank of this process. Defaults to the rank of the process group.
+            world_size (int, optional): Number of processes. Defaults to the size of the process group.
+        """
+        self.data_len = len(dataset)
+        self.rank = rank if rank is not None else (dist.get_rank() if is_distributed() else 0)
+        self.world_size = world_size if world_size is not None else (dist.get_world_size() if is_distributed() else 1)
+
+    def __iter__(self) -> Iterator[int]:
+        """
+        Returns the indices of this process
+
+        Returns:
+            Iterator: Every world_size-th index, starting at the rank.
+        """
+        return iter(range(self.rank, self.data_len, self.world_size))
+
+    def __len__(self) -> int:
+        """
+        Returns the number of indices of this process
+
+        Returns:
+            int: The length of the shard.
+        """
+        return len(range(self.rank, self.data_len, self.world_size))
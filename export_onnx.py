@@ -0,0 +1,60 @@
+# Exports a trained checkpoint (e.g. "./pretrained/EfficientNetB6.pth") to an ONNX graph run by ONNX Runtime
+
+# PyTorch
+import torch
+
+# ONNX export and runtime
+from onnx_backend import OnnxModel, check_parity, export_onnx
+
+# Utils
+from benchmark import input_size
+from utils import build_model
+
+# Others
+import argparse as arg
+
+parser = arg.ArgumentParser(description= 'Export a trained checkpoint to ONNX and check it against PyTorch.')
+
+# Model
+parser.add_argument('-n', '--net', dest = 'net', default = None, type=str, help= 'Model of the checkpoint.')
+
+# Checkpoint
+parser.add_argument('-na', '--name', dest = 'file_name', default = 'output', type=str, help= 'Name of the checkpoint in ./pretrained (without .pth).')
+
+# Destination of the graph
+parser.add_argument('-d', '--destination', dest = 'dest', default = None, type=str, help= 'Destination of the graph. Defaults to ./pretrained/<name>.onnx.')
+
+# Batch of the parity test
+parser.add_argument('-b', '--batch_size', dest = 'batch_size', default = 32, type=int, help= 'Images of the fixed batch used for the parity test and the latency comparison.')
+
+# Accepted difference of the logits
+parser.add_argument('-t', '--tolerance', dest = 'tolerance', default = 1e-4, type=float, help= 'Largest absolute difference of the logits accepted by the parity test.')
+
+def main():
+
+    # Parse arguments
+    args = parser.parse_args()
+    model_name = args.net.lower()
+    dest = args.dest or './pretrained/' + args.file_name + '.onnx'
+
+    model = build_model(model_name)
+    model.load_state_dict(torch.load('./pretrained/' + args.file_name + '.pth', map_location=torch.device('cpu'))['model'])
+
+    export_onnx(model, dest, input_size(model_name))
+    print("Exported %s to %s" % (args.file_name, dest))
+
+    # Fixed batch, so the test is repeatable
+    generator = torch.Generator().manual_seed(0)
+    inputs = torch.randn(args.batch_size, 3, input_size(model_name), input_size(model_name), generator = generator)
+
+    report = check_parity(model, OnnxModel(dest), inputs, atol = args.tolerance)
+
+    print("Parity: %s (max abs difference of the logits %.2e, same predictions: %s)" % ('OK' if report['parity'] else 'FAILED', report['max_abs_diff'], report['same_predictions']))
+    print("Batch latency: PyTorch %.2f ms, ONNX Runtime %.2f ms (x%.2f)"
+          % (1000 * report['torch_latency'], 1000 * report['onnx_latency'], report['torch_latency'] / report['onnx_latency']))
+
+    if not report['parity']:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
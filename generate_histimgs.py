@@ -5,6 +5,20 @@ import torchvision.models as torch_models
 # HistopathologyImageMaker
 from HistImageMaker import HistopathologyImageMaker as histmaker
 
+# Int8 quantization
+from dataset import BreastCancerDataset
+from quantization import QUANTIZATION_MODES, calibration_subset, quantize_model
+
+# ONNX Runtime backend
+from onnx_backend import OnnxModel
+
+# Statistics the model was trained with
+from stats import checkpoint_stats
+
+# Transforms of the test images
+from utils import build_transforms
+from torch.utils.data import DataLoader
+
 # Others
 import os
 import argparse as arg
@@ -14,6 +28,18 @@ parser = arg.ArgumentParser(description= 'Build original, true and predicted his
 # Path to images
 parser.add_argument('-p', '--path', dest = 'path', default = None, type=str, help= 'Path to images.')
 
+# Quantized model
+parser.add_argument('-q', '--quantize', dest = 'quantize', default = None, choices = QUANTIZATION_MODES, help= 'Predict with the model quantized to int8 on the CPU (dynamic, static or auto).')
+
+# Calibration images of static quantization
+parser.add_argument('-c', '--calibration', dest = 'calibration', default = None, type=str, help= 'Path to training images used to calibrate static quantization.')
+
+# ONNX graph
+parser.add_argument('-ox', '--onnx', dest = 'onnx', default = None, type=str, help= 'Predict with this ONNX graph (see export_onnx.py) on ONNX Runtime instead of the checkpoint.')
+
+# Test-time augmentation
+parser.add_argument('-tta', '--tta', dest = 'tta', default = 1, type=int, help= 'Number of views (flips and rotations) of every patch whose logits are averaged. 1 disables it.')
+
 # Path to images
 parser.add_argument('-d', '--destination', dest = 'dest', default = None, type=str, help= 'Destination directory.')
 
@@ -26,16 +52,33 @@ def main():
     # If directory doesn't exist, make one
     if not os.path.isdir(args.dest): os.mkdir(args.dest)
 
-    # Best accuracy was obtanied by EfficientNetB6
-    model = torch_models.efficientnet_b6()
+    # Best accuracy was obtanied by EfficientNetB6 (its checkpoint is also read with ONNX graphs, for the statistics it was trained with)
+    state = None
+    if args.onnx is None or os.path.isfile('./pretrained/EfficientNetB6.pth'):
+        state = torch.load('./pretrained/EfficientNetB6.pth', map_location = None if torch.cuda.is_available() else torch.device('cpu'))
+
+    if args.onnx is not None:
+        model = OnnxModel(args.onnx)
 
-    if torch.cuda.is_available():
-        model.load_state_dict(torch.load('./pretrained/EfficientNetB6.pth') ['model'])
     else:
-        model.load_state_dict(torch.load('./pretrained/EfficientNetB6.pth', map_location=torch.device('cpu')) ['model'])
+        model = torch_models.efficientnet_b6()
+        model.load_state_dict(state['model'])
+
+    # Calibration and prediction normalize with the statistics the model was trained with
+    mean, std = checkpoint_stats(state)
+
+    if args.quantize is not None and args.onnx is None:
+
+        # A fixed slice of the training images calibrates static quantization
+        calibration_loader = None
+        if args.calibration is not None:
+            _, test_transform = build_transforms('efficientnetb6', mean = mean, std = std)
+            calibration_loader = DataLoader(calibration_subset(BreastCancerDataset(args.calibration + '/', transfs = test_transform), 512), batch_size = 64, shuffle = False)
+
+        model = quantize_model(model, 'efficientnetb6', args.quantize, calibration_loader = calibration_loader)
 
     # Make HistopathologyImageMaker
-    histimgmaker = histmaker(model)
+    histimgmaker = histmaker(model, mean = mean, std = std, tta = args.tta)
 
     for dir in os.listdir(args.path):
 
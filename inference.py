@@ -0,0 +1,217 @@
+# PyTorch
+import torch
+from torch.utils.data import DataLoader, Dataset, IterableDataset, Subset
+
+# Dataset
+from dataset import CachedDataset
+
+# Forward pass in mixed precision
+from train import autocast
+
+# Utils
+from checkpoint import atomic_save
+from utils import progress_bar
+import numpy as np
+
+# Others
+import io
+import json
+import os
+from typing import Callable
+
+# File of an output directory with the number of completed chunks
+PROGRESS_FILE = 'progress.json'
+
+# Columns of every chunk
+COLUMNS = ('path', 'patient', 'x', 'y', 'probability', 'label')
+
+def chunk_path(output_dir: str, chunk: int) -> str:
+    """
+    Returns the path of a chunk of predictions
+
+    Args:
+        output_dir (str): Directory of the predictions.
+        chunk (int): Index of the chunk.
+
+    Returns:
+        str: The path.
+    """
+    return os.path.join(output_dir, 'chunk_%06d.npz' % chunk)
+
+def read_progress(output_dir: str) -> dict:
+    """
+    Reads the progress of a bulk inference run
+
+    Args:
+        output_dir (str): Directory of the predictions.
+
+    Returns:
+        dict: Number of images, chunk size and completed chunks (None if the run has not started).
+    """
+    file = os.path.join(output_dir, PROGRESS_FILE)
+    if not os.path.isfile(file):
+        return None
+
+    with open(file) as progress:
+        return json.load(progress)
+
+def write_chunk(output_dir: str, chunk: int, source: Dataset, begin: int, probabilities: np.ndarray) -> None:
+    """
+    Writes the predictions of a chunk of consecutive images with their metadata, one array per column
+
+    Args:
+        output_dir (str): Directory of the predictions.
+        chunk (int): Index of the chunk.
+        source (Dataset): Dataset with the labels, patients, coords and image paths.
+        begin (int): Index of the first image of the chunk.
+        probabilities (np.ndarray): Predicted probability of every image of the chunk.
+
+    Returns:
+        None
+    """
+    end = begin + len(probabilities)
+
+    columns = {
+        'path': np.array([ source.image_path(index) for index in range(begin, end) ]),
+        'patient': np.asarray(source.patients[begin:end]),
+        'x': np.asarray(source.coords[begin:end, 0]),
+        'y': np.asarray(source.coords[begin:end, 1]),
+        'probability': probabilities,
+        'label': np.asarray(source.labels[begin:end])
+    }
+
+    buffer = io.BytesIO()
+    np.savez(buffer, **columns)
+    atomic_save(buffer.getvalue(), chunk_path(output_dir, chunk))
+
+def bulk_predict(device: str, model: torch.nn.Module, dataset: Dataset, output_dir: str, batch_size: int = 256, chunk_size: int = 8192,
+                 batch_transform: Callable = None, amp_dtype: torch.dtype = None, loader_kwargs: dict = None, tta: Callable = None) -> int:
+    """
+    Predicts every image of a dataset and streams the results to disk in chunks of consecutive images
+    ("chunk_<N>.npz", with the columns path, patient, x, y, probability and label). The number of
+    completed chunks is recorded after every chunk, so an interrupted run resumes after the last
+    completed chunk without running its images through the model again.
+
+    Args:
+        device (str): Device to use (CPU or GPU).
+        model (torch.nn.Module): The model to use for predicting.
+        dataset (Dataset): Dataset with image paths and metadata (BreastCancerDataset or PackedBreastCancerDataset, possibly cached).
+        output_dir (str): Directory of the predictions.
+        batch_size (int, optional): Batch size. Defaults to 256.
+        chunk_size (int, optional): Number of images per chunk, rounded down to a multiple of the batch size. Defaults to 8192.
+        batch_transform (Callable, optional): Transform applied to every batch once it is on the device. Defaults to None.
+        amp_dtype (torch.dtype, optional): Type used by autocast in the forward pass. None means float32. Defaults to None.
+        loader_kwargs (dict, optional): Extra arguments of the DataLoader. Defaults to None.
+        tta (Callable, optional): Test-time augmentation (see batch_transforms.TestTimeAugment). Every batch is expanded into its views and their logits are averaged. Defaults to None.
+
+    Raises:
+        TypeError: The given device is not a str
+        TypeError: The given model is not a torch.nn.Module
+        TypeError: The given output directory is not a str
+        TypeError: The dataset has no image paths or metadata
+        ValueError: The dataset is streamed, so it can not be resumed at a given image
+        ValueError: The output directory holds predictions of another dataset, chunk size or number of views
+
+    Returns:
+        int: The number of chunks.
+    """
+    if not isinstance(device, str): raise TypeError('"device" must be a str (CPU or GPU).')
+    if not isinstance(model, torch.nn.Module): raise TypeError('"model" must be a torch.nn.Module.')
+    if not isinstance(output_dir, str): raise TypeError('"output_dir" must be a str.')
+    if isinstance(dataset, IterableDataset): raise ValueError('Streamed datasets can not be resumed, use a directory of images or a packed store.')
+
+    # Metadata of the images (a cached dataset keeps the order of the dataset it caches)
+    source = dataset.dataset if isinstance(dataset, CachedDataset) else dataset
+    if not all(hasattr(source, attr) for attr in ('labels', 'patients', 'coords', 'image_path')): raise TypeError('"dataset" must have image paths and metadata.')
+
+    chunk_size = max(1, chunk_size // batch_size) * batch_size
+    n_images = len(dataset)
+    n_chunks = -(-n_images // chunk_size)
+
+    os.makedirs(output_dir, exist_ok = True)
+
+    # Chunks of a resumed run must be predicted with the same views
+    views = 1 if tta is None else tta.views
+
+    progress = read_progress(output_dir)
+    if progress is None:
+        progress = {'n_images': n_images, 'chunk_size': chunk_size, 'views': views, 'chunks': 0}
+    elif progress['n_images'] != n_images or progress['chunk_size'] != chunk_size or progress.get('views', 1) != views:
+        raise ValueError('"%s" holds the predictions of another dataset, chunk size or number of views.' % output_dir)
+
+    chunk = progress['chunks']
+    if chunk >= n_chunks:
+        return n_chunks
+
+    if chunk > 0:
+        print("Resuming after %d of %d chunks" % (chunk, n_chunks))
+
+    # Only the images of the chunks left
+    loader = DataLoader(Subset(dataset, range(chunk * chunk_size, n_images)), batch_size = batch_size, shuffle = False, **(loader_kwargs or {}))
+
+    model.eval()
+
+    # Probabilities of the current chunk, copied back once per chunk
+    probabilities = torch.empty(chunk_size, dtype = torch.float32, device = device)
+    filled = 0
+
+    with torch.no_grad():
+
+        for batch_idx, (inputs, _) in enumerate(loader):
+
+            inputs = inputs.to(device, non_blocking = True)
+
+            # Batched transforms (e.g. normalization)
+            if batch_transform is not None:
+                inputs = batch_transform(inputs)
+
+            batch_size = inputs.size(0)
+
+            # Views of every image, stacked into a single batch
+            if tta is not None:
+                inputs = tta(inputs)
+
+            # Forward pass (logits of the views averaged)
+            with autocast(device, amp_dtype):
+                outputs = model(inputs)[:,:1].squeeze(1)
+            outputs = outputs if tta is None else tta.reduce(outputs)
+
+            torch.sigmoid(outputs.float(), out = probabilities[filled:filled + batch_size])
+            filled += batch_size
+
+            # Chunk complete (or last images of the dataset)
+            begin = chunk * chunk_size
+            if filled == chunk_size or begin + filled == n_images:
+
+                write_chunk(output_dir, chunk, source, begin, probabilities[:filled].cpu().numpy())
+
+                chunk, filled = chunk + 1, 0
+                progress['chunks'] = chunk
+                atomic_save(json.dumps(progress, indent = 4).encode(), os.path.join(output_dir, PROGRESS_FILE))
+
+            progress_bar(batch_idx, len(loader), 'Chunk %d/%d' % (min(chunk + 1, n_chunks), n_chunks))
+
+    return n_chunks
+
+def load_predictions(output_dir: str) -> dict:
+    """
+    Loads the completed chunks of a bulk inference run
+
+    Args:
+        output_dir (str): Directory of the predictions.
+
+    Raises:
+        OSError: No predictions found
+
+    Returns:
+        dict: Every column (see COLUMNS), concatenated in the order of the dataset.
+    """
+    progress = read_progress(output_dir)
+    if progress is None: raise OSError('Predictions not found')
+
+    chunks = []
+    for chunk in range(progress['chunks']):
+        with np.load(chunk_path(output_dir, chunk)) as columns:
+            chunks.append({ column: columns[column] for column in COLUMNS })
+
+    return { column: np.concatenate([ columns[column] for columns in chunks ]) for column in COLUMNS }
@@ -0,0 +1,62 @@
+# Launches the training of main.py in several processes (on one or several hosts) with distributed data parallelism
+
+# PyTorch
+import torch
+import torch.multiprocessing as mp
+
+# Training script
+import main
+
+# Others
+import argparse as arg
+import os
+
+parser = arg.ArgumentParser(description= 'Run main.py in several processes of this host, joined over TCP (gloo backend) with the processes of the other hosts.',
+                            usage= 'python launch.py [-np N] [-nn NODES] [-nr NODE_RANK] [-ma ADDR] [-mp PORT] -- <main.py arguments>')
+
+# Processes of this host
+parser.add_argument('-np', '--nproc_per_node', dest = 'nproc_per_node', default = 2, type=int, help= 'Number of processes of this host.')
+
+# Hosts
+parser.add_argument('-nn', '--nnodes', dest = 'nnodes', default = 1, type=int, help= 'Number of hosts.')
+
+# Index of this host
+parser.add_argument('-nr', '--node_rank', dest = 'node_rank', default = 0, type=int, help= 'Index of this host (0 to nnodes - 1). Host 0 runs the rendezvous.')
+
+# Rendezvous
+parser.add_argument('-ma', '--master_addr', dest = 'master_addr', default = '127.0.0.1', type=str, help= 'Address of host 0, reachable from every host.')
+parser.add_argument('-mp', '--master_port', dest = 'master_port', default = 29500, type=int, help= 'Free TCP port of host 0.')
+
+# Arguments of main.py
+parser.add_argument('main_args', nargs = arg.REMAINDER, help= 'Arguments passed to main.py.')
+
+def run(local_rank: int, args) -> None:
+    """
+    Runs main.py in a process of this host
+    Args:
+        local_rank: Index of the process in this host
+        args: Arguments passed from the argument parser
+    """
+    os.environ['MASTER_ADDR'] = args.master_addr
+    os.environ['MASTER_PORT'] = str(args.master_port)
+    os.environ['WORLD_SIZE'] = str(args.nnodes * args.nproc_per_node)
+    os.environ['RANK'] = str(args.node_rank * args.nproc_per_node + local_rank)
+    os.environ['LOCAL_RANK'] = str(local_rank)
+
+    # Cores of the host are shared by its processes
+    torch.set_num_threads(max(1, os.cpu_count() // args.nproc_per_node))
+
+    main.main(args.main_args)
+
+def launch():
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    if args.main_args and args.main_args[0] == '--':
+        args.main_args = args.main_args[1:]
+
+    mp.spawn(run, args = (args,), nprocs = args.nproc_per_node, join = True)
+
+if __name__ == "__main__":
+    launch()
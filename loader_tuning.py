@@ -0,0 +1,209 @@
+# PyTorch
+import torch
+from torch.utils.data import DataLoader, Dataset, IterableDataset
+
+# Cache
+from checkpoint import atomic_save
+from dataset import CACHE_DIR
+
+# Running statistics left as they were by the timed training steps
+from checkpointing import frozen_batchnorm_stats
+
+# Others
+import json
+import os
+import socket
+import time
+from typing import Callable
+
+# File where the best configuration of every host is stored
+TUNING_FILE = os.path.join(CACHE_DIR, 'loader_tuning.json')
+
+def loader_kwargs(config: dict, device: str) -> dict:
+    """
+    Converts a loader configuration to DataLoader keyword arguments
+
+    Args:
+        config (dict): Configuration with "num_workers", "prefetch_factor" and "persistent_workers".
+        device (str): Device to use (CPU or GPU).
+
+    Returns:
+        dict: Keyword arguments for a DataLoader.
+    """
+    kwargs = {'num_workers': config['num_workers'], 'pin_memory': device == 'cuda'}
+
+    # Only valid with worker processes
+    if config['num_workers'] > 0:
+        kwargs['prefetch_factor'] = config['prefetch_factor']
+        kwargs['persistent_workers'] = config['persistent_workers']
+
+    return kwargs
+
+
+def measure_loader(dataset: Dataset, batch_size: int, config: dict, device: str, step: Callable = None, num_batches: int = 20, passes: int = 2,
+                   batch_transform: Callable = None, collate_fn: Callable = None) -> float:
+    """
+    Measures the throughput of a loader configuration.
+    Several short passes are made, so the cost of starting the workers of every epoch is included.
+
+    Args:
+        dataset (Dataset): Dataset to load.
+        batch_size (int): Batch size.
+        config (dict): Loader configuration.
+        device (str): Device to use (CPU or GPU).
+        step (Callable, optional): Work done with every batch once on the device (e.g. a forward pass). Defaults to None.
+        num_batches (int, optional): Number of batches of every pass. Defaults to 20.
+        passes (int, optional): Number of passes. Defaults to 2.
+        batch_transform (Callable, optional): Transform applied to every batch once on the device, before the step (e.g. normalization of uint8 batches). Defaults to None.
+        collate_fn (Callable, optional): Collate function of the loader. Defaults to None (default collation).
+
+    Returns:
+        float: Images per second.
+    """
+    loader = DataLoader(dataset, batch_size = batch_size, shuffle = not isinstance(dataset, IterableDataset), collate_fn = collate_fn, **loader_kwargs(config, device))
+
+    images = 0
+    begin = time.perf_counter()
+
+    for _ in range(passes):
+        for batch_idx, (inputs, _) in enumerate(loader):
+
+            if batch_idx == num_batches:
+                break
+
+            inputs = inputs.to(device, non_blocking = True)
+
+            # Batched transforms, as the training loop does
+            if batch_transform is not None:
+                inputs = batch_transform(inputs)
+
+            if step is not None:
+                step(inputs)
+
+            images += inputs.shape[0]
+
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+    elapsed = time.perf_counter() - begin
+
+    # Shut down the workers before the next configuration
+    del loader
+
+    return images / elapsed
+
+
+def tune_loader(dataset: Dataset, batch_size: int, device: str, model: torch.nn.Module = None, key: str = '', num_batches: int = 20, retune: bool = False,
+                batch_transform: Callable = None, collate_fn: Callable = None, train: bool = False) -> dict:
+    """
+    Finds the fastest loader configuration for this host, dataset and model.
+    The number of workers is searched first, then the prefetch depth and then whether workers persist.
+    The result is cached per host, so the search only runs once.
+
+    Args:
+        dataset (Dataset): Dataset to load.
+        batch_size (int): Batch size.
+        device (str): Device to use (CPU or GPU).
+        model (torch.nn.Module, optional): Model that consumes the batches. Defaults to None.
+        key (str, optional): Extra key for the cache (e.g. the model name). Defaults to ''.
+        num_batches (int, optional): Number of batches of every measurement. Defaults to 20.
+        retune (bool, optional): Whether to ignore the cached result. Defaults to False.
+        batch_transform (Callable, optional): Transform applied to every batch once on the device, before the model. Defaults to None.
+        collate_fn (Callable, optional): Collate function of the loader. Defaults to None (default collation).
+        train (bool, optional): Whether the loader feeds training steps (forward and backward passes) instead of
+        evaluation forward passes. The model keeps its mode, weights and running statistics. Defaults to False.
+
+    Raises:
+        TypeError: The given dataset is not a Dataset
+        TypeError: The given batch size is not an integer
+        TypeError: The given device is not a str
+        TypeError: The given model is not a torch.nn.Module
+        TypeError: The given batch transform is not callable
+
+    Returns:
+        dict: The best configuration ("num_workers", "prefetch_factor" and "persistent_workers").
+    """
+    if not isinstance(dataset, Dataset): raise TypeError('"dataset" must be a torch.utils.data.Dataset.')
+    if not isinstance(batch_size, int): raise TypeError('"batch_size" must be an integer.')
+    if not isinstance(device, str): raise TypeError('"device" must be a str (CPU or GPU).')
+    if not (model is None or isinstance(model, torch.nn.Module)): raise TypeError('"model" must be a torch.nn.Module or None.')
+    if not (batch_transform is None or callable(batch_transform)): raise TypeError('"batch_transform" must be callable or None.')
+
+    cpus = os.cpu_count() or 1
+
+    # Where the images are resized (per image or on the device, see --device_resize) changes the best configuration
+    transfs = getattr(batch_transform, 'transfs', [] if batch_transform is None else [batch_transform])
+    transform_key = '%r|%s' % (getattr(dataset, 'transfs', None), '+'.join(type(transf).__name__ for transf in transfs))
+
+    cache_key = '|'.join([socket.gethostname(), str(cpus), device, type(dataset).__name__, key, str(batch_size), transform_key, 'train' if train else 'eval'])
+
+    cache = {}
+    if os.path.isfile(TUNING_FILE):
+        with open(TUNING_FILE) as file:
+            cache = json.load(file)
+
+    if cache_key in cache and not retune:
+        return cache[cache_key]
+
+    forward = None
+    if model is not None:
+
+        # Training steps also run the backward pass (gradients are dropped afterwards)
+        def forward(inputs):
+            if train:
+                model(inputs)[:,:1].sum().backward()
+            else:
+                with torch.no_grad():
+                    model(inputs)
+
+    def measure(config):
+        rate = measure_loader(dataset, batch_size, config, device, forward, num_batches, batch_transform = batch_transform, collate_fn = collate_fn)
+        print('Workers: %d | Prefetch: %d | Persistent: %s -> %.1f images/s' % (config['num_workers'], config['prefetch_factor'], config['persistent_workers'], rate))
+        return rate
+
+    # Number of workers: 0 and powers of two up to the number of cpus
+    worker_counts = [0] + [2**i for i in range(cpus.bit_length()) if 2**i <= cpus]
+
+    # Mode the loader will be used in, restored afterwards
+    was_training = model.training if model is not None else None
+    if model is not None:
+        model.train(train)
+
+    print('Tuning data loader...')
+    try:
+        with frozen_batchnorm_stats([model] if model is not None else []):
+
+            best, best_rate = None, 0.0
+            for workers in worker_counts:
+                config = {'num_workers': workers, 'prefetch_factor': 2, 'persistent_workers': workers > 0}
+                rate = measure(config)
+                if rate > best_rate:
+                    best, best_rate = config, rate
+
+            if best['num_workers'] > 0:
+
+                # Prefetch depth
+                for prefetch in (4, 8):
+                    config = dict(best, prefetch_factor = prefetch)
+                    rate = measure(config)
+                    if rate > best_rate:
+                        best, best_rate = config, rate
+
+                # Persistent workers
+                config = dict(best, persistent_workers = False)
+                rate = measure(config)
+                if rate > best_rate:
+                    best, best_rate = config, rate
+
+    finally:
+        if model is not None:
+            model.train(was_training)
+            model.zero_grad(set_to_none = True)
+
+    print('Best loader: %d workers, prefetch %d, persistent %s (%.1f images/s)' % (best['num_workers'], best['prefetch_factor'], best['persistent_workers'], best_rate))
+
+    cache[cache_key] = best
+    os.makedirs(CACHE_DIR, exist_ok = True)
+    atomic_save(json.dumps(cache, indent = 4).encode(), TUNING_FILE)
+
+    return best
@@ -1,19 +1,57 @@
 # PyTorch
 import torch
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim.lr_scheduler import ExponentialLR
-from torch.utils.data import  DataLoader
+from torch.utils.data import  DataLoader, DistributedSampler, IterableDataset
 
 # Dataset
-from dataset import BreastCancerDataset
+from dataset import BreastCancerDataset, CachedDataset, PackedBreastCancerDataset, ShardedBreastCancerDataset, channels_last_collate, is_packed, is_sharded
 
 # Training and testing loops
 from train import *
 
+# Checkpoints written in the background
+from checkpoint import CheckpointWriter, capture_rng_state, restore_rng_state, restore_sampler_state, sampler_state
+
+# Step profiler
+from profiler import StepProfiler
+
+# Test-time augmentation
+from batch_transforms import TestTimeAugment
+
+# Int8 quantization
+from quantization import QUANTIZATION_MODES, calibration_subset, compare_quantized, quantize_model
+
+# ONNX Runtime backend
+from onnx_backend import OnnxModel
+
+# Resumable bulk inference
+from inference import bulk_predict, load_predictions
+
+# Evaluation in a separate process
+from async_eval import AsyncEvaluator, eval_subset
+
+# Distributed data parallelism
+from distributed import ShardedEvalSampler, broadcast_object, cleanup_distributed, init_distributed, is_main_process, main_process_first
+
+# Data loader tuning
+from loader_tuning import loader_kwargs, tune_loader
+
+# Activation checkpointing
+from checkpointing import enable_activation_checkpointing
+
+# Epoch subsampling
+from sampler import StratifiedBudgetSampler
+
+# Dataset statistics
+from stats import NORM_MEAN, NORM_STD, checkpoint_stats, dataset_stats
+
 # Utils
-from utils import interval95, compute_and_plot_stats, build_optimizer, build_model, build_transforms
+from utils import interval95, compute_and_plot_stats, build_optimizer, build_model, build_precision, build_transforms, build_batch_transforms, compile_model, layout_neutral_state_dict, unwrap_model
 
 # Others
 import argparse as arg
+import numpy as np
 import os
 
 parser = arg.ArgumentParser(description= 'Train or test a CNN or ViT with the breast cancer dataset.')
@@ -39,12 +77,99 @@ parser.add_argument('-o', '--optimizer', dest = 'optimizer', default="adam", typ
 # Resume training from checkpoint
 parser.add_argument('-r', '--resume', action= 'store_true', dest = 'resume', default=False, help= 'Resume training from checkpoint')
 
+# Rolling checkpoints
+parser.add_argument('-kc', '--keep_checkpoints', dest = 'keep_checkpoints', default=3, type=int, help= 'Number of last epoch checkpoints kept in ./pretrained/ (besides the best one)')
+
 # Test the neural network (requiers the -n parameter)
 parser.add_argument('-t', '--test', action= 'store_true', dest = 'test', default=False, help= 'Test a neural network (requiers the -n and -te parameter)')
 
 # Name used for the files generated as output (plots)
 parser.add_argument('-na', '--name', dest = 'file_name', default="output", type=str, help= 'Name used for the files generated as output (plots)')
 
+# Do the flips and rotations on the whole batch on the device instead of per sample in the loader
+parser.add_argument('-ba', '--batch_augment', action= 'store_true', dest = 'batch_augment', default=False, help= 'Apply data augmentation to whole batches on the device')
+
+# Load raw uint8 images and normalize whole batches on the device
+parser.add_argument('-u8', '--uint8', action= 'store_true', dest = 'uint8', default=False, help= 'Load uint8 images and normalize them on the device (implies --batch_augment and --device_resize)')
+
+# Upsample the ViT inputs on the device instead of in the loader
+parser.add_argument('-dr', '--device_resize', action= 'store_true', dest = 'device_resize', default=False, help= 'Resize whole batches to the ViT input size on the device')
+
+# Normalize with the exact statistics of the training data
+parser.add_argument('-st', '--stats', action= 'store_true', dest = 'stats', default=False, help= 'Normalize with the statistics of the training data, computed once and cached (when testing, requires the -tr parameter)')
+
+# Draw a fixed number of training images per epoch
+parser.add_argument('-bu', '--budget', dest = 'budget', default=None, type=int, help= 'Number of training images drawn per epoch, stratified by class and patient (all images if not given)')
+
+# Growth of the number of images drawn per epoch
+parser.add_argument('-bg', '--budget_growth', dest = 'budget_growth', default=1.0, type=float, help= 'Factor applied to the budget after every epoch')
+
+# Class balance of the budget
+parser.add_argument('-bb', '--budget_balance', action= 'store_true', dest = 'budget_balance', default=False, help= 'Both classes get the same share of the budget, instead of one proportional to their size')
+
+# Mixed precision
+parser.add_argument('-p', '--precision', dest = 'precision', default="fp32", type=str, help= 'Precision of the forward pass: fp32, bf16 (CPU or GPU) or fp16 (GPU, with loss scaling)')
+
+# Steps between reads of the running metrics from the device
+parser.add_argument('-li', '--log_interval', dest = 'log_interval', default=50, type=int, help= 'Number of steps between updates of the loss and accuracy shown (every update waits for the device)')
+
+# Gradient accumulation
+parser.add_argument('-ga', '--accumulation_steps', dest = 'accumulation_steps', default=1, type=int, help= 'Number of batches whose gradients are accumulated before every optimizer step')
+
+# Activation checkpointing
+parser.add_argument('-cs', '--checkpoint_segments', dest = 'checkpoint_segments', default=0, type=int, help= 'Recompute the activations of the encoder blocks / feature stages in this many segments (0 disables it)')
+
+# Memory format of the weights and batches
+parser.add_argument('-cl', '--channels_last', action= 'store_true', dest = 'channels_last', default=False, help= 'Keep the weights and the batches of CNN models in the channels_last (NHWC) memory format')
+
+# Compiled model execution
+parser.add_argument('-c', '--compile', action= 'store_true', dest = 'compile', default=False, help= 'Compile the model with torch.compile (falls back to eager if it fails)')
+
+# Evaluation cadence
+parser.add_argument('-ee', '--eval_every', dest = 'eval_every', default=1, type=int, help= 'Number of epochs between evaluations of the test set (the last epoch is always evaluated)')
+
+# Evaluation subsampling
+parser.add_argument('-ef', '--eval_fraction', dest = 'eval_fraction', default=1.0, type=float, help= 'Fraction of the test set (fixed random subset) evaluated after the epochs. The final predictions use the whole test set')
+
+# Evaluation in a separate process
+parser.add_argument('-ae', '--async_eval', action= 'store_true', dest = 'async_eval', default=False, help= 'Evaluate snapshots of the weights in a separate process while training goes on')
+
+# Int8 quantization
+parser.add_argument('-q', '--quantize', dest = 'quantize', default=None, choices = QUANTIZATION_MODES, help= 'When testing, quantize the model to int8 on the CPU (dynamic, static or auto) and compare it with the float model. Static quantization requires the -tr parameter')
+
+# Calibration of static quantization
+parser.add_argument('-cb', '--calibration_batches', dest = 'calibration_batches', default=16, type=int, help= 'Number of training batches used to calibrate static quantization')
+
+# ONNX Runtime backend
+parser.add_argument('-ox', '--onnx', dest = 'onnx', default=None, type=str, help= 'When testing, run this ONNX graph (see export_onnx.py) with ONNX Runtime on the CPU instead of the checkpoint')
+
+# Test-time augmentation
+parser.add_argument('-tta', '--tta', dest = 'tta', default=1, type=int, help= 'Number of views (flips and rotations of the training augmentation) averaged by the final predictions, in a single forward pass per batch. 1 disables it')
+
+# Resumable bulk inference
+parser.add_argument('-bp', '--bulk_predict', dest = 'bulk_predict', default=None, type=str, help= 'When testing, stream the predictions to this directory in chunks (resumed if interrupted) before computing the metrics')
+
+# Images per chunk of the bulk inference
+parser.add_argument('-bc', '--bulk_chunk', dest = 'bulk_chunk', default=8192, type=int, help= 'Number of images per chunk of --bulk_predict')
+
+# Step profiler
+parser.add_argument('-pf', '--profile', action= 'store_true', dest = 'profile', default=False, help= 'Time the phases of every training, test and prediction step and write them to ./profiles/ (slows the steps down)')
+
+# PyTorch profiler window
+parser.add_argument('-pt', '--profile_trace', dest = 'profile_trace', default=None, type=str, help= 'First step and number of steps of every training epoch traced with the PyTorch profiler, as "first,count" (requires --profile)')
+
+# Transform the test set only once and reuse it in every evaluation
+parser.add_argument('-ct', '--cache_test', action= 'store_true', dest = 'cache_test', default=False, help= 'Cache the transformed test set in RAM (or on disk if it does not fit)')
+
+# Maximum RAM used by the test set cache
+parser.add_argument('-cm', '--cache_memory', dest = 'cache_memory', default=2.0, type=float, help= 'Maximum GiB of RAM used by the test set cache')
+
+# Number of data loader worker processes
+parser.add_argument('-w', '--workers', dest = 'workers', default=0, type=int, help= 'Number of data loader worker processes')
+
+# Find the fastest data loader configuration for this machine
+parser.add_argument('-tl', '--tune_loader', action= 'store_true', dest = 'tune_loader', default=False, help= 'Benchmark and use the fastest data loader configuration for this machine (cached per host)')
+
 
 # --------------- Global variables ---------------
 
@@ -61,21 +186,148 @@ scheduler = None
 
 best_accuracy = 0.0
 
+# Number of test images the best accuracy was measured on (None if unknown)
+best_eval_samples = None
+
 
 trainloader, testloader = None, None
+
+# Loader of the whole test set for the predictions (the test loader only has the shard of this process when distributed)
+predictloader = None
 model, optimizer = None,None
 
+# Transforms applied to every training and test batch on the device
+train_batch_transform, test_batch_transform = None, None
+
+# Mixed precision type and loss scaler
+amp_dtype, scaler = None, None
+
 test_samples = 0
+
+# Number of test images evaluated after the epochs (see --eval_fraction)
+eval_samples = 0
 file_name = None
 
+log_interval = 50
+accumulation_steps = 1
+compile_models = False
+channels_last = False
+
+# Rank of this process and number of processes
+rank, world_size = 0, 1
+
+# Epochs between evaluations, and the evaluation worker (None evaluates in this process)
+eval_every = 1
+evaluator = None
+
+# Background checkpoint writer, and first epoch (after the one resumed from)
+checkpointer = None
+start_epoch = 0
+
+# Whether steps are profiled, and the steps traced by the PyTorch profiler
+profile = False
+profile_trace = None
+
+# Directory and chunk size of the bulk inference (None predicts in memory)
+bulk_dir = None
+bulk_chunk = 8192
+
+# Float model a quantized model is compared against (None if not quantized)
+float_model = None
+
+# Test-time augmentation of the final predictions (None disables it)
+tta = None
+
+# Mean and standard deviation the images are normalized with, saved in the checkpoints
+norm_mean, norm_std = NORM_MEAN, NORM_STD
+
 # ---------------------------------------------
+def get_stats(args, state = None):
+    """
+    Gets the mean and standard deviation used to normalize the images
+    Args:
+        args: Arguments passed from the argument parser
+        state: Checkpoint of the model, whose statistics are used unless --stats is given (None for the default ones)
+    """
+    if args.stats:
+        print("Computing training dataset statistics...")
+        mean, std = dataset_stats(args.training_path + '/')
+        print("Mean:", mean, "Std:", std)
+
+        if state is not None and (mean, std) != checkpoint_stats(state):
+            print("Warning: the checkpoint was trained with other statistics (mean: %s, std: %s)" % checkpoint_stats(state))
+
+        return mean, std
+
+    return checkpoint_stats(state)
+
+def get_loader_kwargs(args, dataset, batch_transform = None, train = False) -> dict:
+    """
+    Gets the worker and prefetch settings of the data loaders
+    Args:
+        args: Arguments passed from the argument parser
+        dataset: Dataset the settings are tuned against
+        batch_transform: Transform applied to the batches on the device (or None), also applied while tuning
+        train: Whether the loader feeds training steps, which are then the steps timed while tuning
+    """
+    # Batches are collated directly in the channels_last layout
+    collate_fn = channels_last_collate if args.channels_last else None
+
+    if args.tune_loader:
+
+        # Tuned by the first process, so every process uses the same workers (and reads streamed shards in the same number of batches)
+        config = tune_loader(dataset, args.batch_size, device, model = unwrap_model(model), key = model_name, batch_transform = batch_transform, collate_fn = collate_fn, train = train) if is_main_process() else None
+        config = broadcast_object(config)
+    else:
+        config = {'num_workers': args.workers, 'prefetch_factor': 2, 'persistent_workers': args.workers > 0}
+
+    kwargs = loader_kwargs(config, device)
+
+    # Persistent workers keep their first copy of streamed shards, which would miss set_epoch() and stream the same order every epoch
+    if isinstance(dataset, IterableDataset) and kwargs.get('persistent_workers'):
+        kwargs['persistent_workers'] = False
+
+    if collate_fn is not None:
+        kwargs['collate_fn'] = collate_fn
+
+    return kwargs
+
+def example_batch(loader, batch_transform):
+    """
+    Gets a batch as the model sees it, used to compile the model
+    Args:
+        loader: Data loader
+        batch_transform: Transform applied to the batch on the device (or None)
+    """
+    inputs, _ = next(iter(loader))
+    inputs = inputs.to(device)
+
+    return batch_transform(inputs) if batch_transform is not None else inputs
+
+def load_dataset(data_dir: str, batch_size: int = 1, **kwargs):
+    """
+    Loads a dataset from a directory of images, from a packed store (see pack_dataset.py)
+    or from tar shards (see make_shards.py)
+    Args:
+        data_dir: Path to the images, to the packed store or to the shards
+        batch_size: Batch size of the loader, used to split streamed shards between loader workers
+        kwargs: Arguments passed to the dataset
+    """
+    if is_packed(data_dir):
+        return PackedBreastCancerDataset(data_dir, **kwargs)
+
+    if is_sharded(data_dir):
+        return ShardedBreastCancerDataset(data_dir, batch_size = batch_size, **kwargs)
+
+    return BreastCancerDataset(data_dir, **kwargs)
+
 def set_up_training(args):
     """
     Sets up all of the necessary variable for training
     Args:
         args: Arguments passed from the argument parser
     """
-    global best_accuracy, best_class_accuracy, file_name, n_components, model_name, model, optimizer, trainloader, testloader, scheduler, test_samples
+    global norm_mean, norm_std, best_accuracy, best_eval_samples, best_class_accuracy, file_name, n_components, model_name, model, optimizer, trainloader, testloader, predictloader, scheduler, test_samples, eval_samples, train_batch_transform, test_batch_transform, amp_dtype, scaler, evaluator, checkpointer, start_epoch
 
     # Obtain model name
     model_name = args.net.lower()
@@ -86,22 +338,42 @@ def set_up_training(args):
 
     # Model
     print('Building model...')
-    model = build_model(model_name)
+    model = build_model(model_name, channels_last = args.channels_last)
 
     if os.path.isfile('./pretrained/' + file_name + '.pth'):
         print("Previous training with this models found. Obtaining best accuracy...")
         state_dict = torch.load('./pretrained/' + file_name + '.pth')
         best_accuracy = state_dict['accuracy']
+        best_eval_samples = state_dict.get('eval_samples')
         print("Best accuracy: ", best_accuracy)
 
+    checkpointer = CheckpointWriter('./pretrained', file_name, keep_last = args.keep_checkpoints, resume = args.resume)
+
+    # Epoch checkpoints of a previous run with the same name would be taken for this run's by a later resume
+    if not args.resume and is_main_process() and checkpointer.last_epochs():
+        print("Removing the epoch checkpoints of a previous run named %s" % file_name)
+        checkpointer.clear()
+
+    # Full training state of the last epoch if there is one, otherwise only the weights of the best model
+    resume_state = None
     if args.resume:
-        state_dict = torch.load('./pretrained/' + file_name + '.pth')
-        model.load_state_dict( state_dict['model'] )
-        best_accuracy = state_dict['accuracy']
-        print("Loaded checkpoint, best accuracy obtained previously is: %.3f" % best_accuracy)
+        resume_path = checkpointer.latest() or checkpointer.best_path()
+        resume_state = torch.load(resume_path, map_location = 'cpu')
+        model.load_state_dict( resume_state['model'] )
+        best_accuracy = resume_state.get('best_accuracy', resume_state['accuracy'])
+        best_eval_samples = resume_state.get('eval_samples')
+        print("Loaded checkpoint %s, best accuracy obtained previously is: %.3f" % (resume_path, best_accuracy))
+
+    # Trade compute for memory (state dict keys are unchanged)
+    if args.checkpoint_segments > 0:
+        model = enable_activation_checkpointing(model, model_name, args.checkpoint_segments)
 
     model.to(device)
 
+    # Gradients are averaged across processes in the backward pass
+    if world_size > 1:
+        model = DistributedDataParallel(model, device_ids = [torch.cuda.current_device()] if device == 'cuda' else None)
+
 
     # Get optimizer
     print('Loading optimizer...')
@@ -111,28 +383,108 @@ def set_up_training(args):
     # Build scheduler
     scheduler = ExponentialLR(optimizer, gamma = 0.95, verbose=True)
 
+    # Mixed precision
+    amp_dtype, scaler = build_precision(args.precision.lower(), device)
+
     # Data augmentation
     print("Loading data augmentation transforms...")
-    train_transform, test_transform = build_transforms(model_name)
+    batch_augment = args.batch_augment or args.uint8
+    device_resize = args.device_resize or args.uint8
 
+    # The first process computes the statistics, the others then read them from the cache (a resumed run keeps the ones of its checkpoint)
+    with main_process_first():
+        mean, std = norm_mean, norm_std = get_stats(args, resume_state)
 
-    # Get training dataset (122400 images) with rotations
-    print("Loading training dataset...")                                                                                          
-    training_data = BreastCancerDataset(args.training_path + '/', transfs = train_transform, angles = list(range(-90,91,15)))
-    print("Loaded %d images" % len(training_data))
+    train_transform, test_transform = build_transforms(model_name, batch_augment = batch_augment, device_resize = device_resize, mean = mean, std = std)
 
-    # Get test dataset (13600 images)
-    print("Loading test dataset...")
-    test_data = BreastCancerDataset(args.test_path + '/', transfs = test_transform)
-    print("Loaded %d images" % len(test_data))
+    # Discrete rotation set
+    angles = list(range(-90,91,15))
 
-    test_samples = len(test_data)
+    # Transforms done on whole batches on the device
+    train_batch_transform, test_batch_transform = build_batch_transforms(model_name, uint8 = args.uint8, batch_augment = batch_augment, device_resize = device_resize, angles = angles, mean = mean, std = std, channels_last = args.channels_last)
+
+    # The first process builds the manifests and the cached test set, the others then read them
+    with main_process_first():
+
+        # Get training dataset (122400 images) with rotations
+        print("Loading training dataset...")
+        training_data = load_dataset(args.training_path + '/', batch_size = args.batch_size, transfs = train_transform, angles = None if batch_augment else angles, uint8 = args.uint8)
+        print("Loaded %d images" % len(training_data))
+
+        # Get test dataset (13600 images)
+        print("Loading test dataset...")
+        test_data = load_dataset(args.test_path + '/', batch_size = args.batch_size, transfs = test_transform, uint8 = args.uint8)
+        print("Loaded %d images" % len(test_data))
+
+        if args.cache_test:
+            test_data = CachedDataset(test_data, max_memory = int(args.cache_memory * 1024**3))
+
+    if args.budget is not None and isinstance(training_data, IterableDataset): raise ValueError('--budget is not available for streamed tar shards, use a directory of images or a packed store.')
+
+    # The final predictions read the whole test set (streamed shards are otherwise split between processes)
+    predict_data = test_data
+    if isinstance(test_data, ShardedBreastCancerDataset) and world_size > 1:
+        predict_data = load_dataset(args.test_path + '/', batch_size = args.batch_size, transfs = test_transform, uint8 = args.uint8, split_ranks = False)
+
+    test_samples = len(predict_data)
+
+    kwargs = get_loader_kwargs(args, training_data, train_batch_transform, train = True)
+
+    if args.budget is not None:
+
+        # Class and patient stratified subset of the training data every epoch (every process draws the same subset and keeps its share of it)
+        sampler = StratifiedBudgetSampler(training_data.labels, training_data.patients, args.budget, growth = args.budget_growth, balance_classes = args.budget_balance, rank = rank, world_size = world_size)
+        trainloader = DataLoader(dataset = training_data, batch_size = args.batch_size, sampler = sampler, **kwargs)
 
-    # Training data loader
-    trainloader = DataLoader(dataset = training_data, batch_size = args.batch_size, shuffle = True)
+    elif world_size > 1 and not isinstance(training_data, IterableDataset):
+
+        # Every process trains on its own shard of the training data
+        trainloader = DataLoader(dataset = training_data, batch_size = args.batch_size, sampler = DistributedSampler(training_data, shuffle = True), **kwargs)
+
+    else:
+        # Training data loader (streamed shards are shuffled by the dataset itself, and split between processes)
+        trainloader = DataLoader(dataset = training_data, batch_size = args.batch_size, shuffle = not isinstance(training_data, IterableDataset), **kwargs)
 
     # Test data loader
-    testloader = DataLoader(dataset = test_data, batch_size = args.batch_size, shuffle = False)
+    predictloader = DataLoader(dataset = predict_data, batch_size = args.batch_size, shuffle = False, **kwargs)
+
+    # Images evaluated after the epochs
+    eval_data = eval_subset(test_data, args.eval_fraction)
+    eval_samples = test_samples if eval_data is test_data else len(eval_data)
+
+    # Checkpoints saved before --eval_fraction have no image count and were evaluated on the whole test set
+    if best_accuracy > 0 and (best_eval_samples or test_samples) != eval_samples:
+        print("The best accuracy so far was measured on %d test images and this run evaluates %d, so it is not kept" % (best_eval_samples or test_samples, eval_samples))
+        best_accuracy = 0.0
+
+    if args.async_eval:
+
+        # The first process evaluates the whole (subsampled) test set in the background
+        testloader = None
+        if is_main_process():
+            evaluator = AsyncEvaluator(model_name, device, eval_data, args.batch_size, loader_kwargs = kwargs, batch_transform = test_batch_transform,
+                                       amp_dtype = amp_dtype, channels_last = args.channels_last)
+
+    # Every process evaluates its own shard of the test set, and test() sums the results
+    elif world_size > 1 and not isinstance(eval_data, IterableDataset):
+        testloader = DataLoader(dataset = eval_data, batch_size = args.batch_size, sampler = ShardedEvalSampler(eval_data), **kwargs)
+    else:
+        testloader = DataLoader(dataset = eval_data, batch_size = args.batch_size, shuffle = False, **kwargs) if eval_data is not predict_data else predictloader
+
+    if compile_models:
+        model = compile_model(model, example_batch(trainloader, train_batch_transform), train = True)
+
+    # Restored last, once nothing else draws random numbers before training
+    if resume_state is not None and 'optimizer' in resume_state:
+        optimizer.load_state_dict(resume_state['optimizer'])
+        scheduler.load_state_dict(resume_state['scheduler'])
+        if scaler is not None and resume_state['scaler'] is not None:
+            scaler.load_state_dict(resume_state['scaler'])
+        restore_sampler_state(trainloader, resume_state['sampler'])
+        restore_rng_state(resume_state['rng'])
+
+        start_epoch = resume_state['epoch'] + 1
+        print("Resuming from epoch %d" % start_epoch)
 
     return 
 
@@ -146,7 +498,7 @@ def setup_test(args):
         device: Device used for traning ('cuda' or 'cpu')
         args: Arguments passed from the argument parser
     """
-    global file_name, model_name, model, testloader, test_samples
+    global file_name, model_name, model, testloader, test_samples, test_batch_transform, amp_dtype, device, float_model
 
     # Obtain model name
     model_name = args.net.lower()
@@ -154,34 +506,119 @@ def setup_test(args):
     # Obtain output file name
     file_name = args.file_name
     
+    # Checkpoint of the model (also read with ONNX graphs, for the statistics the model was trained with)
+    state = None
+    if args.onnx is None or os.path.isfile('./pretrained/' + file_name + '.pth'):
+        state = torch.load('./pretrained/' + file_name + '.pth', map_location = None if torch.cuda.is_available() else torch.device('cpu'))
+
     # Model
-    print('Building model...')
-    model = build_model(model_name)
+    if args.onnx is not None:
+        print('Loading ONNX graph...')
+        model = OnnxModel(args.onnx)
 
-    if torch.cuda.is_available():
-        model.load_state_dict( torch.load('./pretrained/' + file_name + '.pth')['model'] )
-    
     else:
-        model.load_state_dict( torch.load('./pretrained/' + file_name + '.pth', map_location=torch.device('cpu'))['model'] )
-        
-    model.to(device)
+        print('Building model...')
+        model = build_model(model_name, channels_last = args.channels_last)
+        model.load_state_dict( state['model'] )
+        model.to(device)
 
-    _, test_transform = build_transforms(model_name)
+    # Mixed precision (no loss scaling needed without training)
+    amp_dtype, _ = build_precision(args.precision.lower(), device)
+
+    device_resize = args.device_resize or args.uint8
+    mean, std = get_stats(args, state)
+    _, test_transform = build_transforms(model_name, device_resize = device_resize, mean = mean, std = std)
+    _, test_batch_transform = build_batch_transforms(model_name, uint8 = args.uint8, device_resize = device_resize, mean = mean, std = std, channels_last = args.channels_last)
 
     # Get test dataset (15110 images)
     print("Loading test dataset...")
-    test_data = BreastCancerDataset(args.test_path, transfs = test_transform)
+    test_data = load_dataset(args.test_path, batch_size = args.batch_size, transfs = test_transform, uint8 = args.uint8)
     print("Loaded %d images" % len(test_data))
+
+    if args.cache_test:
+        test_data = CachedDataset(test_data, max_memory = int(args.cache_memory * 1024**3))
     test_samples = len(test_data)
 
 
+    # Quantized kernels and ONNX Runtime run on the CPU, in float32
+    if args.quantize is not None or args.onnx is not None:
+        device, amp_dtype = 'cpu', None
+
     # Test data loader
-    testloader = DataLoader(dataset = test_data, batch_size = args.batch_size, shuffle = False)
+    testloader = DataLoader(dataset = test_data, batch_size = args.batch_size, shuffle = False, **get_loader_kwargs(args, test_data, test_batch_transform))
+
+    # ONNX graphs are neither quantized nor compiled (ONNX Runtime optimizes them when loaded)
+    if args.onnx is not None:
+        return
+
+    if args.quantize is not None:
+
+        # Calibration with a fixed slice of the training data (test transforms, no augmentation)
+        calibration_loader = None
+        if args.training_path is not None:
+            calibration_data = load_dataset(args.training_path + '/', transfs = test_transform, uint8 = args.uint8)
+            calibration_data = calibration_subset(calibration_data, args.calibration_batches * args.batch_size)
+            calibration_loader = DataLoader(dataset = calibration_data, batch_size = args.batch_size, shuffle = False, **get_loader_kwargs(args, calibration_data, test_batch_transform))
+
+        print("Quantizing model...")
+        float_model = model
+        model = quantize_model(float_model, model_name, args.quantize, calibration_loader = calibration_loader, batch_transform = test_batch_transform)
+
+    elif compile_models:
+        model = compile_model(model, example_batch(testloader, test_batch_transform))
 
     return 
 
 
 
+def make_profiler(loop: str, epoch: int = 0) -> StepProfiler:
+    """
+    Builds the profiler of a training, test or prediction loop
+    Args:
+        loop: Name of the loop ('train', 'test' or 'predict')
+        epoch: Current epoch
+    """
+    trace_steps = profile_trace if loop == 'train' else None
+
+    return StepProfiler('%s_%s_epoch%d' % (file_name, loop, epoch), device, enabled = profile and is_main_process(), trace_steps = trace_steps)
+
+def training_state(epoch: int, accuracy: float) -> dict:
+    """
+    Gets everything needed to resume training after an epoch
+    Args:
+        epoch: Epoch just finished
+        accuracy: Test accuracy of the epoch (None if it was not evaluated)
+    """
+    return {
+        'model': layout_neutral_state_dict(model),
+        'accuracy': accuracy,
+        'epoch': epoch,
+        'best_accuracy': best_accuracy,
+        'eval_samples': eval_samples,
+        'mean': norm_mean,
+        'std': norm_std,
+        'optimizer': optimizer.state_dict(),
+        'scheduler': scheduler.state_dict(),
+        'scaler': scaler.state_dict() if scaler is not None else None,
+        'sampler': sampler_state(trainloader),
+        'rng': capture_rng_state()
+    }
+
+def collect_evaluations(wait: bool = False) -> None:
+    """
+    Saves the best of the snapshots evaluated in the background so far
+    Args:
+        wait: Whether to wait for every pending snapshot
+    """
+    global best_accuracy
+
+    for epoch, test_acc, state_dict in evaluator.collect(wait = wait):
+        print("Epoch %d test accuracy: %.3f%% (%d images)" % (epoch, test_acc, eval_samples))
+
+        if test_acc > best_accuracy:
+            checkpointer.save({'model': state_dict, 'accuracy': test_acc, 'epoch': epoch, 'eval_samples': eval_samples, 'mean': norm_mean, 'std': norm_std}, best = True, last = False)
+            best_accuracy = test_acc
+
 def train_model(num_epochs: int) -> None:
     """
     Trains the neural network for a number of epochs.
@@ -190,29 +627,76 @@ def train_model(num_epochs: int) -> None:
 
     Returns: None
     """
-    global best_accuracy, model_name, model, trainloader, testloader, optimizer, scheduler, test_samples, file_name
+    global best_accuracy, model_name, model, trainloader, testloader, predictloader, optimizer, scheduler, test_samples, file_name, train_batch_transform, test_batch_transform, amp_dtype, scaler
     
 
     
-    for epoch in range(num_epochs):
+    # The evaluation worker is stopped even if training fails, otherwise this process would wait for it forever at exit
+    try:
+        for epoch in range(start_epoch, num_epochs):
 
-        train(criterion, device, epoch, model, model_name, optimizer, scheduler, trainloader)
+            # New shuffling order for streamed shards
+            if isinstance(trainloader.dataset, ShardedBreastCancerDataset):
+                trainloader.dataset.set_epoch(epoch)
 
-        test_acc = test(best_accuracy, criterion, device, epoch, file_name, model, model_name, testloader)
+            # New draws (and budget) of the epoch subsampling, or new shuffling of the distributed shards
+            if isinstance(trainloader.sampler, (StratifiedBudgetSampler, DistributedSampler)):
+                trainloader.sampler.set_epoch(epoch)
 
-        if test_acc > best_accuracy:
-            best_accuracy = test_acc 
+            train(criterion, device, epoch, model, model_name, optimizer, scheduler, trainloader, batch_transform = train_batch_transform,
+                  amp_dtype = amp_dtype, scaler = scaler, log_interval = log_interval,
+                  accumulation_steps = accumulation_steps, profiler = make_profiler('train', epoch))
+
+            test_acc = None
+
+            if (epoch + 1) % eval_every == 0 or epoch == num_epochs - 1:
 
+                if evaluator is not None:
+
+                    # Training goes on while the snapshot is evaluated
+                    evaluator.submit(epoch, model)
+                    collect_evaluations()
+
+                elif testloader is not None:
+                    test_acc = test(best_accuracy, criterion, device, epoch, file_name, model, model_name, testloader, batch_transform = test_batch_transform, amp_dtype = amp_dtype,
+                                    log_interval = log_interval, save = False, profiler = make_profiler('test', epoch))
+
+            improved = test_acc is not None and test_acc > best_accuracy
+            if improved:
+                best_accuracy = test_acc 
+
+            # Training goes on while the checkpoint is written
+            if is_main_process():
+                checkpointer.save(training_state(epoch, test_acc), best = improved)
+
+        if evaluator is not None:
+            collect_evaluations(wait = True)
+
+    finally:
+        if evaluator is not None:
+            evaluator.close()
+
+    # Every checkpoint is on disk before the best one is loaded
+    checkpointer.close()
+
+
+    # Only the process that saved the best model predicts with it
+    if not is_main_process():
+        return
 
     # Get model when it had the best accuracy
     del model
-    model = build_model(model_name)
+    model = build_model(model_name, channels_last = channels_last)
     model.load_state_dict( torch.load('./pretrained/' + file_name + '.pth')['model'] )
     model.to(device)
 
+    if compile_models:
+        model = compile_model(model, example_batch(predictloader, test_batch_transform))
+
     # Obtain predictions
     print("Obtaining predictions...")
-    true_labels, predicted_labels, probabilities = predict(device, model, model_name, testloader)
+    true_labels, predicted_labels, probabilities = predict(device, model, model_name, predictloader, batch_transform = test_batch_transform, amp_dtype = amp_dtype,
+                                                           profiler = make_profiler('predict'), log_interval = log_interval, tta = tta)
 
     # Compute and plot metrics
     precision, recall, specificity, f_score, bac = compute_and_plot_stats(true_labels, predicted_labels, probabilities, file_name)
@@ -222,8 +706,8 @@ def train_model(num_epochs: int) -> None:
     print("F - Score:", f_score)
     print("Balanced Accuracy:", bac)
 
-    # Confidence interval
-    interval = interval95( best_accuracy / 100, test_samples)
+    # Confidence interval (of the accuracy measured on the evaluated images)
+    interval = interval95( best_accuracy / 100, eval_samples)
     print("Confidence interval (95%):")
     print(str(best_accuracy) + ' +- ' + str(interval * 100))
 
@@ -233,8 +717,27 @@ def test_model():
 
     print("Obtaining predictions...")
 
-    # Obtain predictions
-    true_labels, predicted_labels, probabilities = predict(device, model, model_name, testloader)
+    if bulk_dir is not None:
+
+        # Predictions streamed to disk, then read back
+        kwargs = {'num_workers': testloader.num_workers, 'pin_memory': testloader.pin_memory, 'collate_fn': testloader.collate_fn}
+        bulk_predict(device, model, testloader.dataset, bulk_dir, batch_size = testloader.batch_size, chunk_size = bulk_chunk,
+                     batch_transform = test_batch_transform, amp_dtype = amp_dtype, loader_kwargs = kwargs, tta = tta)
+
+        predictions = load_predictions(bulk_dir)
+        true_labels, probabilities = predictions['label'], predictions['probability']
+        predicted_labels = (probabilities > 0.5).astype(np.int64)
+
+    elif float_model is not None:
+
+        # Quantized model, compared with the float model
+        report = compare_quantized(float_model, model, model_name, testloader, batch_transform = test_batch_transform, tta = tta)
+        true_labels, predicted_labels, probabilities = report['predictions']
+
+    else:
+        # Obtain predictions
+        true_labels, predicted_labels, probabilities = predict(device, model, model_name, testloader, batch_transform = test_batch_transform, amp_dtype = amp_dtype,
+                                                               profiler = make_profiler('predict'), log_interval = log_interval, tta = tta)
     
     # Compute and plot metrics
     precision, recall, specificity, f_score, bac = compute_and_plot_stats(true_labels, predicted_labels, probabilities, file_name)
@@ -252,14 +755,31 @@ def test_model():
 
 
 
-def main():
+def main(argv: list = None):
+    global log_interval, accumulation_steps, compile_models, channels_last, rank, world_size, eval_every, profile, profile_trace, bulk_dir, bulk_chunk, tta
 
-    # Parse arguments
-    args = parser.parse_args()
+    # Parse arguments (launch.py passes them explicitly)
+    args = parser.parse_args(argv)
+    log_interval = args.log_interval
+    accumulation_steps = args.accumulation_steps
+    compile_models = args.compile
+    channels_last = args.channels_last
+    eval_every = args.eval_every
+    profile = args.profile
+    profile_trace = tuple(int(value) for value in args.profile_trace.split(',')) if args.profile_trace else None
+    bulk_dir = args.bulk_predict
+    bulk_chunk = args.bulk_chunk
+    tta = TestTimeAugment(args.tta) if args.tta > 1 else None
 
     if not args.test:
+
+        # Joins the other processes when started by launch.py (or torchrun)
+        rank, world_size = init_distributed()
+
         set_up_training(args)
         train_model(args.num_epochs)
+
+        cleanup_distributed()
     else:
         setup_test(args)
         test_model()
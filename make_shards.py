@@ -0,0 +1,29 @@
+# Converts a split directory of patches (e.g. "data/train/") into tar shards readable by ShardedBreastCancerDataset
+
+# Dataset
+from dataset import write_shards
+
+# Others
+import argparse as arg
+
+parser = arg.ArgumentParser(description= 'Convert a directory of image patches into tar shards for sequential streaming.')
+
+# Path to images
+parser.add_argument('-p', '--path', dest = 'path', default = None, type=str, help= 'Path to images.')
+
+# Destination of the shards
+parser.add_argument('-d', '--destination', dest = 'dest', default = None, type=str, help= 'Destination directory.')
+
+# Images per shard
+parser.add_argument('-s', '--shard_size', dest = 'shard_size', default = 10000, type=int, help= 'Number of images per shard.')
+
+def main():
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    n_shards = write_shards(args.path, args.dest, shard_size = args.shard_size)
+    print("Wrote %d shards into %s" % (n_shards, args.dest))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# PyTorch
+import torch
+import torch.nn as nn
+
+# ONNX Runtime is only needed to run exported models
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+# Utils
+from quantization import measure_latency
+from utils import unwrap_model
+
+# Others
+import os
+
+def export_onnx(model: nn.Module, path: str, input_size: int, opset: int = 17) -> str:
+    """
+    Exports a model to an ONNX graph whose batch dimension is dynamic
+
+    Args:
+        model (nn.Module): The model (compiled, distributed or not).
+        path (str): Destination of the graph.
+        input_size (int): Height and width of the input images (50, or 224 for the ViT).
+        opset (int, optional): ONNX opset version. Defaults to 17.
+
+    Raises:
+        TypeError: The given model is not a nn.Module
+        TypeError: The given path is not a str
+
+    Returns:
+        str: The path of the graph.
+    """
+    if not isinstance(model, nn.Module): raise TypeError('"model" must be a nn.Module')
+    if not isinstance(path, str): raise TypeError('"path" must be a str')
+
+    model = unwrap_model(model).cpu().eval()
+
+    # Exported with a batch of 2, so no dimension is specialized to 1
+    inputs = torch.randn(2, 3, input_size, input_size)
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+
+    torch.onnx.export(model, (inputs,), path, opset_version = opset, input_names = ['input'], output_names = ['logits'],
+                      dynamic_axes = {'input': {0: 'batch'}, 'logits': {0: 'batch'}})
+
+    return path
+
+
+class OnnxModel(nn.Module):
+    def __init__(self, path: str, num_threads: int = 0) -> None:
+        """
+        Runs an exported ONNX graph with the CPU provider of ONNX Runtime, behind the interface of a model
+        (a batch tensor in, a logits tensor out), so it can be used wherever a model is.
+        Outputs are returned on the device of the inputs.
+
+        Args:
+            path (str): Path of the graph (see export_onnx).
+            num_threads (int, optional): Threads used by every operator, 0 lets ONNX Runtime decide. Defaults to 0.
+
+        Raises:
+            ImportError: ONNX Runtime is not installed
+            OSError: The graph is not found
+        """
+        if ort is None: raise ImportError('ONNX Runtime is required to run ONNX models (pip install onnxruntime).')
+        if not os.path.isfile(path): raise OSError('ONNX graph not found')
+
+        super(OnnxModel, self).__init__()
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.path = path
+        self.session = ort.InferenceSession(path, sess_options = options, providers = ['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        inputs = x.detach().to('cpu', torch.float32).contiguous().numpy()
+        outputs, = self.session.run(None, {self.input_name: inputs})
+
+        return torch.from_numpy(outputs).to(x.device)
+
+
+def check_parity(model: nn.Module, onnx_model: OnnxModel, inputs: torch.Tensor, atol: float = 1e-4) -> dict:
+    """
+    Compares the logits of a PyTorch model and of its exported graph on a fixed batch, and their latency on the CPU
+
+    Args:
+        model (nn.Module): The PyTorch model.
+        onnx_model (OnnxModel): The exported graph.
+        inputs (torch.Tensor): The batch.
+        atol (float, optional): Largest absolute difference of the logits accepted. Defaults to 1e-4.
+
+    Returns:
+        dict: Largest absolute difference of the logits, whether it is within atol, whether the
+        predicted classes match, and the latency of a batch (seconds) of both models.
+    """
+    model = unwrap_model(model).cpu().eval()
+    inputs = inputs.cpu()
+
+    with torch.no_grad():
+        expected = model(inputs)[:,:1].squeeze(1)
+        actual = onnx_model(inputs)[:,:1].squeeze(1)
+
+    max_diff = float((expected - actual).abs().max())
+
+    return {
+        'max_abs_diff': max_diff,
+        'parity': max_diff <= atol,
+        'same_predictions': bool(((expected > 0) == (actual > 0)).all()),
+        'torch_latency': measure_latency(model, inputs),
+        'onnx_latency': measure_latency(onnx_model, inputs)
+    }
@@ -0,0 +1,26 @@
+# Packs a directory of patches into a memory-mapped store readable by PackedBreastCancerDataset
+
+# Dataset
+from dataset import pack_dataset
+
+# Others
+import argparse as arg
+
+parser = arg.ArgumentParser(description= 'Pack a directory of image patches into a memory-mapped store.')
+
+# Path to images
+parser.add_argument('-p', '--path', dest = 'path', default = None, type=str, help= 'Path to images.')
+
+# Destination of the packed store
+parser.add_argument('-d', '--destination', dest = 'dest', default = None, type=str, help= 'Destination directory.')
+
+def main():
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    n_images = pack_dataset(args.path, args.dest)
+    print("Packed %d images into %s" % (n_images, args.dest))
+
+if __name__ == "__main__":
+    main()
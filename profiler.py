@@ -0,0 +1,239 @@
+# PyTorch
+import torch
+
+# Utils
+import numpy as np
+
+# Others
+import csv
+import json
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Iterable, Iterator, Tuple
+
+# Phases of a step, in order
+PHASES = ('data', 'h2d', 'transform', 'forward', 'backward', 'optimizer')
+
+class StepProfiler:
+    def __init__(self, name: str, device: str, enabled: bool = True, output_dir: str = './profiles', trace_steps: Tuple[int, int] = None) -> None:
+        """
+        Times every phase of the steps of a loop: waiting for the data loader, host to device copy, batch transforms,
+        forward pass, backward pass and optimizer step. The device is synchronized around every phase,
+        so the time of asynchronous kernels goes to the phase that launched them (and steps are slower while profiling).
+        Results are written to "<output_dir>/<name>.json" (summary) and "<output_dir>/<name>.csv" (every step).
+
+        Args:
+            name (str): Name of the output files (e.g. "<model>_train_epoch0").
+            device (str): Device to use (CPU or GPU).
+            enabled (bool, optional): Whether anything is measured. A disabled profiler costs nothing. Defaults to True.
+            output_dir (str, optional): Directory of the output files. Defaults to './profiles'.
+            trace_steps (tuple, optional): First step and number of steps traced with torch.profiler, written
+            to "<output_dir>/<name>.trace.json" (chrome://tracing). None disables it. Defaults to None.
+
+        Raises:
+            TypeError: The given name is not a str
+            TypeError: The given device is not a str
+            TypeError: The given traced steps are not a tuple
+        """
+        if not isinstance(name, str): raise TypeError('"name" must be a str.')
+        if not isinstance(device, str): raise TypeError('"device" must be a str (CPU or GPU).')
+        if not (trace_steps is None or isinstance(trace_steps, tuple)): raise TypeError('"trace_steps" must be a tuple or None.')
+
+        self.name = name
+        self.device = device
+        self.enabled = enabled
+        self.output_dir = output_dir
+
+        # Seconds spent in every phase of the current step, and of every finished step
+        self.current = dict.fromkeys(PHASES, 0.0)
+        self.steps = []
+        self.samples = 0
+        self.step_begin = None
+
+        self.trace = None
+        if enabled and trace_steps is not None:
+            first, active = trace_steps
+            self.trace = torch.profiler.profile(
+                activities = [torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if device.startswith('cuda') else []),
+                schedule = torch.profiler.schedule(wait = max(0, first - 1), warmup = min(1, first), active = active, repeat = 1),
+                on_trace_ready = lambda prof: prof.export_chrome_trace(os.path.join(output_dir, name + '.trace.json')),
+                record_shapes = True)
+
+    def synchronize(self) -> None:
+        """
+        Waits for the kernels launched on the device
+
+        Returns:
+            None
+        """
+        if self.device.startswith('cuda'):
+            torch.cuda.synchronize()
+
+    def iterate(self, loader: Iterable) -> Iterable:
+        """
+        Wraps a data loader, so the time waiting for every batch is measured
+
+        Args:
+            loader (Iterable): The data loader.
+
+        Returns:
+            Iterable: The batches of the loader.
+        """
+        if not self.enabled:
+            return loader
+
+        return self.timed_batches(loader)
+
+    def timed_batches(self, loader: Iterable) -> Iterator:
+        """
+        Yields the batches of a loader, measuring the time waiting for every one
+
+        Args:
+            loader (Iterable): The data loader.
+
+        Returns:
+            Iterator: The batches.
+        """
+        os.makedirs(self.output_dir, exist_ok = True)
+        if self.trace is not None:
+            self.trace.start()
+
+        iterator = iter(loader)
+        self.step_begin = time.perf_counter()
+
+        while True:
+            begin = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                break
+
+            self.current['data'] += time.perf_counter() - begin
+            yield batch
+
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+
+    def phase(self, name: str):
+        """
+        Context that measures a phase of the current step
+
+        Args:
+            name (str): Name of the phase (see PHASES).
+
+        Returns:
+            The context.
+        """
+        if not self.enabled:
+            return nullcontext()
+
+        return self.timed_phase(name)
+
+    @contextmanager
+    def timed_phase(self, name: str):
+        """
+        Measures a phase of the current step, waiting for the device before and after it
+
+        Args:
+            name (str): Name of the phase (see PHASES).
+        """
+        self.synchronize()
+        begin = time.perf_counter()
+
+        with torch.profiler.record_function(name):
+            yield
+
+        self.synchronize()
+        self.current[name] += time.perf_counter() - begin
+
+    def step(self, batch_size: int) -> None:
+        """
+        Ends the current step
+
+        Args:
+            batch_size (int): Number of images of the step.
+
+        Returns:
+            None
+        """
+        if not self.enabled:
+            return
+
+        end = time.perf_counter()
+
+        self.current['total'] = end - self.step_begin
+        self.steps.append(self.current)
+        self.samples += batch_size
+
+        self.current = dict.fromkeys(PHASES, 0.0)
+        self.step_begin = end
+
+        if self.trace is not None:
+            self.trace.step()
+
+    def summary(self) -> dict:
+        """
+        Summarizes the steps measured so far
+
+        Returns:
+            dict: Steps, images per second, and total, mean, median, 90th percentile (seconds)
+            and share of the step time of every phase. "bound" tells whether waiting for the
+            data loader takes longer than the rest of the step ("input") or not ("compute").
+        """
+        totals = np.array([ step['total'] for step in self.steps ])
+        total_time = float(totals.sum())
+
+        phases = {}
+        for name in PHASES + ('other',):
+            if name == 'other':
+                times = totals - np.array([ sum(step[phase] for phase in PHASES) for step in self.steps ])
+            else:
+                times = np.array([ step[name] for step in self.steps ])
+
+            phases[name] = {
+                'total': float(times.sum()),
+                'mean': float(times.mean()),
+                'p50': float(np.percentile(times, 50)),
+                'p90': float(np.percentile(times, 90)),
+                'share': float(times.sum() / total_time) if total_time > 0 else 0.0
+            }
+
+        return {
+            'name': self.name,
+            'device': self.device,
+            'steps': len(self.steps),
+            'samples': self.samples,
+            'time': total_time,
+            'samples_per_second': self.samples / total_time if total_time > 0 else 0.0,
+            'bound': 'input' if phases['data']['share'] > 0.5 else 'compute',
+            'phases': phases
+        }
+
+    def finish(self) -> dict:
+        """
+        Writes the summary (JSON) and every step (CSV) of the loop
+
+        Returns:
+            dict: The summary (None if disabled or nothing was measured).
+        """
+        if not (self.enabled and self.steps):
+            return None
+
+        summary = self.summary()
+
+        with open(os.path.join(self.output_dir, self.name + '.json'), 'w') as file:
+            json.dump(summary, file, indent = 4)
+
+        with open(os.path.join(self.output_dir, self.name + '.csv'), 'w', newline = '') as file:
+            writer = csv.writer(file)
+            writer.writerow(('step',) + PHASES + ('total',))
+            for idx, step in enumerate(self.steps):
+                writer.writerow([idx] + [ '%.6f' % step[phase] for phase in PHASES + ('total',) ])
+
+        print('Profile: %.1f images/s, %s-bound (data %.0f%%, forward %.0f%%, backward %.0f%%, optimizer %.0f%%) -> %s'
+              % (summary['samples_per_second'], summary['bound'], *(100 * summary['phases'][phase]['share'] for phase in ('data', 'forward', 'backward', 'optimizer')),
+                 os.path.join(self.output_dir, self.name + '.json')))
+
+        return summary
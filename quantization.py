@@ -0,0 +1,205 @@
+# PyTorch
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from torch.utils.data import DataLoader, Dataset, Subset
+
+# Prediction loop
+from train import predict
+
+# Utils
+from utils import compute_stats
+import numpy as np
+
+# Others
+import copy
+import time
+from typing import Callable
+
+# Models dominated by fully connected layers, quantized dynamically
+DYNAMIC_MODELS = ('alexnet', 'lenet', 'vit')
+
+# Modes of quantize_model
+QUANTIZATION_MODES = ('dynamic', 'static', 'auto')
+
+def quantization_backend() -> str:
+    """
+    Returns the quantized kernels available on this CPU (x86 or ARM)
+
+    Returns:
+        str: The quantization engine.
+    """
+    engines = torch.backends.quantized.supported_engines
+
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            return engine
+
+    return engines[0]
+
+def is_quantized(model: nn.Module) -> bool:
+    """
+    Returns whether a model has quantized layers (which only run on the CPU)
+
+    Args:
+        model (nn.Module): The model.
+
+    Returns:
+        bool: True if quantized.
+    """
+    return any(module.__module__.startswith('torch.ao.nn.quantized') for module in model.modules())
+
+def calibration_subset(dataset: Dataset, n_images: int, seed: int = 0) -> Dataset:
+    """
+    Returns a fixed random slice of a dataset used to calibrate static quantization
+
+    Args:
+        dataset (Dataset): The dataset (usually the training set, with the test transforms).
+        n_images (int): Number of images.
+        seed (int, optional): Seed of the slice. Defaults to 0.
+
+    Returns:
+        Dataset: The slice.
+    """
+    n_images = min(n_images, len(dataset))
+    indices = np.sort(np.random.default_rng(seed).choice(len(dataset), n_images, replace = False))
+
+    return Subset(dataset, indices.tolist())
+
+def quantize_static(model: nn.Module, calibration_loader: DataLoader, batch_transform: Callable = None) -> nn.Module:
+    """
+    Post-training static int8 quantization (FX graph mode): observers record the range of the
+    activations over the calibration batches, then weights and activations are converted to int8.
+
+    Args:
+        model (nn.Module): The float model (on the CPU).
+        calibration_loader (DataLoader): Batches used to calibrate the activation ranges.
+        batch_transform (Callable, optional): Transform applied to every batch (e.g. normalization). Defaults to None.
+
+    Returns:
+        nn.Module: The quantized model.
+    """
+    torch.backends.quantized.engine = quantization_backend()
+
+    inputs, _ = next(iter(calibration_loader))
+    inputs = batch_transform(inputs) if batch_transform is not None else inputs
+
+    prepared = prepare_fx(copy.deepcopy(model).eval(), get_default_qconfig_mapping(torch.backends.quantized.engine), (inputs,))
+
+    with torch.no_grad():
+        for inputs, _ in calibration_loader:
+            prepared(batch_transform(inputs) if batch_transform is not None else inputs)
+
+    return convert_fx(prepared)
+
+def quantize_model(model: nn.Module, model_name: str, mode: str = 'auto', calibration_loader: DataLoader = None, batch_transform: Callable = None) -> nn.Module:
+    """
+    Quantizes a model to int8 for CPU inference.
+    Dynamic quantization converts the weights of the Linear layers and quantizes their inputs on the fly, which
+    suits models dominated by fully connected layers (AlexNet classifier, ViT encoder). Static quantization also
+    converts the convolutions and needs a calibration pass, which suits the convolutional networks.
+
+    Args:
+        model (nn.Module): The float model.
+        model_name (str): The name of the model.
+        mode (str, optional): 'dynamic', 'static' or 'auto' (dynamic for AlexNet, LeNet and ViT, static otherwise). Defaults to 'auto'.
+        calibration_loader (DataLoader, optional): Calibration batches, required by static quantization. Defaults to None.
+        batch_transform (Callable, optional): Transform applied to every calibration batch. Defaults to None.
+
+    Raises:
+        TypeError: The given model is not a nn.Module
+        ValueError: The given mode is not available
+        ValueError: Static quantization without calibration batches
+
+    Returns:
+        nn.Module: The quantized model (on the CPU, the float model is not modified).
+    """
+    if not isinstance(model, nn.Module): raise TypeError('"model" must be a nn.Module')
+    if mode not in QUANTIZATION_MODES: raise ValueError('"mode" must be one of %s' % ', '.join(QUANTIZATION_MODES))
+
+    if mode == 'auto':
+        mode = 'dynamic' if model_name.startswith(DYNAMIC_MODELS) else 'static'
+
+    model = copy.deepcopy(model).cpu().eval()
+
+    if mode == 'dynamic':
+        torch.backends.quantized.engine = quantization_backend()
+        return quantize_dynamic(model, {nn.Linear}, dtype = torch.qint8)
+
+    if calibration_loader is None: raise ValueError('Static quantization requires calibration batches.')
+
+    return quantize_static(model, calibration_loader, batch_transform)
+
+def measure_latency(model: nn.Module, inputs: torch.Tensor, repeats: int = 10) -> float:
+    """
+    Measures the mean time of a forward pass on the CPU
+
+    Args:
+        model (nn.Module): The model.
+        inputs (torch.Tensor): A batch.
+        repeats (int, optional): Number of forward passes measured. Defaults to 10.
+
+    Returns:
+        float: Seconds per forward pass.
+    """
+    model.eval()
+
+    with torch.no_grad():
+
+        # Warm up
+        model(inputs)
+
+        begin = time.perf_counter()
+        for _ in range(repeats):
+            model(inputs)
+
+    return (time.perf_counter() - begin) / repeats
+
+def compare_quantized(float_model: nn.Module, quantized_model: nn.Module, model_name: str, testloader: DataLoader, batch_transform: Callable = None, tta: Callable = None) -> dict:
+    """
+    Evaluates the float and the quantized models on the CPU and prints their accuracy,
+    balanced accuracy and latency side by side
+
+    Args:
+        float_model (nn.Module): The float model.
+        quantized_model (nn.Module): The quantized model.
+        model_name (str): The name of the model.
+        testloader (DataLoader): Test data loader.
+        batch_transform (Callable, optional): Transform applied to every batch. Defaults to None.
+        tta (Callable, optional): Test-time augmentation of both models (see batch_transforms.TestTimeAugment). Defaults to None.
+
+    Returns:
+        dict: Accuracy, balanced accuracy, latency of a batch (seconds) and images per second of
+        both models ('float' and 'int8'), and the predictions of the quantized model ('predictions').
+    """
+    inputs, _ = next(iter(testloader))
+    inputs = batch_transform(inputs) if batch_transform is not None else inputs
+    inputs = tta(inputs) if tta is not None else inputs
+
+    report = {}
+    for name, model in (('float', float_model.cpu()), ('int8', quantized_model)):
+
+        begin = time.perf_counter()
+        true_labels, predicted_labels, probabilities = predict('cpu', model, model_name, testloader, batch_transform = batch_transform, tta = tta)
+        elapsed = time.perf_counter() - begin
+
+        report[name] = {
+            'accuracy': 100. * float((true_labels == predicted_labels).mean()),
+            'bac': float(compute_stats(true_labels, predicted_labels, probabilities)[3]),
+            'latency': measure_latency(model, inputs),
+            'images_per_second': len(true_labels) / elapsed
+        }
+
+    # Predictions of the quantized model (the last one evaluated)
+    report['predictions'] = (true_labels, predicted_labels, probabilities)
+
+    print('%-6s %-10s %-10s %-18s %s' % ('Model', 'Acc (%)', 'BAC', 'Batch latency (ms)', 'Images/s'))
+    for name in ('float', 'int8'):
+        print('%-6s %-10.3f %-10.4f %-18.2f %.1f' % (name, report[name]['accuracy'], report[name]['bac'], 1000 * report[name]['latency'], report[name]['images_per_second']))
+
+    print('Delta: accuracy %+.3f points, BAC %+.4f, latency x%.2f faster'
+          % (report['int8']['accuracy'] - report['float']['accuracy'], report['int8']['bac'] - report['float']['bac'],
+             report['float']['latency'] / report['int8']['latency']))
+
+    return report
@@ -0,0 +1,149 @@
+# PyTorch
+from torch.utils.data import Sampler
+
+# Utils
+import numpy as np
+
+# Others
+from typing import Iterator
+
+class StratifiedBudgetSampler(Sampler):
+    def __init__(self, labels: np.ndarray, patients: np.ndarray, budget: int, growth: float = 1.0, balance_classes: bool = False, seed: int = 0,
+                 rank: int = 0, world_size: int = 1) -> None:
+        """
+        Samples a fixed number of images per epoch, stratified by class and patient.
+        Images are grouped by (class, patient) once. Every epoch, each group gets a quota of the budget
+        in proportion to its weight (largest remainder rounding, so quotas add up to the budget), and
+        its quota is drawn without replacement, so no image is repeated within an epoch.
+
+        Args:
+            labels (np.ndarray): Label of every image of the dataset.
+            patients (np.ndarray): Patient id of every image of the dataset.
+            budget (int): Number of images drawn in the first epoch.
+            growth (float, optional): Factor applied to the budget after every epoch. Defaults to 1.0.
+            balance_classes (bool, optional): Whether both classes get the same share of the budget (as far as the
+            smaller class has images). Otherwise every group gets a share proportional to its size. Defaults to False.
+            seed (int, optional): Seed of the draws, combined with the epoch. It must be the same in every process. Defaults to 0.
+            rank (int, optional): Rank of this process. Every process draws the same images and keeps every world_size-th one. Defaults to 0.
+            world_size (int, optional): Number of processes. Every process gets budget // world_size images. Defaults to 1.
+
+        Raises:
+            TypeError: The given labels are not a np.ndarray
+            TypeError: The given patients are not a np.ndarray
+            TypeError: The given budget is not an integer
+            TypeError: The given growth is not a float
+            ValueError: The labels and patients have different lengths
+        """
+        if not isinstance(labels, np.ndarray): raise TypeError('"labels" must be a np.ndarray.')
+        if not isinstance(patients, np.ndarray): raise TypeError('"patients" must be a np.ndarray.')
+        if not isinstance(budget, int): raise TypeError('"budget" must be an integer.')
+        if not isinstance(growth, float): raise TypeError('"growth" must be a float.')
+        if len(labels) != len(patients): raise ValueError('"labels" and "patients" must have the same length.')
+
+        self.data_len = len(labels)
+        self.budget = budget
+        self.growth = growth
+        self.seed = seed
+        self.epoch = 0
+        self.rank = rank
+        self.world_size = world_size
+
+        # Images sorted by group, every group is a contiguous slice of "order"
+        keys = labels.astype(np.int64) * (int(patients.max()) + 2) + (patients.astype(np.int64) + 1)
+        self.order = np.argsort(keys, kind = 'stable')
+
+        groups, self.starts, self.counts = np.unique(keys[self.order], return_index = True, return_counts = True)
+
+        # Group of every position of "order"
+        self.group_ids = np.repeat(np.arange(len(self.counts)), self.counts)
+
+        weights = self.counts.astype(np.float64)
+
+        if balance_classes:
+
+            # Every class gets half of the budget, shared by its groups in proportion to their size
+            group_labels = labels[self.order[self.starts]]
+            for label in np.unique(group_labels):
+                weights[group_labels == label] /= weights[group_labels == label].sum()
+
+        self.weights = weights / weights.sum()
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Sets the epoch, which decides the budget and the draws
+
+        Args:
+            epoch (int): Current epoch number.
+
+        Returns:
+            None
+        """
+        self.epoch = epoch
+
+    def epoch_budget(self) -> int:
+        """
+        Returns the number of images drawn in the current epoch
+
+        Returns:
+            int: The budget.
+        """
+        return min(self.data_len, int(self.budget * self.growth**self.epoch))
+
+    def group_quotas(self, budget: int) -> np.ndarray:
+        """
+        Splits a budget between the groups in proportion to their weights, with largest remainder rounding.
+        A group never gets more images than it has, the rest goes to the other groups.
+
+        Args:
+            budget (int): Number of images (at most the size of the dataset).
+
+        Returns:
+            np.ndarray: Number of images drawn from every group.
+        """
+        shares = self.weights * budget
+        quotas = np.minimum(np.floor(shares).astype(np.int64), self.counts)
+
+        left = budget - int(quotas.sum())
+        while left > 0:
+
+            # Images left go to the groups with the largest remainders among those with images left
+            room = quotas < self.counts
+            remainders = np.where(room, shares - quotas, -np.inf)
+            chosen = np.argsort(-remainders, kind = 'stable')[:min(left, int(room.sum()))]
+
+            quotas[chosen] += 1
+            left -= len(chosen)
+
+        return quotas
+
+    def __iter__(self) -> Iterator[int]:
+        """
+        Draws the images of the current epoch
+
+        Returns:
+            Iterator: The indices of the images.
+        """
+        rng = np.random.default_rng(self.seed + self.epoch)
+        budget = self.epoch_budget()
+
+        # Random order inside every group, of which the first quota images are kept (no image twice)
+        positions = np.lexsort((rng.random(self.data_len), self.group_ids))
+        ranks = np.arange(self.data_len) - self.starts[self.group_ids]
+        indices = self.order[positions[ranks < self.group_quotas(budget)[self.group_ids]]]
+
+        # Groups are mixed in the batches
+        indices = rng.permutation(indices)
+
+        # Share of this process, the same number of images in every process
+        indices = indices[:len(self) * self.world_size][self.rank::self.world_size]
+
+        return iter(indices.tolist())
+
+    def __len__(self) -> int:
+        """
+        Returns the number of images drawn by this process in the current epoch
+
+        Returns:
+            int: The share of the budget of this process.
+        """
+        return self.epoch_budget() // self.world_size
@@ -0,0 +1,176 @@
+# Image libraries
+from PIL import Image
+
+# Utils
+import numpy as np
+from checkpoint import atomic_save
+
+# Others
+import hashlib
+import json
+import os
+from multiprocessing import Pool
+from typing import Tuple
+
+# Mean and standard deviation of every channel of the training data (images in [0, 1]).
+# Used when the statistics of a dataset have not been computed.
+NORM_MEAN = (0.7595, 0.5646, 0.6882)
+NORM_STD = (0.1497, 0.1970, 0.1428)
+
+def merge_stats(stats_a: Tuple[int, np.ndarray, np.ndarray], stats_b: Tuple[int, np.ndarray, np.ndarray]) -> Tuple[int, np.ndarray, np.ndarray]:
+    """
+    Merges the running statistics of two disjoint sets of pixels (Chan et al. parallel variance).
+
+    Args:
+        stats_a (tuple): Number of pixels, mean and sum of squared deviations of every channel of the first set.
+        stats_b (tuple): Number of pixels, mean and sum of squared deviations of every channel of the second set.
+
+    Returns:
+        int: The number of pixels of both sets.
+        np.ndarray: The mean of every channel.
+        np.ndarray: The sum of squared deviations from the mean of every channel.
+    """
+    n_a, mean_a, m2_a = stats_a
+    n_b, mean_b, m2_b = stats_b
+
+    if n_a == 0:
+        return stats_b
+    if n_b == 0:
+        return stats_a
+
+    n = n_a + n_b
+    delta = mean_b - mean_a
+
+    return n, mean_a + delta * n_b / n, m2_a + m2_b + delta**2 * n_a * n_b / n
+
+
+def image_stats(pixels: np.ndarray) -> Tuple[int, np.ndarray, np.ndarray]:
+    """
+    Computes the statistics of the pixels of an image
+
+    Args:
+        pixels (np.ndarray): The uint8 image (H x W x C)
+
+    Returns:
+        int: The number of pixels.
+        np.ndarray: The mean of every channel.
+        np.ndarray: The sum of squared deviations from the mean of every channel.
+    """
+    pixels = pixels.reshape(-1, pixels.shape[-1]).astype(np.float64) / 255
+    mean = pixels.mean(axis = 0)
+
+    return pixels.shape[0], mean, ((pixels - mean)**2).sum(axis = 0)
+
+
+def chunk_stats(args: tuple) -> Tuple[int, np.ndarray, np.ndarray]:
+    """
+    Computes the statistics of a chunk of a dataset (run in a worker process)
+
+    Args:
+        args (tuple): Path to the images or packed store, whether it is packed, and the chunk
+        (start and end indices of a packed store, or a list of file names).
+
+    Returns:
+        int: The number of pixels.
+        np.ndarray: The mean of every channel.
+        np.ndarray: The sum of squared deviations from the mean of every channel.
+    """
+    data_dir, packed, chunk = args
+
+    stats = (0, np.zeros(3), np.zeros(3))
+
+    if packed:
+        images = np.load(os.path.join(data_dir, 'images.npy'), mmap_mode = 'r')
+        for idx in range(*chunk):
+            stats = merge_stats(stats, image_stats(images[idx]))
+
+    else:
+        for name in chunk:
+            with Image.open(os.path.join(data_dir, name)) as img:
+                stats = merge_stats(stats, image_stats(np.asarray(img.convert('RGB'))))
+
+    return stats
+
+
+def dataset_stats(data_dir: str, num_workers: int = None, chunk_size: int = 2048) -> Tuple[tuple, tuple]:
+    """
+    Computes the exact mean and standard deviation of every channel of a dataset in a single pass.
+    The dataset is split in chunks that are processed in parallel, and the results are merged
+    with a numerically stable update. Results are cached, keyed by the dataset manifest.
+
+    Args:
+        data_dir (str): Path to the images or to a packed store.
+        num_workers (int, optional): Number of worker processes. Defaults to the number of cpus.
+        chunk_size (int, optional): Number of images per chunk. Defaults to 2048.
+
+    Raises:
+        TypeError: The given path is not a string
+        TypeError: The given number of workers is not an integer
+        OSError: Path to images not found
+        ValueError: The given path is a directory of tar shards, or has no images
+
+    Returns:
+        tuple: The mean of every channel.
+        tuple: The standard deviation of every channel.
+    """
+    # Imported here, dataset.py uses the default statistics of this module
+    from dataset import CACHE_DIR, is_packed, is_sharded, load_manifest
+
+    if not isinstance(data_dir, str): raise TypeError('"data_dir" must be a str.')
+    if not (num_workers is None or isinstance(num_workers, int)): raise TypeError('"num_workers" must be an integer or None.')
+    if not os.path.isdir(data_dir): raise OSError ('Directory not found')
+    if is_sharded(data_dir): raise ValueError('Statistics are not available for tar shards, use the directory of images or the packed store they were written from.')
+
+    packed = is_packed(data_dir)
+
+    if packed:
+        names = np.load(os.path.join(data_dir, 'names.npy'))
+        key = hashlib.sha1(names.tobytes()).hexdigest()[:16]
+        chunks = [ (start, min(start + chunk_size, len(names))) for start in range(0, len(names), chunk_size) ]
+
+    else:
+        manifest, names = load_manifest(data_dir)
+        key = hashlib.sha1(manifest.tobytes() + names.tobytes()).hexdigest()[:16]
+        image_list = [ names[offset:offset + length].tobytes().decode() for offset, length in zip(manifest['offset'], manifest['length']) ]
+        chunks = [ image_list[start:start + chunk_size] for start in range(0, len(image_list), chunk_size) ]
+
+    file = os.path.join(CACHE_DIR, 'stats_' + key + '.json')
+
+    if not chunks: raise ValueError('No images found in "%s".' % data_dir)
+
+    if os.path.isfile(file):
+        with open(file) as cached:
+            cached = json.load(cached)
+        return tuple(cached['mean']), tuple(cached['std'])
+
+    stats = (0, np.zeros(3), np.zeros(3))
+
+    with Pool(num_workers) as pool:
+        for chunk in pool.imap_unordered(chunk_stats, [ (data_dir, packed, chunk) for chunk in chunks ]):
+            stats = merge_stats(stats, chunk)
+
+    n, mean, m2 = stats
+    mean, std = tuple(float(value) for value in mean), tuple(float(value) for value in np.sqrt(m2 / n))
+
+    os.makedirs(CACHE_DIR, exist_ok = True)
+    atomic_save(json.dumps({'data_dir': os.path.abspath(data_dir), 'pixels': n, 'mean': mean, 'std': std}, indent = 4).encode(), file)
+
+    return mean, std
+
+
+def checkpoint_stats(state: dict) -> Tuple[tuple, tuple]:
+    """
+    Returns the statistics the model of a checkpoint was trained with
+
+    Args:
+        state (dict): The checkpoint, or None.
+
+    Returns:
+        tuple: The mean of every channel (NORM_MEAN for checkpoints saved without statistics).
+        tuple: The standard deviation of every channel (NORM_STD for checkpoints saved without statistics).
+    """
+    if state is None or 'mean' not in state:
+        return NORM_MEAN, NORM_STD
+
+    return tuple(state['mean']), tuple(state['std'])
+
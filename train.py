@@ -3,14 +3,36 @@ import torch
 import torch.nn.functional as F
 
 #Utils
-from utils import progress_bar
+from checkpoint import atomic_save
+from distributed import all_reduce_sum, is_main_process
+from profiler import StepProfiler
+from utils import layout_neutral_state_dict, progress_bar
+import math
+import numpy as np
 import os
 
 # Others
-from typing import Tuple
+import io
+from contextlib import nullcontext
+from typing import Callable, Tuple
+
+def autocast(device: str, amp_dtype: torch.dtype) -> torch.autocast:
+    """
+    Mixed precision context for the forward pass
+
+    Args:
+        device (str): Device to use (CPU or GPU).
+        amp_dtype (torch.dtype): Type used by autocast. None disables it.
+
+    Returns:
+        torch.autocast: The autocast context.
+    """
+    return torch.autocast(device_type = device.split(':')[0], dtype = amp_dtype, enabled = amp_dtype is not None)
 
 # Training function
-def train(criterion: torch.nn.modules.loss.BCEWithLogitsLoss, device: str, epoch: int, model: torch.nn.Module, model_name: str,  optimizer: torch.optim.Optimizer, scheduler: torch.optim.lr_scheduler.ExponentialLR, trainloader: torch.utils.data.DataLoader) -> None:
+def train(criterion: torch.nn.modules.loss.BCEWithLogitsLoss, device: str, epoch: int, model: torch.nn.Module, model_name: str,  optimizer: torch.optim.Optimizer, scheduler: torch.optim.lr_scheduler.ExponentialLR, trainloader: torch.utils.data.DataLoader,
+          batch_transform: Callable = None, amp_dtype: torch.dtype = None, scaler: torch.cuda.amp.GradScaler = None, log_interval: int = 50,
+          accumulation_steps: int = 1, profiler: StepProfiler = None) -> None:
     """
     Trains the model for 1 epoch
 
@@ -24,6 +46,15 @@ def train(criterion: torch.nn.modules.loss.BCEWithLogitsLoss, device: str, epoch
         optimizer (torch.optim): Optimizer to use.
         scheduler (torch.optim.lr_scheduler.ExponentialLR): Learning rate scheduler. Only ExponentialLR is used. You may modify the code if you want.
         trainloader (torch.utils.data.DataLoader): Training data loader.
+        batch_transform (Callable, optional): Transform applied to every batch once it is on the device
+        (e.g. batch_transforms.BatchAugment). Defaults to None.
+        amp_dtype (torch.dtype, optional): Type used by autocast in the forward pass (torch.bfloat16 or torch.float16). None means float32. Defaults to None.
+        scaler (torch.cuda.amp.GradScaler, optional): Loss scaler, required to train in float16. Defaults to None.
+        log_interval (int, optional): Number of steps between reads of the running loss and accuracy from the device.
+        Every read waits for the device, so they are also read at the end of the epoch only. Defaults to 50.
+        accumulation_steps (int, optional): Number of micro-batches whose gradients are accumulated before every optimizer step.
+        The effective batch size is accumulation_steps times the loader batch size. Defaults to 1.
+        profiler (StepProfiler, optional): Profiler timing the phases of every (micro-batch) step. Defaults to None.
 
     Raises:
         TypeError: The given loss function is not a function
@@ -33,6 +64,10 @@ def train(criterion: torch.nn.modules.loss.BCEWithLogitsLoss, device: str, epoch
         TypeError: The given optimizer is not a learning rate optimizer
         TypeError: The given scheduler is not a learning rate scheduler
         TypeError: The given trainloader is not DataLoader.
+        TypeError: The given batch transform is not callable.
+        TypeError: The given autocast type is not a torch.dtype
+        TypeError: The given log interval is not an integer
+        ValueError: The given number of accumulation steps is not a positive integer
     
     Returns:
         None
@@ -46,204 +81,382 @@ def train(criterion: torch.nn.modules.loss.BCEWithLogitsLoss, device: str, epoch
     if not isinstance(optimizer, torch.optim.Optimizer): raise TypeError('"optimizer" must be a torch.optim.Optimizer.')
     if not isinstance(scheduler, torch.optim.lr_scheduler.ExponentialLR): raise TypeError('"scheduler" must be a torch.optim.lr_scheduler.')
     if not isinstance(trainloader, torch.utils.data.DataLoader): raise TypeError('"trainloader" must be a torch.utils.data.DataLoader')
+    if not (batch_transform is None or callable(batch_transform)): raise TypeError('"batch_transform" must be callable or None')
+    if not (amp_dtype is None or isinstance(amp_dtype, torch.dtype)): raise TypeError('"amp_dtype" must be a torch.dtype or None')
+    if not isinstance(log_interval, int): raise TypeError('"log_interval" must be an integer.')
+    if not (isinstance(accumulation_steps, int) and accumulation_steps > 0): raise ValueError('"accumulation_steps" must be a positive integer.')
+
+    # A disabled profiler does nothing
+    profiler = profiler or StepProfiler('', device, enabled = False)
     
     print('-------=| Epoch %d |=-------' % epoch)
 
     # Set model to train
     model.train()
 
-    train_loss = 0
-    correct = 0
+    # Running loss and correct predictions stay on the device, so no step waits for it
+    train_loss = torch.zeros((), device = device)
+    correct = torch.zeros((), dtype = torch.int64, device = device)
     total = 0
 
-    for batch_idx, (inputs, labels) in enumerate(trainloader):
+    n_batches = len(trainloader)
 
-        inputs, labels = inputs.to(device), labels.to(device)
-        labels = labels.float()
+    # Optimizer steps in the epoch
+    n_steps = math.ceil(n_batches / accumulation_steps)
 
-        # Reset gradient
-        optimizer.zero_grad()
-        
-        # Forward pass
-        outputs = model(inputs)[:,:1].squeeze(1)
+    for batch_idx, (inputs, labels) in enumerate(profiler.iterate(trainloader)):
 
-        # Loss function
-        loss = criterion(outputs, labels)
+        step_idx, micro_idx = divmod(batch_idx, accumulation_steps)
 
-        # Backward and optimize
-        loss.backward()
-        optimizer.step()
+        # Micro-batches of this optimizer step (the last step of the epoch may have fewer)
+        group_size = max(1, min(accumulation_steps, n_batches - step_idx * accumulation_steps))
+
+        with profiler.phase('h2d'):
+            inputs, labels = inputs.to(device, non_blocking = True), labels.to(device, non_blocking = True)
+            labels = labels.float()
+
+        # Batched data augmentation
+        if batch_transform is not None:
+            with profiler.phase('transform'):
+                inputs = batch_transform(inputs)
+
+        # Reset gradient
+        if micro_idx == 0:
+            optimizer.zero_grad()
+        
+        # Forward pass (in lower precision with mixed precision)
+        with profiler.phase('forward'):
+            with autocast(device, amp_dtype):
+                outputs = model(inputs)[:,:1].squeeze(1)
+
+            # Loss function, always in float32
+            loss = criterion(outputs.float(), labels)
+
+        # Accumulated gradients are the mean over the micro-batches of the step
+        scaled_loss = loss / group_size
+
+        # Distributed gradients are only averaged across processes on the last micro-batch
+        last_micro = micro_idx == group_size - 1
+        sync = nullcontext() if last_micro or not hasattr(model, 'no_sync') else model.no_sync()
+
+        # Backward (scaled, so float16 gradients do not underflow)
+        with sync, profiler.phase('backward'):
+            if scaler is not None:
+                scaler.scale(scaled_loss).backward()
+            else:
+                scaled_loss.backward()
+
+        # Optimize once every micro-batch of the step has been processed
+        if last_micro:
+            with profiler.phase('optimizer'):
+                if scaler is not None:
+                    scaler.step(optimizer)
+                    scaler.update()
+                else:
+                    optimizer.step()
 
         # Accumulate loss
-        train_loss += loss.item()
+        train_loss += loss.detach()
 
         # Get predicted output
         probs = torch.sigmoid(outputs) > 0.5
-        correct += probs.eq(labels).sum().item()
+        correct += probs.eq(labels).sum()
         total += labels.size(0)
         
-        # Update progress bar
-        progress_bar(batch_idx, len(trainloader), 'Loss: %.3f | Acc: %.3f%% (%d/%d)'
-                    % (train_loss/(batch_idx+1), 100.*correct/total, correct, total))
+        # Update progress bar in optimizer steps (reading the metrics waits for the device)
+        if last_micro and (step_idx == 0 or (step_idx + 1) % log_interval == 0 or step_idx == n_steps - 1):
+            n_correct = int(correct)
+            progress_bar(step_idx, n_steps, 'Loss: %.3f | Acc: %.3f%% (%d/%d)'
+                        % (float(train_loss)/(batch_idx+1), 100.*n_correct/total, n_correct, total))
+
+        profiler.step(labels.size(0))
       
     # Decay Learning Rate
     scheduler.step()
+
+    profiler.finish()
     
     return
 
 
-def test(best_acc: float, criterion: torch.nn.modules.loss.BCEWithLogitsLoss, device: str, epoch: int, file_name: str, model: torch.nn.Module, model_name: str, testloader: torch.utils.data.DataLoader) -> Tuple[float, list]:
+def evaluate(criterion: torch.nn.modules.loss.BCEWithLogitsLoss, device: str, model: torch.nn.Module, model_name: str, testloader: torch.utils.data.DataLoader,
+             batch_transform: Callable = None, amp_dtype: torch.dtype = None, log_interval: int = 50, profiler: StepProfiler = None) -> float:
     """
-    Test the model
+    Computes the accuracy of the model on the test set
 
     Args:
-        best_acc (float): Best accuracy obtained previously.
         criterion (torch.nn.modules.loss.BCEWithLogitsLoss): Loss function. Since in this code only uses the BCEWithLogitsLoss, no other loss function is allowed.
         You may modify the code if you need.
         device (str): Device to use (CPU or GPU).
-        epoch (int): Current epoch number.
-        file_name (str): Name of the file where the model weights will be stored.
         model (torch.nn.Module): Model to test.
         model_name (str): Name of the model
         testloader (torch.utils.data.DataLoader): Test data loader.
+        batch_transform (Callable, optional): Transform applied to every batch once it is on the device
+        (e.g. batch_transforms.BatchNormalize). Defaults to None.
+        amp_dtype (torch.dtype, optional): Type used by autocast in the forward pass. None means float32. Defaults to None.
+        log_interval (int, optional): Number of steps between reads of the running loss and accuracy from the device. Defaults to 50.
+        When distributed, the progress bar shows the shard of the first process and the accuracy returned is the one of the whole test set.
+        profiler (StepProfiler, optional): Profiler timing the phases of every step. Defaults to None.
 
     Raises:
-        TypeError: The given best accuracy is not a float number
         TypeError: The given loss function is not a function
         TypeError: The given device is not a string
-        TypeError: The given epoch number is not a integer
-        TypeError: The given file name is not a string
         TypeError: The model is not a nn.Module
         TypeError: The given model name is not a string
         TypeError: The given testloader is not DataLoader
-    
+        TypeError: The given batch transform is not callable.
+        TypeError: The given autocast type is not a torch.dtype
+        TypeError: The given log interval is not an integer
+
     Returns:
         float: The accuracy of the model
-        list: The accuracy of the model per class
-    """    
-    if not isinstance(best_acc, float): raise TypeError('"best_acc" must be a float.')
+    """
     if not isinstance(criterion, torch.nn.modules.loss.BCEWithLogitsLoss): raise TypeError('"criterion" must be a loss function.')
     if not isinstance(device, str): raise TypeError('"device" must be a str (CPU or GPU).')
-    if not isinstance(epoch, int): raise TypeError('"epoch" must be an integer.')
-    if not isinstance(file_name, str): raise TypeError('"file_name" must be a string.')
     if not isinstance(model, torch.nn.Module): raise TypeError('"model" must be a torch.nn.Module.')
     if not isinstance(model_name, str): raise TypeError('"model_name" must be a string.')
     if not isinstance(testloader, torch.utils.data.DataLoader): raise TypeError('"testloader" must be a torch.utils.data.DataLoader')
+    if not (batch_transform is None or callable(batch_transform)): raise TypeError('"batch_transform" must be callable or None')
+    if not (amp_dtype is None or isinstance(amp_dtype, torch.dtype)): raise TypeError('"amp_dtype" must be a torch.dtype or None')
+    if not isinstance(log_interval, int): raise TypeError('"log_interval" must be an integer.')
+
+    # A disabled profiler does nothing
+    profiler = profiler or StepProfiler('', device, enabled = False)
 
     #Set model to evaluation
     model.eval()
 
-    test_loss = 0
-    correct = 0
+    # Running loss and correct predictions stay on the device, so no step waits for it
+    test_loss = torch.zeros((), device = device)
+    correct = torch.zeros((), dtype = torch.int64, device = device)
     total = 0
 
+    n_batches = len(testloader)
+
     # Disable gradients
     with torch.no_grad():
 
-        for batch_idx, (inputs, labels) in enumerate(testloader):
+        for batch_idx, (inputs, labels) in enumerate(profiler.iterate(testloader)):
 
-            inputs, labels = inputs.to(device), labels.to(device)
-            labels = labels.float()
+            with profiler.phase('h2d'):
+                inputs, labels = inputs.to(device, non_blocking = True), labels.to(device, non_blocking = True)
+                labels = labels.float()
+
+            # Batched transforms (e.g. normalization)
+            if batch_transform is not None:
+                with profiler.phase('transform'):
+                    inputs = batch_transform(inputs)
             
             # Forward pass
-            outputs = model(inputs)[:,:1].squeeze(1)
+            with profiler.phase('forward'):
+                with autocast(device, amp_dtype):
+                    outputs = model(inputs)[:,:1].squeeze(1)
 
-            # Loss function
-            loss = criterion(outputs, labels)
+                # Loss function, in float32
+                loss = criterion(outputs.float(), labels)
 
             # Accumulate test loss
-            test_loss += loss.item()
+            test_loss += loss
             
             # Get predicted output
             probs = torch.sigmoid(outputs) > 0.5
-            correct += probs.eq(labels).sum().item()
+            correct += probs.eq(labels).sum()
             total += labels.size(0)
             
+            # Reading the metrics waits for the device
+            if batch_idx == 0 or (batch_idx + 1) % log_interval == 0 or batch_idx == n_batches - 1:
+                n_correct = int(correct)
+                progress_bar(batch_idx, n_batches, 'Loss: %.3f | Acc: %.3f%% (%d/%d)'
+                            % (float(test_loss)/(batch_idx+1), 100.*n_correct/total, n_correct, total))
+
+            profiler.step(labels.size(0))
+
+    profiler.finish()
+
+    # Every process evaluates its own shard of the test set
+    n_correct, total = all_reduce_sum(correct, total)
+
+    return 100.*n_correct/total
+
+
+def save_checkpoint(model_state: dict, accuracy: float, epoch: int, file_name: str) -> None:
+    """
+    Saves the weights of the best model so far in ./pretrained/ (atomically, so an interrupted
+    save never leaves a truncated file). See checkpoint.CheckpointWriter to save in the background.
+
+    Args:
+        model_state (dict): State dict of the model (see utils.layout_neutral_state_dict).
+        accuracy (float): Test accuracy of the model.
+        epoch (int): Epoch the model was trained up to.
+        file_name (str): Name of the file where the model weights will be stored.
+
+    Returns:
+        None
+    """
+    print('Saving checkpoint...')
+    state = {
+        'model': model_state,
+        'accuracy': accuracy,
+        'epoch': epoch
+    }
+
+    if not os.path.isdir('pretrained'):
+        os.mkdir('pretrained')
+
+    buffer = io.BytesIO()
+    torch.save(state, buffer)
+    atomic_save(buffer.getvalue(), './pretrained/' + file_name + '.pth')
+
 
-            progress_bar(batch_idx, len(testloader), 'Loss: %.3f | Acc: %.3f%% (%d/%d)'
-                        % (test_loss/(batch_idx+1), 100.*correct/total, correct, total))
-   
+def test(best_acc: float, criterion: torch.nn.modules.loss.BCEWithLogitsLoss, device: str, epoch: int, file_name: str, model: torch.nn.Module, model_name: str, testloader: torch.utils.data.DataLoader,
+         batch_transform: Callable = None, amp_dtype: torch.dtype = None, log_interval: int = 50, save: bool = True, profiler: StepProfiler = None) -> Tuple[float, list]:
+    """
+    Test the model, and save it if it is better than the best model so far
+
+    Args:
+        best_acc (float): Best accuracy obtained previously.
+        criterion (torch.nn.modules.loss.BCEWithLogitsLoss): Loss function. Since in this code only uses the BCEWithLogitsLoss, no other loss function is allowed.
+        You may modify the code if you need.
+        device (str): Device to use (CPU or GPU).
+        epoch (int): Current epoch number.
+        file_name (str): Name of the file where the model weights will be stored.
+        model (torch.nn.Module): Model to test.
+        model_name (str): Name of the model
+        testloader (torch.utils.data.DataLoader): Test data loader.
+        batch_transform (Callable, optional): Transform applied to every batch once it is on the device
+        (e.g. batch_transforms.BatchNormalize). Defaults to None.
+        amp_dtype (torch.dtype, optional): Type used by autocast in the forward pass. None means float32. Defaults to None.
+        log_interval (int, optional): Number of steps between reads of the running loss and accuracy from the device. Defaults to 50.
+        When distributed, the progress bar shows the shard of the first process and the accuracy returned is the one of the whole test set.
+        save (bool, optional): Whether the weights are saved when the accuracy improves. Disable it when the caller
+        saves its own checkpoints (see checkpoint.CheckpointWriter). Defaults to True.
+        profiler (StepProfiler, optional): Profiler timing the phases of every step. Defaults to None.
 
-    # Save checkpoint.
-    acc = 100.*correct/total
-    if acc > best_acc:
-        print('Saving checkpoint...')
-        state = {
-            'model': model.state_dict(),
-            'accuracy': acc,
-            'epoch': epoch
-        }
+    Raises:
+        TypeError: The given best accuracy is not a float number
+        TypeError: The given epoch number is not a integer
+        TypeError: The given file name is not a string
+        See evaluate() for the other arguments.
+    
+    Returns:
+        float: The accuracy of the model
+    """    
+    if not isinstance(best_acc, float): raise TypeError('"best_acc" must be a float.')
+    if not isinstance(epoch, int): raise TypeError('"epoch" must be an integer.')
+    if not isinstance(file_name, str): raise TypeError('"file_name" must be a string.')
 
-        if not os.path.isdir('pretrained'):
-            os.mkdir('pretrained')
-        torch.save(state, './pretrained/' + file_name + '.pth')
+    acc = evaluate(criterion, device, model, model_name, testloader, batch_transform = batch_transform, amp_dtype = amp_dtype, log_interval = log_interval,
+                   profiler = profiler)
 
+    # Save checkpoint (only once when distributed)
+    if save and acc > best_acc and is_main_process():
+        save_checkpoint(layout_neutral_state_dict(model), acc, epoch, file_name)
 
     # Return this epoch's test loss, test accuracy and class accuracy
     # return test_loss / (batch_idx+1), acc, [100.0 * n_class_correct[i] / n_class_samples[i] for i in range(len(classes))]
     return acc
 
-def predict(device: str, model: torch.nn.Module, model_name: str, testloader: torch.utils.data.DataLoader) -> Tuple[list, list]:
+def predict(device: str, model: torch.nn.Module, model_name: str, testloader: torch.utils.data.DataLoader, batch_transform: Callable = None,
+            amp_dtype: torch.dtype = None, profiler: StepProfiler = None, log_interval: int = 50, tta: Callable = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
     Uses the model to classify the images in the given testloader.
+    Labels and probabilities are written into buffers on the device, sized from the dataset,
+    and only copied back once at the end.
 
     Args:
         device (str): Device to use (CPU or GPU)
         model (torch.nn.Module): The model to use for predicting
         testloader (torch.utils.data.DataLoader): Data loader
+        batch_transform (Callable, optional): Transform applied to every batch once it is on the device. Defaults to None.
+        amp_dtype (torch.dtype, optional): Type used by autocast in the forward pass. None means float32. Defaults to None.
+        profiler (StepProfiler, optional): Profiler timing the phases of every step. Defaults to None.
+        log_interval (int, optional): Number of steps between reads of the accuracy from the device. Defaults to 50.
+        tta (Callable, optional): Test-time augmentation (see batch_transforms.TestTimeAugment). Every batch is expanded into its views and their logits are averaged. Defaults to None.
 
     Raises:
         TypeError: The given dice is not a str
         TypeError: The given model is not a torch.nn.Module
         TypeError: The given testloader is not a torch.utisl.data.DataLoader
+        TypeError: The given batch transform is not callable.
+        TypeError: The given autocast type is not a torch.dtype
+        TypeError: The given log interval is not an integer
+        TypeError: The given test-time augmentation has no reduce method
 
     Returns:
-        list: The true labels of the images.
-        list: The predicted labels of the images.
+        np.ndarray: The true labels of the images.
+        np.ndarray: The predicted labels of the images.
+        np.ndarray: The predicted probabilities of the images.
     """    
 
     if not isinstance(device, str): raise TypeError('"device" must be a string (CPU or GPU).')
     if not isinstance(model, torch.nn.Module): raise TypeError('"model" must be a torch.nn.Module.')
     if not isinstance(model_name, str): raise TypeError('"model_name" must be a string.')
     if not isinstance(testloader, torch.utils.data.DataLoader): raise TypeError('"testloader" must be a torch.utils.data.DataLoader')
+    if not (batch_transform is None or callable(batch_transform)): raise TypeError('"batch_transform" must be callable or None')
+    if not (amp_dtype is None or isinstance(amp_dtype, torch.dtype)): raise TypeError('"amp_dtype" must be a torch.dtype or None')
+    if not isinstance(log_interval, int): raise TypeError('"log_interval" must be an integer.')
+    if not (tta is None or hasattr(tta, 'reduce')): raise TypeError('"tta" must be a TestTimeAugment or None')
+
+    # A disabled profiler does nothing
+    profiler = profiler or StepProfiler('', device, enabled = False)
     
     #Set model to evaluation
     model.eval()
 
-    correct = 0
-    total = 0
+    # One slot per image (streamed shards of a distributed run may fill fewer)
+    n_images = len(testloader.dataset)
+    true_labels = torch.empty(n_images, dtype = torch.int64, device = device)
+    probabilities = torch.empty(n_images, dtype = torch.float32, device = device)
 
+    # Correct predictions stay on the device, so no step waits for it
+    correct = torch.zeros((), dtype = torch.int64, device = device)
+    total = 0
 
-    true_labels, predicted_labels, probabilities = [], [], []
+    n_batches = len(testloader)
 
     with torch.no_grad():
 
-        for batch_idx, (inputs, labels) in enumerate(testloader):
+        for batch_idx, (inputs, labels) in enumerate(profiler.iterate(testloader)):
 
-            inputs, labels = inputs.to(device), labels.to(device)
-            labels = labels.float()
+            with profiler.phase('h2d'):
+                inputs, labels = inputs.to(device, non_blocking = True), labels.to(device, non_blocking = True)
+
+            # Batched transforms (e.g. normalization)
+            if batch_transform is not None:
+                with profiler.phase('transform'):
+                    inputs = batch_transform(inputs)
+
+            # Views of every image, stacked into a single batch
+            if tta is not None:
+                with profiler.phase('transform'):
+                    inputs = tta(inputs)
             
-            # Forward pass
-            outputs = model(inputs)[:,:1].squeeze(1)
+            # Forward pass (logits of the views averaged)
+            with profiler.phase('forward'):
+                with autocast(device, amp_dtype):
+                    outputs = model(inputs)
+                outputs = outputs[:,:1].squeeze(1) if tta is None else tta.reduce(outputs[:,:1].squeeze(1))
 
-            # Get predicted probability 
-            probs = torch.sigmoid(outputs).tolist()
+            # Predicted probabilities and true labels of the batch, written in place
+            batch_size = labels.size(0)
+            probs = probabilities[total:total + batch_size]
+            torch.sigmoid(outputs.float(), out = probs)
+            true_labels[total:total + batch_size] = labels
 
-            # Convert probability to class
-            predicted_class = torch.Tensor([1 if elem > 0.5 else 0 for elem in probs]).to(device)
+            correct += (probs > 0.5).eq(labels).sum()
+            total += batch_size
 
-            # Accumulate true, predicted labels and probabilities
-            true_labels.extend( labels.data.tolist() )
-            predicted_labels.extend( predicted_class.tolist() )
-            probabilities.extend( probs )
+            # Reading the accuracy waits for the device
+            if batch_idx == 0 or (batch_idx + 1) % log_interval == 0 or batch_idx == n_batches - 1:
+                n_correct = int(correct)
+                progress_bar(batch_idx, n_batches, ' Acc: %.3f%% (%d/%d)'
+                    % (100.*n_correct/total, n_correct, total))
 
-            # Add total and correct predictions
-            total += labels.size(0)
-            correct += predicted_class.eq(labels).sum().item()
+            profiler.step(batch_size)
 
-            # Update progress bar
-            progress_bar(batch_idx, len(testloader), ' Acc: %.3f%% (%d/%d)'
-                % (100.*correct/total, correct, total))
+    profiler.finish()
 
+    # Convert probability to class, for every image at once
+    predicted_labels = (probabilities[:total] > 0.5).long()
 
-    return true_labels, predicted_labels, probabilities
\ No newline at end of file
+    return true_labels[:total].cpu().numpy(), predicted_labels.cpu().numpy(), probabilities[:total].cpu().numpy()
@@ -2,6 +2,8 @@
 import torch
 from torch import mean
 import torchvision.transforms as transforms
+from batch_transforms import BatchAugment, BatchChannelsLast, BatchCompose, BatchNormalize, BatchResize
+from stats import NORM_MEAN, NORM_STD, merge_stats
 from adabound import AdaBound
 
 
@@ -22,6 +24,8 @@ from cnn_models.AlexNet import *
 import numpy as np
 
 # Others
+import copy
+import os
 import pickle
 import sys
 import time
@@ -33,9 +37,14 @@ last_time = time.time()
 begin_time = last_time
 term_width = 100
 
+# The bar is redrawn at most once every MIN_DRAW_INTERVAL seconds
+MIN_DRAW_INTERVAL = 0.1
+last_step = 0
+
 def progress_bar(current: int, total: int, msg: str=None) -> None:
     """
-    Displays a progress bar while training or testing
+    Displays a progress bar while training or testing.
+    It may be called only every few steps, the step time shown is the average since the last call.
 
     Args:
         current (int): Current batch index.
@@ -56,24 +65,22 @@ def progress_bar(current: int, total: int, msg: str=None) -> None:
     if not (msg is None or isinstance(msg, str)): raise TypeError('"msg" must be a str or None.')
 
 
-    global last_time, begin_time
+    global last_time, begin_time, last_step
+    cur_time = time.time()
+
     if current == 0:
-        begin_time = time.time()  # Reset for new bar.
+        begin_time = cur_time  # Reset for new bar.
+        last_time, last_step = cur_time, -1
+
+    # Rate limit, the last step is always drawn
+    if 0 < current < total-1 and cur_time - last_time < MIN_DRAW_INTERVAL:
+        return
 
     cur_len = int(TOTAL_BAR_LENGTH*current/total)
     rest_len = int(TOTAL_BAR_LENGTH - cur_len) - 1
 
-    sys.stdout.write(' [')
-    for i in range(cur_len):
-        sys.stdout.write('=')
-    sys.stdout.write('>')
-    for i in range(rest_len):
-        sys.stdout.write('.')
-    sys.stdout.write(']')
-
-    cur_time = time.time()
-    step_time = cur_time - last_time
-    last_time = cur_time
+    step_time = (cur_time - last_time) / max(current - last_step, 1)
+    last_time, last_step = cur_time, current
     tot_time = cur_time - begin_time
 
     L = []
@@ -83,19 +90,16 @@ def progress_bar(current: int, total: int, msg: str=None) -> None:
         L.append(' | ' + msg)
 
     msg = ''.join(L)
-    sys.stdout.write(msg)
-    for i in range(term_width-int(TOTAL_BAR_LENGTH)-len(msg)-3):
-        sys.stdout.write(' ')
+
+    # The whole bar is written at once
+    bar = [' [', '=' * cur_len, '>', '.' * rest_len, ']', msg, ' ' * (term_width-int(TOTAL_BAR_LENGTH)-len(msg)-3)]
 
     # Go back to the center of the bar.
-    for i in range(term_width-int(TOTAL_BAR_LENGTH/2)+2):
-        sys.stdout.write('\b')
-    sys.stdout.write(' %d/%d ' % (current+1, total))
+    bar.append('\b' * (term_width-int(TOTAL_BAR_LENGTH/2)+2))
+    bar.append(' %d/%d ' % (current+1, total))
+    bar.append('\r' if current < total-1 else '\n')
 
-    if current < total-1:
-        sys.stdout.write('\r')
-    else:
-        sys.stdout.write('\n')
+    sys.stdout.write(''.join(bar))
     sys.stdout.flush()
 
 
@@ -157,21 +161,29 @@ def format_time(seconds):
     return f
 
 
-def build_model(model_name: str) -> nn.Module:
+def build_model(model_name: str, channels_last: bool = False) -> nn.Module:
     """
     Function that builds the model to train based on the provided name.
 
     Args:
         model_name (str): The name of the model to build.
+        channels_last (bool, optional): Whether the weights are converted to the channels_last (NHWC) memory format,
+        often faster for convolutions on modern CPU kernels. Defaults to False.
 
     Raises:
         TypeError: The given model_name is not a str
+        TypeError: The given channels_last flag is not a bool
         ValueError: The given name of the model is not available.
 
     Returns:
         nn.Module: The model to train.
     """    
 
+    if not isinstance(channels_last, bool): raise TypeError('"channels_last" must be a bool')
+
+    if channels_last:
+        return build_model(model_name).to(memory_format = torch.channels_last)
+
     # Available models
     net_models = ["alexnet", "convnext_tiny", "convnext_small", "convnext_base", "convnext_large", "densenet121", "densenet161", "efficientnetb0", "efficientnetb1", "efficientnetb2",
     "efficientnetb3", "efficientnetb4", "efficientnetb5", "efficientnetb6", "efficientnetb7", "googlenet", "lenet5",
@@ -265,6 +277,120 @@ def build_model(model_name: str) -> nn.Module:
     if model_name == "vgg19":
         return torch_models.vgg19_bn(pretrained = True)
 
+def unwrap_model(model: nn.Module) -> nn.Module:
+    """
+    Returns the original model of a compiled and/or DistributedDataParallel model, so its state dict has the usual keys.
+
+    Args:
+        model (nn.Module): The model, wrapped or not.
+
+    Returns:
+        nn.Module: The original model.
+    """
+    # torch.compile keeps the model in "_orig_mod", DistributedDataParallel in "module"
+    while True:
+        if hasattr(model, '_orig_mod'):
+            model = model._orig_mod
+        elif isinstance(model, nn.parallel.DistributedDataParallel):
+            model = model.module
+        else:
+            return model
+
+def layout_neutral_state_dict(model: nn.Module) -> dict:
+    """
+    Returns the state dict of a model with every tensor contiguous (NCHW), so a checkpoint
+    saved from a channels_last model loads the same way in either memory format.
+
+    Args:
+        model (nn.Module): The model, compiled or not.
+
+    Returns:
+        dict: The state dict.
+    """
+    return { key: value.contiguous() for key, value in unwrap_model(model).state_dict().items() }
+
+def compile_model(model: nn.Module, inputs: torch.Tensor, train: bool = False, cache_dir: str = './cache/inductor') -> nn.Module:
+    """
+    Compiles the model with torch.compile and runs it in every mode it is used in (training, evaluation
+    without gradients, and a smaller batch, so the graph with a dynamic batch size is built too),
+    so compilation happens here and not in the first steps. Compiled kernels are cached on disk, so
+    later runs start faster. If the model fails to compile the eager model is returned, and if a later
+    recompilation (new shapes or modes) fails the model runs eagerly from then on. Both are logged, and
+    no global compiler setting is changed, so other compiled models still report their errors.
+
+    Args:
+        model (nn.Module): The model.
+        inputs (torch.Tensor): Example batch, on the same device as the model.
+        train (bool, optional): Whether the backward pass is compiled too. Defaults to False.
+        cache_dir (str, optional): Directory of the compilation cache. Defaults to './cache/inductor'.
+
+    Raises:
+        TypeError: The given model is not a nn.Module
+        TypeError: The given inputs are not a torch.Tensor
+
+    Returns:
+        nn.Module: The compiled model, or the same model if it could not be compiled.
+    """
+    if not isinstance(model, nn.Module): raise TypeError('"model" must be a nn.Module')
+    if not isinstance(inputs, torch.Tensor): raise TypeError('"inputs" must be a torch.Tensor')
+
+    if not hasattr(torch, 'compile'):
+        print("torch.compile is not available, running eagerly")
+        return model
+
+    # Persistent compilation cache
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(cache_dir))
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except (ImportError, AttributeError):
+        pass
+
+    # The warm up step must not change the weights or the BatchNorm statistics
+    state = copy.deepcopy(model.state_dict())
+    was_training = model.training
+
+    compiled = torch.compile(model)
+
+    try:
+        print("Compiling model...")
+        if train:
+            compiled.train()
+            compiled(inputs).sum().backward()
+
+        # Evaluation (test, predictions) with the batch and a smaller one (last batch, test-time augmentation views)
+        compiled.eval()
+        with torch.no_grad():
+            compiled(inputs)
+            if inputs.shape[0] > 1:
+                compiled(inputs[:max(1, inputs.shape[0] // 2)])
+
+    except Exception as error:
+        print("Model could not be compiled, running eagerly:", error)
+        compiled = model
+
+    model.zero_grad(set_to_none = True)
+    model.load_state_dict(state)
+    model.train(was_training)
+
+    if compiled is not model:
+
+        # Recompilations after the warm up (e.g. the last, smaller batch of an epoch) fall back to eager on failure, for this model only
+        compiled_forward = compiled.forward
+
+        def forward(*args, **kwargs):
+            try:
+                return compiled_forward(*args, **kwargs)
+
+            except torch._dynamo.exc.TorchDynamoException as error:
+                print("Model could not be recompiled, running eagerly:", error)
+                compiled.forward = model.forward
+                return model(*args, **kwargs)
+
+        compiled.forward = forward
+
+    return compiled
+
 def build_optimizer(model: torch.nn.Module, optimizer_name: str) -> torch.optim.Optimizer:
 
     """
@@ -301,14 +427,54 @@ def build_optimizer(model: torch.nn.Module, optimizer_name: str) -> torch.optim.
         return AdaBound(model.parameters(), lr= 1e-3, final_lr = 0.1)
 
 
-def build_transforms(model_name:str) -> Tuple[transforms.Compose, transforms.Compose]:
+def build_precision(precision: str, device: str) -> Tuple[torch.dtype, torch.cuda.amp.GradScaler]:
+
+    """
+    Function that builds the mixed precision settings based on the provided name.
+
+    Args:
+        precision (str): The name of the precision ('fp32', 'bf16' or 'fp16').
+        device (str): Device to use (CPU or GPU).
+
+    Raises:
+        TypeError: The given precision is not a str
+        ValueError: The given precision is not available.
+        ValueError: float16 is requested on a device other than a GPU.
+
+    Returns:
+        torch.dtype: The type used by autocast (None for float32).
+        torch.cuda.amp.GradScaler: The loss scaler (None if it is not needed).
+    """
+    # Available precisions
+    precisions = ['fp32', 'bf16', 'fp16']
+
+    if not isinstance(precision, str): raise TypeError('"precision" must be a str')
+    if precision not in precisions: raise ValueError('"precision" must be one of the available precisions: ' + ', '.join(precisions))
+
+    if precision == 'fp32':
+        return None, None
+
+    # bfloat16 has the range of float32, so gradients do not need scaling
+    if precision == 'bf16':
+        return torch.bfloat16, None
+
+    if not device.startswith('cuda'): raise ValueError('float16 mixed precision requires a GPU, use bf16 on CPU')
+
+    return torch.float16, torch.cuda.amp.GradScaler()
+
+def build_transforms(model_name:str, batch_augment: bool = False, device_resize: bool = False, mean: tuple = NORM_MEAN, std: tuple = NORM_STD) -> Tuple[transforms.Compose, transforms.Compose]:
 
     """
     Function that builds the transforms to apply to the data based on the provided name.
 
     Args:
         model_name (str): The name of the model to build.
-        pca (bool): Whether to apply PCA.
+        batch_augment (bool, optional): Whether the random flips are left out because they are applied
+        on the whole batch by a batch_transforms.BatchAugment. Defaults to False.
+        device_resize (bool, optional): Whether the ViT resize is left out because it is applied
+        on the whole batch by a batch_transforms.BatchResize. Defaults to False.
+        mean (tuple, optional): Mean of every channel of the training data (see stats.dataset_stats). Defaults to NORM_MEAN.
+        std (tuple, optional): Standard deviation of every channel of the training data. Defaults to NORM_STD.
 
     Raises:
         ValueError: The given name of the model is not available.
@@ -326,6 +492,8 @@ def build_transforms(model_name:str) -> Tuple[transforms.Compose, transforms.Com
 
     if not isinstance(model_name, str): raise TypeError('"model_name" must be a str')
     if model_name not in net_models: raise ValueError('"model_name" must be one of the available models: ' + ', '.join(net_models))
+    if not isinstance(batch_augment, bool): raise TypeError('"batch_augment" must be a bool')
+    if not isinstance(device_resize, bool): raise TypeError('"device_resize" must be a bool')
 
     if model_name == 'vit_b_16' or model_name == 'vit_b_32' or model_name == 'vit_l_16' or model_name == 'vit_l_32':
         
@@ -345,7 +513,7 @@ def build_transforms(model_name:str) -> Tuple[transforms.Compose, transforms.Com
             transforms.Resize((224,224)),
 
             # Normalize train dataset with its mean and standard deviation
-            transforms.Normalize((0.7595, 0.5646, 0.6882), (0.1497, 0.1970, 0.1428))
+            transforms.Normalize(mean, std)
         ])
 
         test_transform = transforms.Compose([
@@ -358,7 +526,7 @@ def build_transforms(model_name:str) -> Tuple[transforms.Compose, transforms.Com
             transforms.Resize((224,224)),
 
             # Normalize test dataset with the mean and standard deviation of the training data
-            transforms.Normalize((0.7595, 0.5646, 0.6882), (0.1497, 0.1970, 0.1428))
+            transforms.Normalize(mean, std)
         ])
         
 
@@ -377,7 +545,7 @@ def build_transforms(model_name:str) -> Tuple[transforms.Compose, transforms.Com
             transforms.RandomVerticalFlip(p = 0.05),
 
             # Normalize train dataset with its mean and standard deviation
-            transforms.Normalize((0.7595, 0.5646, 0.6882), (0.1497, 0.1970, 0.1428))
+            transforms.Normalize(mean, std)
         ])
 
         test_transform = transforms.Compose([
@@ -386,10 +554,86 @@ def build_transforms(model_name:str) -> Tuple[transforms.Compose, transforms.Com
             transforms.ToTensor(),
             
             # Normalize test dataset with its mean and standard deviation
-            transforms.Normalize((0.7595, 0.5646, 0.6882), (0.1497, 0.1970, 0.1428))
+            transforms.Normalize(mean, std)
         ])
 
 
+    if batch_augment:
+
+        # Flips are done on the device, after the batch has been collated
+        train_transform = transforms.Compose([ transf for transf in train_transform.transforms
+            if not isinstance(transf, (transforms.RandomHorizontalFlip, transforms.RandomVerticalFlip)) ])
+
+    if device_resize:
+
+        # The ViT resize is done on the device, so the loader only moves 50 x 50 images
+        train_transform = transforms.Compose([ transf for transf in train_transform.transforms if not isinstance(transf, transforms.Resize) ])
+        test_transform = transforms.Compose([ transf for transf in test_transform.transforms if not isinstance(transf, transforms.Resize) ])
+
+    return train_transform, test_transform
+
+def build_batch_transforms(model_name: str, uint8: bool = False, batch_augment: bool = False, device_resize: bool = False, angles: list = None,
+                           mean: tuple = NORM_MEAN, std: tuple = NORM_STD, channels_last: bool = False) -> Tuple[BatchCompose, BatchCompose]:
+
+    """
+    Function that builds the transforms applied to whole batches once they are on the device.
+    They complement the transforms returned by build_transforms.
+
+    Args:
+        model_name (str): The name of the model to build.
+        uint8 (bool, optional): Whether the dataset returns raw uint8 images, which are then normalized on the device. Defaults to False.
+        batch_augment (bool, optional): Whether the random flips and rotations are done on the device. Defaults to False.
+        device_resize (bool, optional): Whether the ViT resize is done on the device. Defaults to False.
+        angles (list, optional): Discrete rotation set used by the batch augmentation. Defaults to None.
+        mean (tuple, optional): Mean of every channel of the training data (see stats.dataset_stats). Defaults to NORM_MEAN.
+        std (tuple, optional): Standard deviation of every channel of the training data. Defaults to NORM_STD.
+        channels_last (bool, optional): Whether batches are kept in the channels_last memory format after the other transforms. Defaults to False.
+
+    Raises:
+        TypeError: The given model_name is not a str
+        TypeError: The given booleans are not booleans. (True or False)
+
+    Returns:
+        BatchCompose: The batch transforms to apply to the training data (None if there are none).
+        BatchCompose: The batch transforms to apply to the test data (None if there are none).
+    """
+    if not isinstance(model_name, str): raise TypeError('"model_name" must be a str')
+    if not isinstance(uint8, bool): raise TypeError('"uint8" must be a bool')
+    if not isinstance(batch_augment, bool): raise TypeError('"batch_augment" must be a bool')
+    if not isinstance(device_resize, bool): raise TypeError('"device_resize" must be a bool')
+    if not isinstance(channels_last, bool): raise TypeError('"channels_last" must be a bool')
+
+    train_transforms, test_transforms = [], []
+
+    if uint8:
+
+        # Normalize with the mean and standard deviation of the training data
+        normalize = BatchNormalize(mean, std)
+        train_transforms.append(normalize)
+        test_transforms.append(normalize)
+
+    # Raw images skip the per-image resize as well
+    if model_name.startswith('vit') and (device_resize or uint8):
+
+        # This resize is required to provide a correct input
+        # to a pretrained ViT of patch size == 16
+        resize = BatchResize((224, 224))
+        train_transforms.append(resize)
+        test_transforms.append(resize)
+
+    # Flips and rotations after normalization and resize, as the per-image transforms do
+    if batch_augment or uint8:
+        train_transforms.append(BatchAugment(angles = angles))
+
+    # Resampling may return contiguous batches, so the layout is restored last
+    if channels_last and train_transforms:
+        train_transforms.append(BatchChannelsLast())
+    if channels_last and test_transforms:
+        test_transforms.append(BatchChannelsLast())
+
+    train_transform = BatchCompose(train_transforms) if train_transforms else None
+    test_transform = BatchCompose(test_transforms) if test_transforms else None
+
     return train_transform, test_transform
 
 def interval95(acc:float, n_data:int) -> float:
@@ -427,21 +671,23 @@ def get_mean_and_std(dataloader: torch.utils.data.DataLoader) -> Tuple[torch.Ten
     """    
     if not isinstance(dataloader, torch.utils.data.DataLoader): raise TypeError('"dataloader" must be a torch.utils.data.DataLoader')
 
-    channels_sum, channels_squared_sum, num_batches = 0, 0, 0
+    # Number of values, mean and sum of squared deviations of every channel.
+    # Merged batch by batch, so a short last batch weighs exactly as much as its pixels
+    stats = (0, np.zeros(0), np.zeros(0))
 
     for data, _ in dataloader:
-        # Computes mean over batch, height and width, not over the channels
-        channels_sum += mean(data, dim=[0,2,3])
-        channels_squared_sum += mean(data**2, dim=[0,2,3])
-        num_batches += 1
-    
-    data_mean = channels_sum / num_batches
+        # Values of every channel (over batch, height and width)
+        data = data.transpose(0, 1).reshape(data.shape[1], -1).double()
+        batch_mean = data.mean(dim = 1)
+
+        stats = merge_stats(stats, (data.shape[1], batch_mean.numpy(), ((data - batch_mean[:, None])**2).sum(dim = 1).numpy()))
+
+    n, data_mean, m2 = stats
 
-    # Var[X] = E[X**2] - E[X] ** 2
     # Standard deviation
-    std = (channels_squared_sum / num_batches  - data_mean**2) ** 0.5
+    std = np.sqrt(m2 / n)
 
-    return data_mean, std
+    return torch.from_numpy(data_mean).float(), torch.from_numpy(std).float()
     
 def count_parameters(model: nn.Module) -> int:
     """